@@ -0,0 +1,599 @@
+#channel.py
+""" One channel access API for every fstiming script, whatever CA client is installed.
+
+channel.Pv(name) returns a channel with the psp.Pv interface femto.py was
+written against:
+- connect(timeout), isconnected, disconnect()
+- get(ctrl, timeout) and put(value, timeout), value / secs / nsec / severity;
+  timeout=None only queues the request and flush_io() sends what is queued
+- wait_connected(pvs, timeout): waits for channels started with
+  connect(timeout=None) under one deadline (psp connects through a
+  connection handler, which pend_io does not wait for either)
+- get_all(pvs, timeout) / put_all(pvs, values, timeout): batches that send
+  every request at once and wait for each one to complete under one deadline
+  (psp's queued requests complete through callbacks, which pend_io does not
+  wait for)
+- monitor(), add_monitor_callback(cb) / del_monitor_callback(id), cb(None) on
+  every update
+- put_callback(value, fn): write, fn() once the IOC has processed it
+caget(name) / caput(name, value) keep one channel per name for scripts that
+work by PV name.
+
+Backends:
+- psp: psp.Pv and pyca (python 2.7 IOC hosts), the channels are psp Pvs
+- pyepics: epics.PV
+- caproto: caproto's threading client through its pyepics compatible PV
+- fake: values kept in this process, for tests and benchmarks
+
+FS_EPICS_BACKEND picks one for every script. Otherwise a script's prefer()
+choice is used, or the first of psp, pyepics and caproto that imports. The
+backend is set up on first use, after femtosim has had a chance to install
+its stand-in modules.
+"""
+
+import os
+import threading
+import time
+
+order = ['psp', 'pyepics', 'caproto'] # tried in this order when nothing is chosen
+chosen = None # backend in use, set on first use
+preferred = None # set by prefer()
+
+
+class error(Exception):
+    """Raised for a channel that doesn't connect or answer in time (backends other than psp)."""
+    pass
+
+
+class psp_backend():
+    """psp.Pv channels, pyca batching."""
+    name = 'psp'
+
+    def __init__(self):
+        from psp.Pv import Pv
+        import pyca
+        base = Pv
+        class psp_channel(Pv):
+            """psp.Pv with a put-callback and completion events for queued gets and puts."""
+            def __init__(self, name, **kw):
+                self.get_event = threading.Event() # set by pyca when a queued get completes
+                self.put_event = threading.Event() # set by pyca when a queued put completes
+                self.get_error = None
+                self.put_error = None
+                base.__init__(self, name, **kw)
+
+            def getevt_cb(self, e=None):
+                """pyca callback for a queued get, e is None on success."""
+                if hasattr(base, 'getevt_cb'):
+                    base.getevt_cb(self, e)
+                self.get_error = e
+                self.get_event.set()
+
+            def putevt_cb(self, e=None):
+                """pyca callback for a queued put, e is None on success."""
+                if hasattr(base, 'putevt_cb'):
+                    base.putevt_cb(self, e)
+                self.put_error = e
+                self.put_event.set()
+
+            def get_nowait(self, ctrl=True):
+                """Queues a read, completion sets get_event."""
+                self.get_event.clear()
+                self.get(ctrl=ctrl, timeout=None)
+
+            def put_nowait(self, value):
+                """Queues a write, completion sets put_event."""
+                self.put_event.clear()
+                self.put(value, timeout=None)
+
+            def put_callback(self, value, fn, timeout=10.0):
+                """Takes a value and a function, writes the value and calls fn() once the write completed, without waiting for it."""
+                def run():
+                    attach_context()
+                    self.put(value, timeout=timeout) # waits for the completion
+                    fn()
+                th = threading.Thread(target=run)
+                th.daemon = True
+                th.start()
+        self.Pv = psp_channel
+        self.flush_io = pyca.flush_io
+        self.pend_io = pyca.pend_io
+        self.pend_event = getattr(pyca, 'pend_event', time.sleep)
+        self.attach_context = getattr(pyca, 'attach_context', lambda: None)
+        self.errors = (pyca.pyexc, pyca.caexc, error)
+
+    def wait_connected(self, pvs, timeout):
+        """Takes a dict of name -> channel and a timeout in s, waits for them to connect, returns the names that didn't."""
+        end = time.time() + timeout
+        waiting = [name for name, ch in pvs.items() if not ch.isconnected]
+        while waiting and time.time() < end:
+            self.pend_event(min(0.01, max(end - time.time(), 0.001))) # connection handlers set isconnected
+            waiting = [name for name in waiting if not pvs[name].isconnected]
+        return waiting
+
+    def get_all(self, pvs, timeout):
+        """Takes a dict of name -> channel and a timeout in s, reads them all at once, returns the names whose read failed or didn't complete."""
+        end = time.time() + timeout
+        sent = []
+        failed = []
+        for name, ch in pvs.items():
+            try:
+                ch.get_nowait()
+                sent.append(name)
+            except:
+                failed.append(name)
+        self.flush_io()
+        for name in sent:
+            ch = pvs[name]
+            if not ch.get_event.wait(max(end - time.time(), 0)) or ch.get_error is not None:
+                failed.append(name)
+        return failed
+
+    def put_all(self, pvs, values, timeout):
+        """Takes a dict of name -> channel, one of name -> value and a timeout in s, writes them all at once, returns the names whose write failed or didn't complete."""
+        end = time.time() + timeout
+        sent = []
+        failed = []
+        for name, ch in pvs.items():
+            try:
+                ch.put_nowait(values[name])
+                sent.append(name)
+            except:
+                failed.append(name)
+        self.flush_io()
+        for name in sent:
+            ch = pvs[name]
+            if not ch.put_event.wait(max(end - time.time(), 0)) or ch.put_error is not None:
+                failed.append(name)
+        return failed
+
+
+class pyepics_channel():
+    """psp.Pv interface on a pyepics style PV (pyepics, or caproto's pyepics_compat)."""
+    def __init__(self, backend, name):
+        """Takes the backend and the PV name, doesn't connect yet."""
+        self.backend = backend
+        self.name = name
+        self.pv = None # made on connect
+        self.value = None
+        self.secs = 0
+        self.nsec = 0
+        self.severity = 0
+        self.ismonitored = False
+        self.monitor_cbs = dict() # id -> function
+        self.next_cb = 0
+        self.cb_index = None
+
+    @property
+    def isconnected(self):
+        return self.pv is not None and bool(self.pv.connected)
+
+    def connect(self, timeout=None):
+        """Starts connecting; with a timeout, waits for it and raises error if it doesn't connect."""
+        if self.pv is None:
+            self.pv = self.backend.PV(self.name)
+        if timeout is None:
+            self.backend.connecting.append(self) # pend_io waits for it
+            return
+        if not self.pv.wait_for_connection(timeout=timeout):
+            raise error('connection timed out: ' + self.name)
+
+    def disconnect(self):
+        if self.pv is not None:
+            self.pv.disconnect()
+            self.pv = None
+        self.ismonitored = False
+
+    def update(self, value, stamp=None, severity=None):
+        """Takes a value read or sent by the IOC, stores it with its time stamp and severity."""
+        self.value = value
+        stamp = time.time() if stamp is None else stamp
+        self.secs = int(stamp)
+        self.nsec = int((stamp - self.secs) * 1e9)
+        if severity is not None:
+            self.severity = severity
+
+    def get(self, ctrl=None, timeout=None, **kw):
+        """Reads the value; timeout=None queues the read for pend_io."""
+        if self.pv is None:
+            self.connect(timeout if timeout is not None else 1.0)
+        if timeout is None:
+            self.backend.request(self)
+            return None
+        self.backend.complete(self, timeout)
+        return self.value
+
+    def put(self, value, timeout=None, **kw):
+        """Writes the value; with a timeout, waits until the IOC has processed it."""
+        if self.pv is None:
+            self.connect(1.0)
+        if timeout is None:
+            self.pv.put(value, wait=False)
+        elif not self.backend.put_done(self.pv.put(value, wait=True, timeout=timeout)):
+            raise error('write failed or timed out: ' + self.name)
+        self.value = value
+
+    def put_callback(self, value, fn, timeout=10.0):
+        """Takes a value and a function, writes the value and calls fn() once the write completed, without waiting for it."""
+        if self.pv is None:
+            self.connect(1.0)
+        self.pv.put(value, wait=False, callback=lambda **kw: fn())
+        self.value = value
+
+    def monitor(self, mask=None, ctrl=False, count=None, wait_first=False):
+        if self.pv is None:
+            self.connect(1.0)
+        if not self.ismonitored:
+            self.ismonitored = True
+            self.cb_index = self.pv.add_callback(self.event)
+
+    def monitor_stop(self):
+        if self.cb_index is not None:
+            self.pv.remove_callback(self.cb_index)
+            self.cb_index = None
+        self.ismonitored = False
+
+    def event(self, value=None, timestamp=None, severity=None, **kw):
+        """pyepics callback: stores the update and calls the monitor callbacks."""
+        self.update(value, timestamp, severity)
+        for cb in list(self.monitor_cbs.values()):
+            cb(None)
+
+    def add_monitor_callback(self, cb, once=False):
+        self.next_cb += 1
+        self.monitor_cbs[self.next_cb] = cb
+        return self.next_cb
+
+    def del_monitor_callback(self, id):
+        self.monitor_cbs.pop(id, None)
+
+    def timestamp(self):
+        return (self.secs, self.nsec)
+
+
+class pyepics_backend():
+    """pyepics PVs behind the psp.Pv interface; queued reads go out at once and pend_io collects them."""
+    name = 'pyepics'
+
+    def __init__(self):
+        import epics
+        self.PV = epics.PV
+        self.ca = getattr(epics, 'ca', None) # low level calls for reads without waiting (not in femtosim's stand-in)
+        self.connecting = [] # channels pend_io waits to connect
+        self.queued = [] # channels with a read for pend_io
+        self.lock = threading.Lock()
+        self.errors = (error,) + ((self.ca.ChannelAccessException,) if hasattr(self.ca, 'ChannelAccessException') else ())
+
+    def Pv(self, name):
+        return pyepics_channel(self, name)
+
+    def put_done(self, ret):
+        """Takes what PV.put(wait=True) returned, True if the write completed: 1, -1 on a timeout, None if not connected."""
+        return ret == 1
+
+    def request(self, ch):
+        """Takes a channel, starts a read for pend_io without waiting for it."""
+        if self.ca is not None:
+            self.ca.get(ch.pv.chid, wait=False) # on the wire now, pend_io only collects it
+        with self.lock:
+            self.queued.append(ch)
+
+    def complete(self, ch, timeout, sent=False):
+        """Takes a channel, a timeout in s and whether its read was already sent, finishes (or does) the read, raises error if it doesn't answer."""
+        if self.ca is not None and sent:
+            value = self.ca.get_complete(ch.pv.chid, timeout=timeout)
+        else:
+            value = ch.pv.get(timeout=timeout, use_monitor=False)
+        if value is None:
+            raise error('read timed out: ' + ch.name)
+        ch.update(value, getattr(ch.pv, 'timestamp', None), getattr(ch.pv, 'severity', None))
+
+    def flush_io(self):
+        pass # pyepics sends right away
+
+    def pend_io(self, timeout=None):
+        """Waits up to timeout s in total for the queued connections and reads, raises error if any didn't finish."""
+        end = time.time() + (timeout or 1.0)
+        with self.lock:
+            connecting, self.connecting = self.connecting, []
+            queued, self.queued = self.queued, []
+        failed = []
+        for ch in connecting:
+            if not ch.pv.wait_for_connection(timeout=max(end - time.time(), 0.001)):
+                failed.append(ch.name)
+        for ch in queued:
+            try:
+                self.complete(ch, max(end - time.time(), 0.001), sent=True)
+            except error:
+                failed.append(ch.name)
+        if failed:
+            raise error('timed out: ' + ', '.join(failed))
+
+    def wait_connected(self, pvs, timeout):
+        """Takes a dict of name -> channel and a timeout in s, waits for them to connect, returns the names that didn't."""
+        end = time.time() + timeout
+        chs = list(pvs.values())
+        with self.lock: # waited for here, pend_io needn't
+            self.connecting = [ch for ch in self.connecting if ch not in chs]
+        failed = []
+        for name, ch in pvs.items():
+            if ch.pv is None:
+                ch.pv = self.PV(ch.name)
+            if not ch.pv.wait_for_connection(timeout=max(end - time.time(), 0.001)):
+                failed.append(name)
+        return failed
+
+    def get_all(self, pvs, timeout):
+        """Takes a dict of name -> channel and a timeout in s, reads them all at once, returns the names whose read failed or didn't complete."""
+        end = time.time() + timeout
+        sent = []
+        failed = []
+        for name, ch in pvs.items():
+            try:
+                if ch.pv is None:
+                    ch.connect(max(end - time.time(), 0.001))
+                if self.ca is not None:
+                    self.ca.get(ch.pv.chid, wait=False) # on the wire now
+                sent.append(name)
+            except Exception:
+                failed.append(name)
+        for name in sent:
+            try:
+                self.complete(pvs[name], max(end - time.time(), 0.001), sent=True)
+            except Exception:
+                failed.append(name)
+        return failed
+
+    def put_all(self, pvs, values, timeout):
+        """Takes a dict of name -> channel, one of name -> value and a timeout in s, writes them all at once, returns the names whose write failed or didn't complete."""
+        end = time.time() + timeout
+        done = dict() # name -> event set by the put callback
+        failed = []
+        for name, ch in pvs.items():
+            ev = threading.Event()
+            try:
+                if ch.pv is None:
+                    ch.connect(max(end - time.time(), 0.001))
+                ch.pv.put(values[name], wait=False, callback=lambda ev=ev, **kw: ev.set())
+                done[name] = ev
+            except Exception:
+                failed.append(name)
+        for name, ev in done.items():
+            if ev.wait(max(end - time.time(), 0)):
+                pvs[name].value = values[name]
+            else:
+                failed.append(name)
+        return failed
+
+    def attach_context(self):
+        pass # pyepics shares one context between threads
+
+
+class caproto_backend(pyepics_backend):
+    """caproto's threading client, through its pyepics compatible PV."""
+    name = 'caproto'
+
+    def __init__(self):
+        from caproto.threading import pyepics_compat
+        pyepics_backend.__init__(self)
+        self.PV = pyepics_compat.PV
+        self.ca = None
+        self.errors = (error, TimeoutError)
+
+    def put_done(self, ret):
+        return True # caproto's put returns None and raises on a timeout
+
+
+class fake_channel():
+    """A value kept in this process under a PV name, shared by every channel of that name."""
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+        self.value = backend.values.get(name)
+        self.secs = 0
+        self.nsec = 0
+        self.severity = 0
+        self.isconnected = False
+        self.ismonitored = False
+        self.monitor_cbs = dict()
+        self.next_cb = 0
+
+    def connect(self, timeout=None):
+        self.isconnected = True
+
+    def disconnect(self):
+        self.isconnected = False
+        self.monitor_stop()
+
+    def get(self, ctrl=None, timeout=None, **kw):
+        self.value = self.backend.values.get(self.name, 0)
+        return self.value
+
+    def put(self, value, timeout=None, **kw):
+        self.backend.write(self.name, value)
+
+    def put_callback(self, value, fn, timeout=10.0):
+        self.put(value)
+        fn()
+
+    def event(self, value):
+        self.value = value
+        stamp = time.time()
+        self.secs = int(stamp)
+        self.nsec = int((stamp - self.secs) * 1e9)
+        for cb in list(self.monitor_cbs.values()):
+            cb(None)
+
+    def monitor(self, mask=None, ctrl=False, count=None, wait_first=False):
+        if not self.ismonitored:
+            self.ismonitored = True
+            self.backend.watchers.setdefault(self.name, []).append(self)
+
+    def monitor_stop(self):
+        if self.ismonitored:
+            self.backend.watchers[self.name].remove(self)
+        self.ismonitored = False
+
+    def add_monitor_callback(self, cb, once=False):
+        self.next_cb += 1
+        self.monitor_cbs[self.next_cb] = cb
+        return self.next_cb
+
+    def del_monitor_callback(self, id):
+        self.monitor_cbs.pop(id, None)
+
+    def timestamp(self):
+        return (self.secs, self.nsec)
+
+
+class fake_backend():
+    """PV values in a dict in this process. Unknown names read 0; set values to seed them."""
+    name = 'fake'
+
+    def __init__(self):
+        self.values = dict() # PV name -> value
+        self.watchers = dict() # PV name -> monitoring channels
+        self.errors = (error,)
+
+    def Pv(self, name):
+        return fake_channel(self, name)
+
+    def write(self, name, value):
+        """Takes a PV name and value, stores it and sends it to the channels monitoring it."""
+        self.values[name] = value
+        for ch in list(self.watchers.get(name, [])):
+            ch.event(value)
+
+    def flush_io(self):
+        pass
+
+    def pend_io(self, timeout=None):
+        pass
+
+    def wait_connected(self, pvs, timeout):
+        return [name for name, ch in pvs.items() if not ch.isconnected]
+
+    def get_all(self, pvs, timeout):
+        for ch in pvs.values():
+            ch.get()
+        return []
+
+    def put_all(self, pvs, values, timeout):
+        for name, ch in pvs.items():
+            ch.put(values[name])
+        return []
+
+    def attach_context(self):
+        pass
+
+
+backends = dict(psp=psp_backend, pyepics=pyepics_backend, caproto=caproto_backend, fake=fake_backend)
+
+
+def use(name=None):
+    """Takes a backend name (None: $FS_EPICS_BACKEND, else the preferred one, else the first of order that imports), sets it up and returns it."""
+    global chosen
+    name = name or os.environ.get('FS_EPICS_BACKEND') or preferred
+    if name:
+        if name not in backends:
+            raise ValueError('unknown EPICS backend %r, use one of %s' % (name, ', '.join(sorted(backends))))
+        chosen = backends[name]()
+        return chosen
+    for name in order:
+        try:
+            chosen = backends[name]()
+            return chosen
+        except ImportError:
+            continue
+    raise ImportError('no EPICS client library found (tried %s)' % ', '.join(order))
+
+
+def prefer(name):
+    """Takes the backend a script was written for, used unless FS_EPICS_BACKEND names another. Call before the first channel."""
+    global preferred
+    preferred = name
+
+
+def backend():
+    """Returns the backend in use, setting it up on first use."""
+    return chosen or use()
+
+
+def Pv(name):
+    """Takes a PV name, returns a channel for it (not connected yet)."""
+    return backend().Pv(name)
+
+
+def flush_io():
+    """Sends the queued requests."""
+    backend().flush_io()
+
+
+def pend_io(timeout=None):
+    """Waits up to timeout s for every queued connection, read and write, raises one of errors() if any didn't finish."""
+    backend().pend_io(timeout)
+
+
+def wait_connected(pvs, timeout):
+    """Takes a dict of name -> channel (connect(timeout=None) already called) and a timeout in s, waits for all of them under one deadline, returns the names that didn't connect."""
+    remote = dict((k, v) for k, v in pvs.items() if not getattr(v, 'served', False)) # local records are always connected
+    return backend().wait_connected(remote, timeout) if remote else []
+
+
+def get_all(pvs, timeout):
+    """Takes a dict of name -> channel and a timeout in s, reads them all in one batch and waits for every read, returns the names whose read failed or didn't complete in time."""
+    remote = dict((k, v) for k, v in pvs.items() if not getattr(v, 'served', False)) # local records are always current
+    return backend().get_all(remote, timeout) if remote else []
+
+
+def put_all(pvs, values, timeout):
+    """Takes a dict of name -> channel, one of name -> value and a timeout in s, writes them all in one batch and waits for every write, returns the names whose write failed or didn't complete in time."""
+    remote = dict()
+    for k, v in pvs.items():
+        if getattr(v, 'served', False): # local record, a memory update
+            v.put(values[k])
+        else:
+            remote[k] = v
+    return backend().put_all(remote, values, timeout) if remote else []
+
+
+def attach_context():
+    """Lets the calling thread use the process's CA context (psp only, a no-op for the others)."""
+    backend().attach_context()
+
+
+def errors():
+    """Returns the exception classes the backend raises for CA problems."""
+    return backend().errors
+
+
+channels = dict() # PV name -> channel, for caget / caput
+
+
+def channel(name, timeout=1.0):
+    """Takes a PV name, returns its connected channel, made on first use and kept."""
+    ch = channels.get(name)
+    if ch is None:
+        ch = Pv(name)
+        ch.connect(timeout)
+        channels[name] = ch
+    return ch
+
+
+def caget(name, timeout=1.0):
+    """Takes a PV name, returns its value, None if it can't be read."""
+    try:
+        return channel(name, timeout).get(ctrl=True, timeout=timeout)
+    except Exception:
+        channels.pop(name, None) # connect again next time
+        return None
+
+
+def caput(name, value, timeout=None):
+    """Takes a PV name and value and writes it (waiting up to timeout s for the IOC to process it if given), returns True if it went out."""
+    try:
+        channel(name).put(value, timeout=timeout)
+        return True
+    except Exception:
+        channels.pop(name, None)
+        return False
@@ -0,0 +1,93 @@
+#checkpoint.py
+""" Locker state kept on disk so a restarted locker picks up where it stopped.
+
+The state is a small JSON object (counter readings, drift correction
+accumulator, last calibration, ...). write() replaces the file atomically:
+the new state goes to a temporary file in the same directory, is flushed to
+disk and renamed over the old one, so a reader sees the old or the new state,
+never half of one. saver does the writing from a daemon thread, the control
+loop only hands it the latest state.
+
+Works with python 2.7 and 3.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+version = 1 # bump when the layout of the state changes, older files are ignored
+
+
+def write(path, state):
+    """Takes a file path and a state dict, replaces the file with the state atomically."""
+    d = dict(state)
+    d['version'] = version
+    d['t'] = time.time()
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path), dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(d, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path) # atomic on POSIX, replaces the old file
+    except:
+        os.remove(tmp)
+        raise
+
+
+def read(path, max_age=None):
+    """Takes a file path and the oldest state in s accepted (None for any), returns (state, problems). state is None if unusable."""
+    try:
+        with open(path, 'r') as f:
+            d = json.load(f)
+    except (IOError, OSError) as e:
+        return None, ['cannot read %s: %s' % (path, e)]
+    except ValueError as e:
+        return None, ['bad state file %s: %s' % (path, e)]
+    if not isinstance(d, dict) or d.get('version') != version:
+        return None, ['state file %s has an old layout' % path]
+    age = time.time() - d.get('t', 0)
+    if max_age is not None and not -1 < age < max_age: # clock went back, or saved too long ago
+        return None, ['state file %s is %.0f s old' % (path, age)]
+    return d, []
+
+
+class saver(threading.Thread):
+    """Writes the latest state handed to it from a daemon thread, so a slow disk doesn't hold up the loop."""
+    def __init__(self, path):
+        """Takes the file path."""
+        threading.Thread.__init__(self, name=threading.current_thread().name + ':checkpoint') # owner's name first, femto_host sorts log records by it
+        self.daemon = True
+        self.path = path
+        self.state = None # latest state not yet written
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.writes = 0
+        self.failures = 0 # writes in a row that failed
+        self.start()
+
+    def save(self, state):
+        """Takes a state dict, writes it soon. Replaces a state still waiting to be written."""
+        with self.lock:
+            self.state = state
+        self.ready.set()
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            with self.lock:
+                state, self.state = self.state, None
+            if state is None:
+                continue
+            try:
+                write(self.path, state)
+                self.writes += 1
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                if self.failures == 1: # once per run of failures, not every few seconds
+                    logging.warning('Cannot write locker state %s: %r', self.path, e)
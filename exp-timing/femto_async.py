@@ -0,0 +1,292 @@
+#femto_async.py
+""" Event-driven asyncio engine for the femto locker.
+
+Runs the same locker, sawtooth and time_interval_counter logic as femto.py,
+but instead of polling every 100 ms it wakes on CA monitor events:
+- a new SR620 counter reading runs check_jump (and fix_jump if enabled)
+- a new FS_TGT_TIME (or delay, offset, enable, drift correction signal) runs set_time
+A periodic tick keeps the housekeeping (watchdog, locker status, calibration
+requests, degrees sync, loop time) at the old cadence, and runs check_jump
+itself when the counter has sent nothing for a second, so a dead SR620 still
+shows "No counter reading".
+
+Locker calls block on CA puts, so they run one at a time in a worker thread
+while the event loop keeps collecting monitor events. A call that fails is
+handled as in femto.py: the PVs that failed are reconnected, and after
+max_soft failures in a row the engine is rebuilt.
+
+Dependencies:
+- python 3
+- psp (same channel layer as femto.py)
+
+Usage: python femto_async.py <HUTCH>
+"""
+
+import asyncio
+import checkpoint
+import importlib
+import logging
+import supervisor
+import sys
+import time
+import watchdog
+
+
+class locker_engine():
+    """Runs one locker on an asyncio event loop, driven by counter and target time monitors."""
+    def __init__(self, name, tick=0.1):
+        """Takes the hutch name and housekeeping period in seconds, sets up PVs, watchdog and locker."""
+        self.name = name
+        self.tick = tick
+        self.counter_timeout = 1.0 # s without a counter event before on_tick checks the counter itself
+        self.max_soft = 3 # failed calls in a row recovered in place before a full rebuild
+        self.errors = 0 # failed calls in a row
+        self.error_start = None # time of the first error of the current run of them
+        self.rebuild = False # set by recover(), run() sets the engine up again
+        self.W = None
+        self.saver = None # writes the checkpoint file, kept across rebuilds
+        # XCS runs the long delay variant, same as st.cmd
+        self.F = importlib.import_module('femto_longdelay' if name == 'XCS' else 'femto')
+        self.setup()
+
+    def setup(self):
+        """Connects PVs and sets up watchdog, locker and degrees conversion, sets OK if ready to run."""
+        if self.W is not None:
+            self.W.stop() # the old heartbeat would look like another instance
+        self.P = self.F.PVS(self.name)
+        self.OK = self.P.OK
+        if not self.OK:
+            return
+        if not self.P.use_cache: # the engine needs monitors whether or not the config asks for the cache
+            self.P.use_cache = True
+            self.P.start_monitors()
+        self.W = watchdog.heartbeat(self.P.pvlist['watchdog']) # increments from its own thread, not from the event loop
+        if self.W.error:
+            self.OK = 0
+            return
+        self.L = self.F.locker(self.P, self.W)
+        self.resume()
+        if self.saver is None:
+            self.saver = checkpoint.saver(self.P.state_file)
+        self.saved = time.time() # last checkpoint
+        self.D = self.F.degrees_s(self.P)
+        self.flags = self.snapshot()
+        self.L.locker_status(self.flags)
+        self.P.E.write_error(self.L.message)
+        self.laser_ok = self.L.laser_ok
+        self.calibrating = False
+        self.counter_seen = time.time() # last counter monitor event
+
+    def resume(self):
+        """Restores the locker state saved before a restart, the parts that still match the PVs."""
+        s, problems = checkpoint.read(self.P.state_file, self.P.state_max_age)
+        if s is None:
+            logging.info('No saved locker state: %s', '; '.join(problems))
+            return
+        restored = self.L.resume(s, self.F.snapshot(self.P, self.L.inputs))
+        logging.info('Restored saved locker state: %s', ', '.join(restored) or 'nothing')
+
+    def run(self):
+        """Runs the engine until the watchdog reports an error, setting it up again when calls keep failing."""
+        while True:
+            asyncio.run(self.main())
+            if not self.rebuild:
+                break
+            self.rebuild = False
+            self.setup()
+            while not self.OK and not (self.W is not None and self.W.error): # PVs not back yet
+                time.sleep(1.0)
+                self.setup()
+            if not self.OK: # another instance has the watchdog
+                return
+        self.W.stop()
+        self.P.E.write_error('done, exiting')
+        self.P.flush()
+
+    async def main(self):
+        """Hooks monitor callbacks into the event loop and runs the counter, target and housekeeping tasks."""
+        self.loop = asyncio.get_running_loop()
+        self.lock = asyncio.Lock() # locker state is not thread safe, one call at a time
+        self.counter_event = asyncio.Event()
+        self.target_event = asyncio.Event()
+        self.stop = asyncio.Event()
+        hooks = [('counter', self.wake(self.counter_event))]
+        for name in ['time', 'delay', 'offset', 'enable']: # anything that changes where the motor should be
+            hooks.append((name, self.wake(self.target_event)))
+        if self.P.use_drift_correction:
+            hooks.append(('drift_correction_signal', self.wake(self.target_event)))
+        for name, fn in hooks:
+            self.P.add_callback(name, fn)
+        tasks = [asyncio.ensure_future(self.counter_task()),
+                 asyncio.ensure_future(self.target_task()),
+                 asyncio.ensure_future(self.housekeeping_task())]
+        await self.stop.wait()
+        for name, fn in hooks: # this event loop closes, a rebuild hooks up the next one
+            self.P.remove_callback(name, fn)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def wake(self, event):
+        """Takes an asyncio event, returns a monitor callback that sets it from the CA thread."""
+        def callback(value):
+            self.loop.call_soon_threadsafe(event.set)
+        return callback
+
+    def snapshot(self):
+        """Returns the locker inputs read together, so one handler sees consistent values."""
+        inputs = set(self.L.status_inputs + self.L.inputs + self.D.inputs + ['calibrate', 'fix_bucket', 'enable'])
+        return self.F.snapshot(self.P, sorted(inputs))
+
+    def flushed(self, fn):
+        """Takes a locker function, returns it wrapped to send its queued writes in one batch when it returns."""
+        def run():
+            try:
+                return fn()
+            finally:
+                self.P.flush()
+        return run
+
+    async def call(self, fn):
+        """Takes a locker function, runs it in a worker thread while holding the locker lock, then flushes its writes."""
+        async with self.lock:
+            try:
+                result = await self.loop.run_in_executor(None, self.flushed(fn))
+            except Exception as e:
+                await self.recover(fn, e)
+                return None
+        if self.error_start is not None: # first good call after errors
+            dt = time.time() - self.error_start
+            logging.info('Recovered after %.3f s.', dt)
+            for k in self.P.available(['recover_time']):
+                self.P.write(k, dt)
+            self.error_start = None
+        self.errors = 0
+        return result
+
+    async def recover(self, fn, e):
+        """Takes the locker function that failed and its exception, reconnects only the PVs that failed, or has run() rebuild the engine if that keeps failing."""
+        kind = self.F.error_kind(e)
+        logging.error('%s error in %s: %r', kind, fn.__name__, e)
+        if self.error_start is None:
+            self.error_start = time.time()
+        self.errors += 1
+        if kind != 'other' and self.errors <= self.max_soft:
+            bad = await self.loop.run_in_executor(None, self.P.reconnect)
+            if bad:
+                logging.warning('Still not responding: %s', ', '.join(bad))
+            return
+        logging.error('%d failed calls in a row, setting up the locker again', self.errors)
+        self.errors = 0
+        self.rebuild = True
+        self.stop.set()
+
+    def ready(self):
+        """Returns True when events should drive the locker (laser OK and not calibrating)."""
+        return self.laser_ok and not self.calibrating and not self.W.error
+
+    async def counter_task(self):
+        """Runs jump detection and correction on every new counter reading."""
+        while True:
+            await self.counter_event.wait()
+            self.counter_event.clear()
+            self.counter_seen = time.time()
+            if self.ready():
+                await self.call(self.on_counter)
+
+    async def target_task(self):
+        """Moves the trigger and phase motor on every new target time."""
+        while True:
+            await self.target_event.wait()
+            self.target_event.clear()
+            if self.ready() and self.flags['enable']:
+                await self.call(self.on_target)
+
+    async def housekeeping_task(self):
+        """Runs the slow checks on a fixed period."""
+        next_tick = self.loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - self.loop.time()))
+            if not self.W.error: # set by the heartbeat thread, no need to wait for the locker lock
+                await self.call(self.on_tick)
+            if self.W.error:
+                self.stop.set()
+                return
+
+    def on_counter(self):
+        """Checks for bucket jumps on a fresh counter reading and fixes them if enabled."""
+        V = self.snapshot()
+        self.L.check_jump(V)
+        if V['fix_bucket'] and self.L.buckets != 0 and V['enable']:
+            self.P.write('ok', 0)
+            self.P.write('busy', 1)
+            self.L.fix_jump(V) # flushes busy first
+        for k, x in [('busy', 0), ('bucket_error', self.L.buckets), ('unfixed_error', self.L.bucket_error), ('ok', 1)]:
+            self.P.write(k, x) # only sent if changed
+
+    def on_target(self):
+        """Applies a new target time."""
+        V = self.snapshot()
+        self.L.set_time(V)
+        self.L.move_time_delay(V)
+
+    def on_tick(self):
+        """Watchdog, locker status, calibration requests and degrees sync."""
+        loop_start = time.time()
+        self.W.check()
+        if self.W.error:
+            return
+        keys = self.P.reload_config() # edits of the locker config file apply between handler calls
+        if keys:
+            self.L.configure(keys)
+            self.P.E.write_error('Config reloaded')
+        if self.P.config_problems:
+            self.P.E.write_error('Config rejected')
+        V = self.snapshot()
+        self.L.locker_status(V)
+        self.laser_ok = self.L.laser_ok
+        if not self.laser_ok:
+            self.P.E.write_error(self.L.message)
+            self.P.write('busy', 0)
+            self.P.write('ok', 0)
+            return
+        self.flags = V
+        if V['calibrate']:
+            self.calibrating = True
+            self.P.E.write_error('calibration requested - starting')
+            self.P.write('ok', 0)
+            self.P.write('busy', 1)
+            self.P.flush()
+            self.L.calibrate(V)
+            self.P.put('calibrate', 0)
+            self.P.E.write_error(' calibration done')
+            self.calibrating = False
+            return
+        if time.time() - self.counter_seen > self.counter_timeout: # no counter events, check_jump reports the missing readings
+            self.L.check_jump(V)
+        if V['enable']:
+            if self.P.use_dither:
+                self.L.set_time(V) # dither needs a fresh random step every cycle
+            self.L.move_time_delay(V) # counter may have caught up with the last move
+        self.D.run(V)
+        if loop_start - self.saved >= self.P.task_periods.get('checkpoint', 5.0):
+            self.saver.save(self.L.state(V))
+            self.saved = loop_start
+        self.P.write('loop_time', time.time() - loop_start)
+        supervisor.ready() # first full tick, for the restart latency
+
+
+def run():
+    """Starts the engine for the hutch given on the command line."""
+    if len(sys.argv) < 2:
+        print('usage: python femto_async.py <HUTCH>')
+        return
+    E = locker_engine(sys.argv[1])
+    if not E.OK:
+        sys.exit(1) # not a clean finish, the supervisor restarts it
+    E.run()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,98 @@
+#femto_host.py
+""" Runs the lockers for several hutches in one process.
+
+Each hutch gets its own femto.locker_loop (femto_longdelay for XCS, same as
+st.cmd) on its own thread, so a calibration or a slow CA call in one hutch
+doesn't hold up the others. All lockers share the process CA context and a
+pv_pool, so a PV used by more than one locker is connected once.
+
+Every hutch keeps its own watchdog, FS_STATUS and log file. A locker that
+can't connect its PVs is retried on its own without disturbing the others; a
+locker whose watchdog says stop (negative, or another program incrementing
+it) is left stopped. The process exits once every locker has stopped.
+
+Usage: python femto_host.py <HUTCH> [<HUTCH> ...]
+"""
+
+import importlib
+import logging
+import sys
+import threading
+import time
+import channel
+import femto
+import fslog
+
+
+class hutch_filter(logging.Filter):
+    """Passes only log records from one hutch's thread and its helper threads (named '<hutch>:...')."""
+    def __init__(self, name):
+        logging.Filter.__init__(self)
+        self.hutch = name
+
+    def filter(self, record):
+        return record.threadName == self.hutch or record.threadName.startswith(self.hutch + ':')
+
+
+class host():
+    """Starts one locker thread per hutch and waits for them."""
+    def __init__(self, names, retry=10.0):
+        """Takes a list of hutch names and the time in s between setup retries."""
+        self.names = names
+        self.retry = retry
+        self.pool = femto.pv_pool() # connections shared by all lockers
+        self.lockers = dict() # hutch name -> locker_loop, once it is running
+        self.threads = dict() # hutch name -> thread
+
+    def log_files(self):
+        """Sends each hutch's log records to its usual femto.log through one log queue, unless logging is already set up."""
+        if fslog.configured():
+            return
+        handlers = []
+        for name in self.names:
+            handler = fslog.file_handler('/reg/d/iocData/py-fstiming-'+name+'/iocInfo/femto.log')
+            handler.addFilter(hutch_filter(name))
+            handlers.append(handler)
+        fslog.start(handlers)
+
+    def run_locker(self, name):
+        """Takes a hutch name, sets up its locker (retrying until its PVs connect) and runs it until its watchdog stops it."""
+        channel.attach_context() # use the process CA context from this thread
+        F = importlib.import_module('femto_longdelay' if name == 'XCS' else 'femto')
+        while True:
+            try:
+                R = F.locker_loop(name, self.pool)
+            except: # setup problem in this hutch only
+                print(name, sys.exc_info()[0], 'Error occurred at:', femto.date_time())
+                logging.error('Locker setup failed: %s', sys.exc_info()[0])
+                R = None
+            if R is not None and R.OK:
+                break
+            if R is not None and R.W is not None: # watchdog said not to run
+                return
+            print(name, 'PVs not available, retrying in', self.retry, 's')
+            logging.warning('PVs not available, retrying in %s s', self.retry)
+            time.sleep(self.retry)
+        self.lockers[name] = R
+        logging.info('Hutch: %s. Running in femto_host.', name)
+        R.run()
+        del self.lockers[name] # let its PVs go back to the pool
+
+    def run(self):
+        """Starts every locker and waits until all have stopped."""
+        self.log_files()
+        for name in self.names:
+            th = threading.Thread(target=self.run_locker, args=(name,), name=name)
+            th.daemon = True # Ctrl-C ends the process
+            th.start()
+            self.threads[name] = th
+        while any(th.is_alive() for th in self.threads.values()):
+            time.sleep(1.0)
+        print('All lockers stopped at', femto.date_time())
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: python femto_host.py <HUTCH> [<HUTCH> ...]')
+    else:
+        host(sys.argv[1:]).run()
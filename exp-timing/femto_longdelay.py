@@ -1,68 +1,92 @@
 
 import time
+import threading
 import math
 import numpy as np
 import watchdog
-from psp.Pv import Pv
+from ring import ring
+import pvconnect
+import pvstats
+import fslog
+import lockerconfig
+import scheduler
+import checkpoint
+import supervisor
+import softioc
+import channel
 import sys
 import random
-import json
 import logging
+import os
+
+class pv_pool():
+    """Shares Pv connections between lockers running in one process."""
+    def __init__(self):
+        self.pvs = dict() # PV name -> Pv
+        self.users = dict() # PV name -> number of PVS objects holding it
+        self.lock = threading.Lock() # lockers start and stop on their own threads
+
+    def get(self, name):
+        """Takes a PV name, returns the shared Pv for it."""
+        with self.lock:
+            if name not in self.pvs:
+                self.pvs[name] = channel.Pv(name)
+                self.users[name] = 0
+            self.users[name] += 1
+            return self.pvs[name]
+
+    def release(self, pv):
+        """Takes a Pv from get(), disconnects it once no locker holds it."""
+        with self.lock:
+            self.users[pv.name] -= 1
+            if self.users[pv.name] > 0:
+                return
+            del self.users[pv.name]
+            del self.pvs[pv.name]
+        pv.disconnect()
+
 
 class PVS():
     """Initializes dictionaries for a particular locker, reads and writes to PVs from that locker."""
-    def __init__(self, nx='NULL'):
-        """Assigns IOC PVs to dictionaries for each locker parameter for the selected laser system."""
+    def __init__(self, nx='NULL', pool=None):
+        """Assigns IOC PVs to dictionaries for each locker parameter for the selected laser system, sharing connections through pool if given."""
+        self.pool = pool
+        self.monitor_ids = dict() # Monitor callback ids, removed again if the Pv is shared
         self.version = 'Watchdog 141126a' #Version string
         self.name = nx # Sets the hutch name
         print(self.name)
-        logging.basicConfig(
-                format='%(asctime)s - %(levelname)s - %(message)s',
-                style='%',
-                datefmt='%Y-%m-%d %H:%M',
-                level=logging.DEBUG,
-                filename=str('/reg/d/iocData/py-fstiming-'+self.name+'/iocInfo/femto.log'),
-                filemode='a',
-            )
+        fslog.setup('/reg/d/iocData/py-fstiming-'+self.name+'/iocInfo/femto.log') # queued, the loop never waits for the file (no-op if logging is set up already)
         logging.info('Hutch: %s. IOC Enabled/Rebooted.', self.name)
-        self.path = '/cds/group/laser/timing/femto-timing/dev/exp-timing/'
+        self.path = os.environ.get('FS_CONFIG_PATH', '/cds/group/laser/timing/femto-timing/dev/exp-timing/') # Overridden to run against a local checkout
         self.config = self.path+self.name+'_locker_config.json' #Sets name of hutch config file
+        self.state_file = os.environ.get('FS_STATE_PATH', '/reg/d/iocData/py-fstiming-'+self.name+'/iocInfo/')+self.name+'_locker_state.json' # Locker state kept for a restart, see checkpoint.py
         namelist = set() # Checks if scripts is configured to run specified locker name
         self.pvlist = dict()  # List of all PVs
-        self.PV_errs = dict() # List of PV connection errors
-        self.err_idx = 0
+        self.optional = set() # PVs the locker can run without, dropped from pvlist if they don't connect
+        self.stats = pvstats.pv_stats() # Rolling PV error counts and latency histograms
+        self.failed = set() # PVs that failed since the last reconnect()
+        self.reads_avoided = 0 # reads skipped because the device state was already known
+        self.pending = dict() # Write-behind values waiting for flush(), latest per PV
+        self.written = dict() # Last value written to each PV
+        self.shared = set(['time', 'deg_Sband', 'busy', 'ok', 'calibrate', 'drift_correction_value']) # Setpoints and handshakes others write too, never skipped for matching self.written
         counter_base = dict()  # Time interval counter names
         freq_counter = dict() # Frequency counter names
         dev_base = dict() # dev_base is a combination of the locker name of the subsequent string in the IOC PV sub-name (i.e. 'VIT' in most of the LCLS-I laser lockers)
         phase_motor = dict() # Phase motor names
-        laser_trigger = dict() # EVR on time trigger PV        
         error_pv_name = dict() # femto.py script error status for each locker   
-        use_drift_correction = dict() # Allows drift correction feature to be turned on/off individually for each locker
-        drift_correction_signal = dict() # Drift correction float value in ps pulled from the time_tool.py script
-        drift_correction_value = dict() # Current drift correction output in ns
-        drift_correction_offset = dict() # Fixed offset in ns applied to the drift_correction_signal value
-        drift_correction_gain = dict() # Multiplier applied to drift_correction_signal. Gain of 0 disables drift correction feedback
-        drift_correction_dir = dict()  # Bool value that is configurable based on the set-up of the timetool stage in a particular hutch 
-        drift_correction_smoothing = dict()  # Smoothing factor that reduces the drift correction step size
-        drift_correction_accum = dict() # Enables/disables drift correction accumulation (integration term)
-        bucket_correction_delay = dict() # Tracks the amount of time between bucket jump detection and correction
         move_delay = dict()
         script_loop_time = dict() # Tracks the cycle time of one main program loop
-        for n in range(0,20):
-            use_drift_correction[n] = False  # Turn off except where needed
-        use_dither = dict() # Used to allow fast dither of timing
-        dither_level = dict()  # Amount of dither in ps
-        for n in range(0,20):
-            use_dither[n] = False  # Turn off except where needed
         version_pv_name = dict()
         timeout = 1.0  # Default timeout for connecting to PVs
 
-        try:
-            with open(self.config, 'r') as file:
-                self.locker_config = json.load(file) # Load parameters of current locker from json file
-        except json.JSONDecodeError as e: # Check that json file syntax is correct
-            print('Invalid JSON syntax: '+e)
-            logging.error('Invalid JSON syntax: %s', e)
+        self.locker_config, problems = lockerconfig.read(self.config) # Load parameters of current locker from json file, checked against the schema
+        if problems:
+            print('Bad locker config', self.config+':', '; '.join(problems))
+            logging.error('Bad locker config %s: %s', self.config, '; '.join(problems))
+            self.OK = 0
+            return
+        self.watch = lockerconfig.watch(self.config) # notices edits, see reload_config()
+        self.config_problems = [] # why the last edit of the config file was rejected
 
         # Pull locker configuration data from .json file
         nm = str(self.locker_config['nm'])
@@ -74,20 +98,12 @@ class PVS():
         phase_motor[nm] = base+'MMS:PH' 
         error_pv_name[nm] = dev_base[nm]+'FS_STATUS' 
         version_pv_name[nm] = dev_base[nm]+'FS_WATCHDOG.DESC'
-        laser_trigger[nm] = str(self.locker_config['laser_trigger'])
-        drift_correction_signal[nm] = dev_base[nm]+'DRIFT_CORRECT_SIG'
-        drift_correction_value[nm] = dev_base[nm]+'DRIFT_CORRECT_VAL'
-        drift_correction_offset[nm] = dev_base[nm]+'DRIFT_CORRECT_OFF'
-        drift_correction_gain[nm] = dev_base[nm]+'DRIFT_CORRECT_GAIN'
-        drift_correction_dir[nm] = self.locker_config['drift_correction_dir']
-        drift_correction_smoothing[nm] = dev_base[nm]+'DRIFT_CORRECT_SMOOTH'
-        drift_correction_accum[nm] = dev_base[nm]+'DRIFT_CORRECT_ACCUM'
         move_delay[nm] = dev_base[nm]+'MOV_TIME_DLY'
         script_loop_time[nm] = dev_base[nm]+'LOOP_TIME'
-        use_drift_correction[nm] = self.locker_config['use_drift_correction']
-        use_dither[nm] = self.locker_config['use_dither']
-        dither_level[nm] = dev_base[nm]+'DITHER'
-        bucket_correction_delay[nm] = str(self.locker_config['bucket_correction_delay'])
+        self.dev_base = dev_base[nm]
+        self.use_cache = self.locker_config.get('use_pv_cache', False) # Serve get() from CA monitors instead of a round trip per read
+        self.soft_ioc = softioc.serve(self.dev_base) if self.locker_config.get('serve_pvs', False) else None # Locker's own records hosted in this process
+        self.params(self.locker_config)
         
         while not (self.name in namelist):
             print(self.name + '  not found, please enter one of the following: ')
@@ -95,142 +111,420 @@ class PVS():
                 print(x)
             self.name = input('Enter system name:')                           
 
-        self.use_drift_correction = use_drift_correction[self.name] # Turns drift correction on/off based on which laser locker is selected
-        if self.use_drift_correction:
-            self.drift_correction_dir = drift_correction_dir[self.name] # Sets drift correction direction based on which laser locker is selected
-        self.use_dither = use_dither[self.name] # Used to allow fast dither of timing
-        if self.use_dither:
-            self.dither_level = dither_level[self.name]                  
 
         # List of other PVs used.
-        self.pvlist['watchdog'] =  Pv(dev_base[self.name]+'FS_WATCHDOG')
-        self.pvlist['oscillator_f'] =  Pv(dev_base[self.name]+'FS_OSC_TGT_FREQ')
-        self.pvlist['time'] =  Pv(dev_base[self.name]+'FS_TGT_TIME')
-        self.pvlist['time_hihi'] =  Pv(dev_base[self.name]+'FS_TGT_TIME.HIHI')
-        self.pvlist['time_lolo'] =  Pv(dev_base[self.name]+'FS_TGT_TIME.LOLO')
-        self.pvlist['calibrate'] =  Pv(dev_base[self.name]+'FS_START_CALIB')
-        self.pvlist['enable'] =  Pv(dev_base[self.name]+'FS_ENABLE_TIME_CTRL')
-        self.pvlist['busy'] =  Pv(dev_base[self.name]+'FS_CTRL_BUSY')
-        self.pvlist['error'] =  Pv(dev_base[self.name]+'FS_TIMING_ERROR')
-        self.pvlist['ok'] =  Pv(dev_base[self.name]+'FS_LASER_OK')
-        self.pvlist['fix_bucket'] =  Pv(dev_base[self.name]+'FS_ENABLE_BUCKET_FIX')   
-        self.pvlist['delay'] =  Pv(dev_base[self.name]+'FS_TRIGGER_DELAY')
-        self.pvlist['offset'] =  Pv(dev_base[self.name]+'FS_TIMING_OFFSET')
-        self.pvlist['enable_trig'] =  Pv(dev_base[self.name]+'FS_ENABLE_TRIGGER')
-        self.pvlist['bucket_error'] =  Pv(dev_base[self.name]+'FS_BUCKET_ERROR')
-        self.pvlist['bucket_counter'] =  Pv(dev_base[self.name]+'FS_CORRECTION_CNT')
-        self.pvlist['deg_Sband'] =  Pv(dev_base[self.name]+'PDES')
-        self.pvlist['deg_offset'] =  Pv(dev_base[self.name]+'POC')
-        self.pvlist['ns_offset'] =  Pv(dev_base[self.name]+'FS_NS_OFFSET')
-        self.pvlist['calib_error'] =  Pv(dev_base[self.name]+'FS_CALIB_ERROR')
-        self.pvlist['counter'] = Pv(counter_base[self.name]+'GetOffsetInvMeasMean')  #time interval counter result, create PV
-        self.pvlist['counter_low'] = Pv(counter_base[self.name]+'GetOffsetInvMeasMean.LOW')        
-        self.pvlist['counter_high'] = Pv(counter_base[self.name]+'GetOffsetInvMeasMean.HIGH')        
-        self.pvlist['counter_jitter'] = Pv(counter_base[self.name]+'GetMeasJitter')
-        self.pvlist['counter_jitter_high'] = Pv(counter_base[self.name]+'GetMeasJitter.HIGH')        
-        self.pvlist['freq_counter'] = Pv(freq_counter[self.name])  # frequency counter readback        
-        self.pvlist['phase_motor'] = Pv(phase_motor[self.name])  # phase control smart motor
-        self.pvlist['phase_motor_dmov'] = Pv(phase_motor[self.name]+'.DMOV')  # motor motion status
-        self.pvlist['phase_motor_rb'] = Pv(phase_motor[self.name]+'.RBV')  # motor readback
-        self.pvlist['freq_sp'] =  Pv(dev_base[self.name]+'FREQ_SP')  # frequency counter setpoint
-        self.pvlist['freq_err'] = Pv(dev_base[self.name]+'FREQ_ERR') # frequency counter error
-        self.pvlist['rf_pwr']= Pv(dev_base[self.name]+'CH1_RF_PWR') # RF power readback
-        self.pvlist['rf_pwr_lolo']= Pv(dev_base[self.name]+'CH1_RF_PWR'+'.LOLO') # RF power readback
-        self.pvlist['rf_pwr_hihi']= Pv(dev_base[self.name]+'CH1_RF_PWR'+'.HIHI') # RF power readback 
-        self.pvlist['diode_pwr'] = Pv(dev_base[self.name]+'CH1_DIODE_PWR')
-        self.pvlist['diode_pwr_lolo'] = Pv(dev_base[self.name]+'CH1_DIODE_PWR'+'.LOLO')
-        self.pvlist['diode_pwr_hihi'] = Pv(dev_base[self.name]+'CH1_DIODE_PWR'+'.HIHI')
-        self.pvlist['laser_trigger'] = Pv(laser_trigger[self.name])
-        self.pvlist['laser_locked'] = Pv(dev_base[self.name]+'PHASE_LOCKED')
-        self.pvlist['lock_enable'] = Pv(dev_base[self.name]+'RF_LOCK_ENABLE')
-        self.pvlist['unfixed_error'] =  Pv(dev_base[self.name]+'FS_UNFIXED_ERROR')
-        self.pvlist['bucket_correction_delay'] = Pv(bucket_correction_delay[self.name])
-        self.pvlist['move_time_delay'] = Pv(move_delay[self.name]) # Delay between when set time is changed and when counter readback changes
-        self.pvlist['loop_time'] = Pv(script_loop_time[self.name]) # Run time of the main program loop 
-        if self.use_drift_correction:
-            self.pvlist['drift_correction_signal'] = Pv(drift_correction_signal[self.name])
-            self.pvlist['drift_correction_value'] = Pv(drift_correction_value[self.name])
-            self.pvlist['drift_correction_offset'] = Pv(drift_correction_offset[self.name])
-            self.pvlist['drift_correction_gain'] =  Pv(drift_correction_gain[self.name])
-            self.pvlist['drift_correction_smoothing'] =  Pv(drift_correction_smoothing[self.name])
-            self.pvlist['drift_correction_accum'] = Pv(drift_correction_accum[self.name])
-        if self.use_dither:
-            self.pvlist['dither_level'] = Pv(dither_level[self.name]) 
+        self.pvlist['watchdog'] =  self.new_pv(dev_base[self.name]+'FS_WATCHDOG')
+        self.pvlist['oscillator_f'] =  self.new_pv(dev_base[self.name]+'FS_OSC_TGT_FREQ')
+        self.pvlist['time'] =  self.new_pv(dev_base[self.name]+'FS_TGT_TIME')
+        self.pvlist['time_hihi'] =  self.new_pv(dev_base[self.name]+'FS_TGT_TIME.HIHI')
+        self.pvlist['time_lolo'] =  self.new_pv(dev_base[self.name]+'FS_TGT_TIME.LOLO')
+        self.pvlist['calibrate'] =  self.new_pv(dev_base[self.name]+'FS_START_CALIB')
+        self.pvlist['enable'] =  self.new_pv(dev_base[self.name]+'FS_ENABLE_TIME_CTRL')
+        self.pvlist['busy'] =  self.new_pv(dev_base[self.name]+'FS_CTRL_BUSY')
+        self.pvlist['error'] =  self.new_pv(dev_base[self.name]+'FS_TIMING_ERROR')
+        self.pvlist['ok'] =  self.new_pv(dev_base[self.name]+'FS_LASER_OK')
+        self.pvlist['fix_bucket'] =  self.new_pv(dev_base[self.name]+'FS_ENABLE_BUCKET_FIX')   
+        self.pvlist['delay'] =  self.new_pv(dev_base[self.name]+'FS_TRIGGER_DELAY')
+        self.pvlist['offset'] =  self.new_pv(dev_base[self.name]+'FS_TIMING_OFFSET')
+        self.pvlist['enable_trig'] =  self.new_pv(dev_base[self.name]+'FS_ENABLE_TRIGGER')
+        self.pvlist['bucket_error'] =  self.new_pv(dev_base[self.name]+'FS_BUCKET_ERROR')
+        self.pvlist['bucket_counter'] =  self.new_pv(dev_base[self.name]+'FS_CORRECTION_CNT')
+        self.pvlist['deg_Sband'] =  self.new_pv(dev_base[self.name]+'PDES')
+        self.pvlist['deg_offset'] =  self.new_pv(dev_base[self.name]+'POC')
+        self.pvlist['ns_offset'] =  self.new_pv(dev_base[self.name]+'FS_NS_OFFSET')
+        self.pvlist['calib_error'] =  self.new_pv(dev_base[self.name]+'FS_CALIB_ERROR')
+        self.pvlist['counter'] = self.new_pv(counter_base[self.name]+'GetOffsetInvMeasMean')  #time interval counter result, create PV
+        self.pvlist['counter_low'] = self.new_pv(counter_base[self.name]+'GetOffsetInvMeasMean.LOW')        
+        self.pvlist['counter_high'] = self.new_pv(counter_base[self.name]+'GetOffsetInvMeasMean.HIGH')        
+        self.pvlist['counter_jitter'] = self.new_pv(counter_base[self.name]+'GetMeasJitter')
+        self.pvlist['counter_jitter_high'] = self.new_pv(counter_base[self.name]+'GetMeasJitter.HIGH')        
+        self.pvlist['freq_counter'] = self.new_pv(freq_counter[self.name])  # frequency counter readback        
+        self.pvlist['phase_motor'] = self.new_pv(phase_motor[self.name])  # phase control smart motor
+        self.pvlist['phase_motor_dmov'] = self.new_pv(phase_motor[self.name]+'.DMOV')  # motor motion status
+        self.pvlist['phase_motor_rb'] = self.new_pv(phase_motor[self.name]+'.RBV')  # motor readback
+        self.pvlist['freq_sp'] =  self.new_pv(dev_base[self.name]+'FREQ_SP')  # frequency counter setpoint
+        self.pvlist['freq_err'] = self.new_pv(dev_base[self.name]+'FREQ_ERR') # frequency counter error
+        self.pvlist['rf_pwr']= self.new_pv(dev_base[self.name]+'CH1_RF_PWR') # RF power readback
+        self.pvlist['rf_pwr_lolo']= self.new_pv(dev_base[self.name]+'CH1_RF_PWR'+'.LOLO') # RF power readback
+        self.pvlist['rf_pwr_hihi']= self.new_pv(dev_base[self.name]+'CH1_RF_PWR'+'.HIHI') # RF power readback 
+        self.pvlist['diode_pwr'] = self.new_pv(dev_base[self.name]+'CH1_DIODE_PWR')
+        self.pvlist['diode_pwr_lolo'] = self.new_pv(dev_base[self.name]+'CH1_DIODE_PWR'+'.LOLO')
+        self.pvlist['diode_pwr_hihi'] = self.new_pv(dev_base[self.name]+'CH1_DIODE_PWR'+'.HIHI')
+        self.pvlist['laser_locked'] = self.new_pv(dev_base[self.name]+'PHASE_LOCKED')
+        self.pvlist['lock_enable'] = self.new_pv(dev_base[self.name]+'RF_LOCK_ENABLE')
+        self.pvlist['unfixed_error'] =  self.new_pv(dev_base[self.name]+'FS_UNFIXED_ERROR')
+        self.pvlist['move_time_delay'] = self.new_pv(move_delay[self.name]) # Delay between when set time is changed and when counter readback changes
+        self.pvlist['loop_time'] = self.new_pv(script_loop_time[self.name]) # Run time of the main program loop 
+        for k, pvname in self.config_pvs(self.locker_config).items(): # trigger, drift correction, dither, offset tracking
+            self.pvlist[k] = self.new_pv(pvname)
+        self.optional.update(['offset_track', 'offset_track_sigma'])
+        self.pvlist['recover_time'] = self.new_pv(dev_base[self.name]+'FS_RECOVER_TIME') # s from a loop error to the next good cycle
+        self.pvlist['pv_errors'] = self.new_pv(dev_base[self.name]+'FS_PV_ERRORS') # PV errors in the last 10 minutes
+        self.pvlist['pv_error_summary'] = self.new_pv(dev_base[self.name]+'FS_PV_ERR_SUMMARY') # worst PVs, short text
+        self.pvlist['status_bits'] = self.new_pv(dev_base[self.name]+'FS_STATUS_BITS') # bitmask of active status conditions
+        self.pvlist['status_count'] = self.new_pv(dev_base[self.name]+'FS_STATUS_CNT') # number of active status conditions
+        self.pvlist['reads_avoided'] = self.new_pv(dev_base[self.name]+'FS_READS_AVOIDED') # device reads skipped since startup
+        self.pvlist['overruns'] = self.new_pv(dev_base[self.name]+'FS_OVERRUNS') # loop task deadline overruns since startup
+        self.pvlist['overrun_summary'] = self.new_pv(dev_base[self.name]+'FS_OVERRUN_SUMMARY') # overruns per task, short text
+        self.pvlist['heartbeat_jitter'] = self.new_pv(dev_base[self.name]+'FS_HEARTBEAT_JITTER') # s, std of the watchdog increment interval
+        self.pvlist['heartbeat_late'] = self.new_pv(dev_base[self.name]+'FS_HEARTBEAT_LATE') # watchdog increments more than 2 periods late
+        self.optional.update(['recover_time', 'pv_errors', 'pv_error_summary', 'status_bits', 'status_count', 'reads_avoided', 'overruns', 'overrun_summary', 'heartbeat_jitter', 'heartbeat_late'])
         self.OK = 1
-        for k, v in self.pvlist.items():  # Now loop over all pvs to initialize
-            try:
-                v.get(ctrl=True, timeout=1.0) # Get data
-            except: 
-                print('Could not open:', v.name, '(', k, '),', 'Error occurred at:', date_time())
-                logging.warning('Could not open: %s (%s), Error occurred at: %s', v.name, k, date_time())
-                self.OK = 0 # Error with setting up PVs, can't run, will exit  
-        self.error_pv = Pv(error_pv_name[self.name]) # Open pv
-        self.version_pv = Pv(version_pv_name[self.name])
+        missing = pvconnect.connect_all(self.pvlist, timeout=1.0) # Connect and read all pvs at once
+        optional = [k for k in missing if k in self.optional]
+        required = [k for k in missing if k not in self.optional]
+        pvconnect.report(optional, self.pvlist, 'Running without optional')
+        pvconnect.report(required, self.pvlist)
+        for k in optional: # can run without them, just don't publish there
+            self.release_pv(k, self.pvlist.pop(k))
+        if required:
+            self.OK = 0 # Error with setting up PVs, can't run, will exit  
+        self.cache = dict() # Latest [value, CA timestamp, severity] for each monitored PV
+        self.sync_reads = set(['phase_motor_dmov', 'phase_motor_rb']) # Always read with a round trip, motion checks can't trust a monitor that may lag the move
+        self.callbacks = dict() # Functions called on every monitor update, by PV name
+        if self.use_cache and self.OK:
+            self.start_monitors()
+        self.error_pv = self.new_pv(error_pv_name[self.name]) # Open pv
+        self.version_pv = self.new_pv(version_pv_name[self.name])
         self.version_pv.put(self.version, timeout = 10.0)
-        self.E = error_output(self.error_pv)
+        self.E = error_output(self.error_pv, self.status_hold)
         self.E.write_error('OK')
 
-    def get(self, name):
-        """Takes a PV name, connects to it, and returns its value."""
-        if self.err_idx == 0: # Start of a new PV error report cycle
-            self.report_start = time.time() # Start time of PV error report
+    def params(self, cfg):
+        """Takes a locker config, sets the parameters read from it that may change while running."""
+        self.use_drift_correction = cfg['use_drift_correction'] # Turns drift correction on/off based on which laser locker is selected
+        self.drift_correction_dir = cfg['drift_correction_dir'] # Sets drift correction direction based on which laser locker is selected
+        self.use_dither = cfg['use_dither'] # Used to allow fast dither of timing
+        self.track_offset = cfg.get('track_offset', False) # Track offset drift from counter residuals between calibrations
+        self.deadband = dict(error=1e-5, unfixed_error=1e-4, offset_track=1e-5, offset_track_sigma=1e-5) # Write-behind changes smaller than this are not sent
+        self.deadband.update(cfg.get('write_deadbands', dict()))
+        self.task_periods = cfg.get('task_periods', dict()) # s, by loop task name, e.g. {"lock": 0.05}, the loop ticks at the shortest
+        self.task_deadlines = cfg.get('task_deadlines', dict()) # s, by loop task name, default the period
+        self.status_hold = cfg.get('status_hold', 2.0) # s a warning stays on the status PV
+        self.state_max_age = cfg.get('state_max_age', 600.0) # s, older saved locker state is not restored
+
+    def config_pvs(self, cfg):
+        """Takes a locker config, returns {name: PV name} for the PVs that depend on it."""
+        pvs = dict()
+        pvs['laser_trigger'] = str(cfg['laser_trigger']) # EVR on time trigger PV
+        pvs['bucket_correction_delay'] = str(cfg['bucket_correction_delay']) # Tracks the amount of time between bucket jump detection and correction
+        if cfg['use_drift_correction']:
+            pvs['drift_correction_signal'] = self.dev_base+'DRIFT_CORRECT_SIG' # Drift correction float value in ps pulled from the time_tool.py script
+            pvs['drift_correction_value'] = self.dev_base+'DRIFT_CORRECT_VAL' # Current drift correction output in ns
+            pvs['drift_correction_offset'] = self.dev_base+'DRIFT_CORRECT_OFF' # Fixed offset in ns applied to the drift_correction_signal value
+            pvs['drift_correction_gain'] = self.dev_base+'DRIFT_CORRECT_GAIN' # Multiplier applied to drift_correction_signal. Gain of 0 disables drift correction feedback
+            pvs['drift_correction_smoothing'] = self.dev_base+'DRIFT_CORRECT_SMOOTH' # Smoothing factor that reduces the drift correction step size
+            pvs['drift_correction_accum'] = self.dev_base+'DRIFT_CORRECT_ACCUM' # Enables/disables drift correction accumulation (integration term)
+        if cfg['use_dither']:
+            pvs['dither_level'] = self.dev_base+'DITHER' # Amount of dither in ps
+        if cfg.get('track_offset', False):
+            pvs['offset_track'] = self.dev_base+'FS_OFFSET_TRACK' # tracked offset, ns
+            pvs['offset_track_sigma'] = self.dev_base+'FS_OFFSET_TRACK_SIGMA' # its uncertainty, ns
+        return pvs
+
+    def apply_config(self, cfg):
+        """Takes a checked locker config, connects the PVs it adds, drops the ones it removes and swaps in its parameters.
+        Returns a list of problems, nothing is changed if there are any."""
+        restart = [k for k in lockerconfig.changed(self.locker_config, cfg) if k in lockerconfig.restart_keys]
+        if restart:
+            return [k+' changed, needs a restart' for k in restart]
+        old = self.config_pvs(self.locker_config)
+        new = self.config_pvs(cfg)
+        add = dict((k, self.new_pv(pvname)) for k, pvname in new.items() if old.get(k) != pvname)
+        missing = pvconnect.connect_all(add, timeout=1.0) # only the new ones
+        required = [k for k in missing if k not in self.optional]
+        if required:
+            problems = ['cannot connect ' + ', '.join(add[k].name for k in required)]
+            for k, v in add.items():
+                self.release_pv(k, v)
+            return problems
+        for k, pvname in old.items():
+            if new.get(k) != pvname and k in self.pvlist: # removed or renamed
+                self.release_pv(k, self.pvlist.pop(k))
+                for d in [self.cache, self.pending, self.written]:
+                    d.pop(k, None)
+        for k, v in add.items():
+            if k in missing: # optional, run without it
+                self.release_pv(k, v)
+            else:
+                self.pvlist[k] = v
+        if self.use_cache:
+            self.start_monitors([k for k in add if k in self.pvlist])
+        self.locker_config = cfg
+        self.params(cfg)
+        self.E.hold = self.status_hold
+        return []
+
+    def reload_config(self):
+        """Applies the config file if it was edited since the last call, returns the keys that changed (empty if none or rejected).
+        Problems with a rejected edit are kept in config_problems until the file is fixed."""
+        if not self.watch.changed():
+            return []
+        cfg, problems = lockerconfig.read(self.config)
+        keys = lockerconfig.changed(self.locker_config, cfg) if cfg is not None else []
+        if not problems and keys:
+            problems = self.apply_config(cfg)
+        self.config_problems = problems
+        if problems:
+            print('Locker config edit rejected:', '; '.join(problems), 'Occurred at:', date_time())
+            logging.error('Locker config edit rejected: %s', '; '.join(problems))
+            return []
+        if keys:
+            print('Locker config reloaded, changed:', ', '.join(keys), 'at', date_time())
+            logging.info('Locker config reloaded, changed: %s', ', '.join(keys))
+        return keys
+
+    def new_pv(self, pvname):
+        """Takes a PV name, returns a Pv for it, from the pool when lockers share one, or the local record if this process serves it."""
+        if self.soft_ioc is not None and pvname in self.soft_ioc:
+            return self.soft_ioc.pv(pvname)
+        if self.pool is None:
+            return channel.Pv(pvname)
+        return self.pool.get(pvname)
+
+    def release_pv(self, k, v):
+        """Takes a pvlist key (or None) and its Pv, drops this locker's use of it."""
+        if self.pool is None or getattr(v, 'served', False):
+            v.disconnect()
+            return
+        if k in self.monitor_ids: # other lockers keep the Pv, stop feeding our cache
+            try:
+                v.del_monitor_callback(self.monitor_ids.pop(k))
+            except:
+                pass
+        self.pool.release(v)
+
+    def get(self, name, sync=False):
+        """Takes a PV name, returns its value. Served from the monitor cache when enabled, unless sync is set."""
+        if self.use_cache and not sync and name in self.cache and name not in self.sync_reads:
+            return self.cache[name][0]
+        start = time.time()
         try:
             self.pvlist[name].get(ctrl=True, timeout=10.0)
+            self.stats.record(name, 'read', True, time.time() - start)
             return self.pvlist[name].value                      
         except:
-            self.PV_errs[self.err_idx] = str(name)+' - read' # Store PV name that caused error 
-            self.err_idx += 1 # Increase PV error counter
+            self.PV_err(name, 'read')
             return 0 
         finally:
             self.PV_err_report()
   
+    def available(self, names):
+        """Takes a list of PV names, returns the ones that are connected (optional PVs may be missing)."""
+        return [name for name in names if name in self.pvlist]
+
     def get_last(self, name):
         """Takes a PV name and returns its last value, without connecting to the PV."""
         return self.pvlist[name].value                
+
+    def get_cached(self, name):
+        """Takes a PV name, returns [value, CA timestamp, severity] from the monitor cache, or None if it is not monitored."""
+        return self.cache.get(name)
+
+    def start_monitors(self, names=None):
+        """Takes PV names (default all of pvlist), subscribes to their CA monitors and seeds the cache with the values already read."""
+        for k in (self.pvlist if names is None else names):
+            v = self.pvlist[k]
+            self.cache[k] = [v.value, 0, 0]
+            try:
+                self.monitor_ids[k] = v.add_monitor_callback(self.monitor_callback(k))
+                if not getattr(v, 'ismonitored', False): # a shared Pv may already be monitored
+                    v.monitor(ctrl=False) # time type, so updates carry timestamp and severity
+            except:
+                del self.cache[k] # fall back to synchronous reads for this PV
+                print('Could not monitor:', v.name, '(', k, '),', 'Error occurred at:', date_time())
+                logging.warning('Could not monitor: %s (%s), Error occurred at: %s', v.name, k, date_time())
+
+    def monitor_callback(self, name):
+        """Takes a PV name, returns the monitor callback that refreshes its cache entry."""
+        pv = self.pvlist[name]
+        def callback(e=None):
+            if e is None:
+                self.cache[name] = [pv.value, pv.secs + 1e-9 * pv.nsec, pv.severity]
+                for fn in list(self.callbacks.get(name, [])): # copy, callers add and remove from other threads
+                    fn(pv.value)
+        return callback
+
+    def add_callback(self, name, fn):
+        """Takes a PV name and a function, calls the function with the new value on every monitor update of that PV."""
+        self.callbacks.setdefault(name, []).append(fn)
+
+    def remove_callback(self, name, fn):
+        """Takes a PV name and a function added with add_callback, stops calling it."""
+        try:
+            self.callbacks.get(name, []).remove(fn)
+        except ValueError:
+            pass
                 
     def put(self, name, x):
         """Takes a PV name, connects to it, and then writes a value to it."""
-        if self.err_idx == 0: # Start of a new PV error report cycle
-            self.report_start = time.time() # Start time of PV error report
+        start = time.time()
         try:
             self.pvlist[name].put(x, timeout = 10.0) # long timeout           
+            self.stats.record(name, 'write', True, time.time() - start)
+            self.written[name] = x
+            self.pending.pop(name, None) # supersedes a queued write
+            if name in self.cache:
+                self.cache[name][0] = x # write through so the next get sees the new value before the monitor echoes it
         except:
-            self.PV_errs[self.err_idx] = str(name)+' - write' # Store PV name that caused error 
-            self.err_idx += 1 # Increase PV error counter
+            self.PV_err(name, 'write')
         finally:
             self.PV_err_report()
+
+    def get_many(self, names):
+        """Takes a list of PV names, returns a dict of their values. Uncached PVs are requested together and each read is waited for under one deadline."""
+        values = dict()
+        pending = []
+        for name in names:
+            if self.use_cache and name in self.cache and name not in self.sync_reads:
+                values[name] = self.cache[name][0]
+            elif getattr(self.pvlist[name], 'served', False): # local record, no round trip
+                values[name] = self.pvlist[name].value
+            else:
+                pending.append(name)
+        if not pending:
+            return values
+        start = time.time()
+        failed = channel.get_all(dict((name, self.pvlist[name]) for name in pending), 10.0) # one batch, waits for every read to complete
+        dt = time.time() - start
+        for name in pending:
+            if name in failed: # retry on its own, so only the PVs that failed are counted
+                values[name] = self.get(name, sync=True)
+            else:
+                values[name] = self.pvlist[name].value
+                self.stats.record(name, 'read', True, dt)
+        self.PV_err_report()
+        return values
+
+    def put_many(self, pvs):
+        """Takes a dict of PV names and values, writes them all and flushes once."""
+        start = time.time()
+        sent = dict()
+        for name, x in pvs.items():
+            if getattr(self.pvlist[name], 'served', False): # local record, a memory update
+                self.put(name, x)
+            else:
+                sent[name] = x
+        if not sent: # all local
+            return
+        failed = channel.put_all(dict((name, self.pvlist[name]) for name in sent), sent, 10.0) # one batch, waits for every write to complete
+        dt = time.time() - start
+        for name, x in sent.items():
+            if name in failed: # retry on its own, so only the PVs that failed are counted
+                self.put(name, x)
+                continue
+            self.stats.record(name, 'write', True, dt)
+            self.written[name] = x
+            self.pending.pop(name, None)
+            if name in self.cache:
+                self.cache[name][0] = x
+        self.PV_err_report()
+
+    def reconnect(self):
+        """Reconnects the PVs that failed or dropped since the last call, returns the names that still don't respond."""
+        names = set(self.failed) | set(k for k, v in self.pvlist.items() if not getattr(v, 'isconnected', True))
+        self.failed = set()
+        bad = []
+        for k in names:
+            if k not in self.pvlist:
+                continue
+            v = self.pvlist[k]
+            try:
+                if not getattr(v, 'isconnected', True):
+                    v.connect(timeout=1.0)
+                v.get(ctrl=True, timeout=1.0)
+                if k in self.cache:
+                    self.cache[k][0] = v.value
+            except:
+                bad.append(k)
+                self.failed.add(k) # try again next time
+        return bad
+
+    def write(self, name, x):
+        """Takes a PV name and value, queues the write for flush(). Later writes to the same PV in the cycle replace it."""
+        self.pending[name] = x
+
+    def changed(self, name, x):
+        """Takes a PV name and value, returns True if it differs from the PV's current value by more than the PV's deadband, or the PV is shared and not monitored."""
+        if name in self.cache:
+            last = self.cache[name][0] # monitor shows changes made by anyone else too
+        elif name in self.shared:
+            return True # someone may have changed it since we wrote it
+        else:
+            last = self.written.get(name) # only the locker writes it
+        if last is None:
+            return True
+        try:
+            return abs(x - last) > self.deadband.get(name, 0)
+        except TypeError: # strings
+            return x != last
+
+    def flush(self):
+        """Sends the queued writes and status text that changed, in one batch."""
+        self.E.flush()
+        for k, x in [('status_bits', self.E.bits), ('status_count', self.E.count)]:
+            if k in self.pvlist:
+                self.pending[k] = x
+        pvs = dict((k, x) for k, x in self.pending.items() if self.changed(k, x))
+        self.pending = dict()
+        if pvs:
+            self.put_many(pvs)
+        else:
+            channel.flush_io() # status text, if any
+
+    def PV_err(self, name, op):
+        """Takes a PV name and operation ('read' or 'write'), records a PV error for the periodic report."""
+        self.stats.record(name, op, ok=False)
+        self.failed.add(name)
                 
     def PV_err_report(self):
-        self.curr_time = time.time()
-        self.diff = self.curr_time - self.report_start # Compare current time to time at start of report
-        try:
-            if self.diff >= 600: # Have we reached 10 minutes?
-                self.num_errs = len(self.PV_errs) # Total number of errors that have occurred
-                self.PV_err_list = self.PV_errs.values()
-                if self.num_errs >= 1: # If an error has occurred, print report
-                    print('Current time:', date_time(), 'In the past 10 minutes,', self.num_errs, 'PV connection errors have occurred.')
-                    logging.warning('In the past 10 minutes, %s PV connection errors have occurred.', self.num_errs)
-                    print('Error report: ')
-                    logging.warning('Error report: ')
-                    self.PV_err_short = set(self.PV_err_list) # List each PV only once
-                    for n in self.PV_err_short: # Loop over all unique PV errors
-                        self.report_num = self.PV_err_list.count(n) # Calculate the number of times current PV error occurred
-                        print('PV Name/Error Type:', n, 'Connection Errors:', self.report_num)
-                        logging.warning('PV Name/Error Type: %s Connection Errors: %s', n, self.report_num)
-                self.err_idx = 0 # Restart PV error counter regardless of whether error has occurred
-        except:
-            self.err_idx = 0 #If loop breaks, restart the counter so we don't spam the log
+        """Logs the PV errors and slowest PVs of the last 10 minutes, once every 10 minutes."""
+        self.stats.report()
+
+    def publish_stats(self, period=10.0):
+        """Writes the rolling PV error count, a short summary and the reads avoided to their optional PVs, at most once per period in s."""
+        names = self.available(['pv_errors', 'pv_error_summary', 'reads_avoided'])
+        if not names or not self.stats.due(period):
             return
+        total, txt = self.stats.summary()
+        values = dict(pv_errors=total, pv_error_summary=txt, reads_avoided=self.reads_avoided)
+        for k in names:
+            self.write(k, values[k])
 
     def __del__ (self):
         """Disconnects from all IOC PVs."""
-        for v in self.pvlist.values():
-            v.disconnect()  
-        self.error_pv.disconnect()    
+        for k, v in self.pvlist.items():
+            self.release_pv(k, v)
+        if hasattr(self, 'error_pv'): # not made if the config was bad
+            self.release_pv(None, self.error_pv)
         print('Closed all PV connections at', date_time())
         logging.warning('Closed all PV connections.')
 
 
+class snapshot():
+    """Values of the locker's input PVs, read together once at the start of a cycle so every step sees the same ones."""
+    def __init__(self, P, names):
+        """Takes locker PVs and the input PV names, reads them in one batch (no I/O for PVs in the monitor cache)."""
+        self.t = time.time() # when the snapshot was taken
+        self.values = P.get_many(names)
+        self.stamps = dict()
+        for name in names:
+            c = P.get_cached(name)
+            self.stamps[name] = c[1] if c is not None and c[1] else self.t # CA timestamp, or the read time if not monitored
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __setitem__(self, name, x):
+        """Takes a PV name and a value the locker just wrote to it, later steps in the cycle see the new value."""
+        self.values[name] = x
+        self.stamps[name] = time.time()
+
+    def stamp(self, name):
+        """Takes a PV name, returns the CA timestamp of its value in s."""
+        return self.stamps[name]
+
+
 class locker():
     """Sets up locker parameters, performs calibrations, sets laser time, and corrects for bucket jumps."""
     def __init__(self, P, W):
@@ -254,12 +548,82 @@ class locker():
          self.drift_last = 0 # used for drift correction when activated
          self.drift_initialized = False # will be true after first cycle
          self.C = time_interval_counter(self.P) # creates a time interval counter object
+         self.M = phase_motor(self.P) # kept for the life of the locker, tracks where it sent the motor
+         self.T = trigger(self.P)
+         self.pc_diff = 0 # phase motor move still to make, ns
+         self.pc_out = self.M.position # last phase motor target, ns
+         self.buckets = 0 # bucket jumps seen by the last check_jump
+         self.bucket_error = 0
          self.move_flag = 0
          self.bucket_flag = 0
          self.stale_cnt = 0 # Counter to determine if TIC is updating
+         self.calibration = None # time, error and good points of the last calibration
+         self.status_inputs = ['rf_pwr', 'rf_pwr_hihi', 'rf_pwr_lolo', 'diode_pwr', 'diode_pwr_hihi', 'diode_pwr_lolo', 'freq_sp', 'oscillator_f', 'laser_locked'] # read by locker_status
+         self.configure()
+
+    def configure(self, keys=None):
+        """Takes the locker config keys that changed (None at startup), sets up the parts of the locker that depend on them."""
+        if keys is not None and 'counter_window' in keys:
+            self.C = time_interval_counter(self.P) # starts a new window of readings
+        if keys is None or [k for k in keys if k == 'track_offset' or k.startswith('offset_track')]:
+            self.tracker = offset_tracker(self.P, self.locking_f) if self.P.track_offset else None # follows offset drift between calibrations
+        if keys is not None and 'use_drift_correction' in keys:
+            self.drift_initialized = False # start again from the current signal
+        self.inputs = ['time', 'time_hihi', 'time_lolo', 'delay', 'offset', 'laser_trigger', 'enable_trig', 'phase_motor'] # read by check_jump, set_time and move_time_delay
+        if self.P.use_drift_correction:
+            self.inputs += ['drift_correction_signal', 'drift_correction_offset', 'drift_correction_gain', 'drift_correction_smoothing', 'drift_correction_value', 'drift_correction_accum']
+        if self.P.use_dither:
+            self.inputs += ['dither_level']
+
+    def state(self, V):
+        """Takes the cycle's snapshot, returns what the locker has learned so far as a dict for the checkpoint file."""
+        s = dict(name=self.P.name, dev_base=self.P.dev_base, delay=self.d['delay'], offset=self.d['offset'],
+                 time=V['time'], laser_trigger=V['laser_trigger'], calibration=self.calibration)
+        s['counter'] = self.C.rt.recent() # s, oldest first
+        s['jitter'] = self.C.rj.recent()
+        for k in ['stale_cnt', 'move_start', 'drift_initialized', 'drift_last', 'dc_last']:
+            if hasattr(self, k): # some are only set once used
+                s[k] = getattr(self, k)
+        if self.tracker is not None:
+            T = self.tracker
+            s['tracker'] = dict(e=T.e, var=T.var, offset=T.offset, last=T.last, rejected=T.rejected)
+        return s
+
+    def resume(self, s, V):
+        """Takes a saved locker state and a snapshot of the inputs, restores the parts that still match the PVs, returns their names."""
+        if s.get('name') != self.P.name or s.get('dev_base') != self.P.dev_base:
+            return []
+        restored = []
+        if abs(s['delay'] - self.d['delay']) > 1e-9 or abs(s['offset'] - self.d['offset']) > 1e-9:
+            return restored # calibrated since, nothing saved applies
+        self.calibration = s['calibration']
+        restored.append('calibration')
+        if self.tracker is not None and 'tracker' in s:
+            for k, x in s['tracker'].items():
+                setattr(self.tracker, k, x)
+            restored.append('offset tracker')
+        saved = np.array(s['counter'])
+        now = self.C.rt.get_last_element() # read when the counter object was made
+        if s['time'] == V['time'] and s['laser_trigger'] == V['laser_trigger'] and len(saved):
+            spread = self.C.scale * (saved.max() - saved.min())
+            if abs(self.C.scale * (now - np.median(saved))) < max(self.max_jump_error, spread): # no jump or move while down
+                self.C.load(s['counter'], s['jitter'])
+                self.stale_cnt = s['stale_cnt']
+                self.move_start = s['move_start'] # no 10 s hold if the target hasn't moved
+                restored.append('counter readings')
+        if self.P.use_drift_correction and s.get('drift_initialized'):
+            if getattr(self.P.pvlist['drift_correction_value'], 'served', False): # started empty with this process, nobody could reset it
+                self.P.put('drift_correction_value', s['drift_last'])
+                V['drift_correction_value'] = s['drift_last']
+            if abs(V['drift_correction_value'] - s['drift_last']) < 1e-12: # accumulator not reset while down
+                self.drift_last = s['drift_last']
+                self.dc_last = s['dc_last']
+                self.drift_initialized = True
+                restored.append('drift correction')
+        return restored
 
-    def locker_status(self):
-        """Checks if core locker parameters are within optimal range and updates 'OK' flags accordingly."""
+    def locker_status(self, V):
+        """Takes the cycle's snapshot, checks if core locker parameters are within optimal range and updates 'OK' flags accordingly."""
         self.laser_ok = 1 # list of various failure modes
         self.rf_ok = 1
         self.diode_ok = 1
@@ -267,100 +631,93 @@ class locker():
         self.setpoint_ok = 1
         self.lock_ok = 1
         self.message = 'OK' # output error message, OK means no trouble found    
-        rfpwr = self.P.get('rf_pwr')  # check RF level
-        rfpwrhihi = self.P.get('rf_pwr_hihi')
-        rfpwrlolo = self.P.get('rf_pwr_lolo')
-        if (rfpwr > rfpwrhihi) | (rfpwr < rfpwrlolo):
+        if (V['rf_pwr'] > V['rf_pwr_hihi']) | (V['rf_pwr'] < V['rf_pwr_lolo']): # check RF level
             self.message = 'RF power out of range'
+            self.P.E.write_error(self.message) # raise every failure, not just the last
             self.laser_ok = 0
             self.rf_ok = 0
-        dpwr = self.P.get('diode_pwr') # check diode level
-        dpwrhihi = self.P.get('diode_pwr_hihi')
-        dpwrlolo = self.P.get('diode_pwr_lolo')
-        if (dpwr > dpwrhihi) | (dpwr < dpwrlolo):
+        if (V['diode_pwr'] > V['diode_pwr_hihi']) | (V['diode_pwr'] < V['diode_pwr_lolo']): # check diode level
             self.message = 'Diode power out of range'
+            self.P.E.write_error(self.message) # raise every failure, not just the last
             self.laser_ok = 0
             self.rf_diode_ok = 0
-        if abs(self.P.get('freq_sp') - self.P.get('oscillator_f')) > self.max_frequency_error:  # oscillator set point wrong
+        if abs(V['freq_sp'] - V['oscillator_f']) > self.max_frequency_error:  # oscillator set point wrong
             self.laser_ok = 0
             self.frequency_ok = 0
             self.frequency_ok = 0
             self.message = 'Frequency set point out of range'
-        if not self.P.get('laser_locked'):
+            self.P.E.write_error(self.message)
+        if not V['laser_locked']:
             self.message = 'Laser not indicating lock'
+            self.P.E.write_error(self.message) # raise every failure, not just the last
             self.lock_ok = 0
             self.laser_ok = 0
 
-    def calibrate(self):
-        """Performs a linear sweep of phase motor range, sets the delay and offset values to minimize counter time error."""
-        M = phase_motor(self.P)  # creates a phase motor control object (PVs were initialized earlier)
-        T = trigger(self.P)  # trigger class
-        ns = 10000 # number of different times to try for fit - INEFFICIENT - should do Newton's method but too lazy
+    def calibrate(self, V):
+        """Takes the cycle's snapshot, performs a linear sweep of phase motor range, sets the delay and offset values to minimize counter time error."""
+        M = self.M
         self.P.put('busy', 1) # set busy flag
         tctrl = np.linspace(0, self.calib_range, self.calib_points) # control values to use
-        tout = np.array([]) # array to hold measured time data
-        counter_good = np.array([]) # array to hold array of errors
-        t_trig = T.get_ns() # trigger time in nanoseconds
-        M.move(0)  # move to zero to start 
-        M.wait_for_stop()
-        for x in tctrl:  #loop over input array 
+        tout = np.zeros(self.calib_points) # array to hold measured time data
+        counter_good = np.zeros(self.calib_points) # array to hold array of errors
+        jitter = np.zeros(self.calib_points) # counter jitter at each point, used to weight the fit
+        t_trig = V['laser_trigger'] # trigger time in nanoseconds
+        M.move(0)  # move to zero to start, returns once in position
+        for n, x in enumerate(tctrl):  #loop over input array 
             self.W.check() # check watchdog
             if self.W.error:
                 return    
             if not self.P.get('calibrate'):
                 return   # canceled calibration
-            M.move(x)  # move motor
-            M.wait_for_stop()
-            time.sleep(2)  #Don't know why this is needed
+            self.P.flush() # status and busy show while calibrating
+            M.move(x)  # move motor, returns once in position
+            self.C.wait_for_update() # counter averages over time, wait for readings taken after the move
             t_tmp = 0 # to check if we ever get a good reading
-            for n in range(0, 25): # try to see if we can get a good reading
+            for k in range(0, 25): # try to see if we can get a good reading
                  t_tmp = self.C.get_time()  # read time
                  if t_tmp != 0: # have a new reading
                      break # break out of loop
-            tout = np.append(tout, t_tmp) # read timing and put in array
-            counter_good = np.append(counter_good, self.C.good) # will use to filter data
-            if not self.C.good:
+            tout[n] = t_tmp # read timing and put in array
+            counter_good[n] = self.C.good # will use to filter data
+            if self.C.good:
+                jitter[n] = self.C.rj.get_last_element() * self.C.scale # jitter of this reading in ns
+            else:
                 print('Bad counter data. Occurred at:', date_time())
                 logging.warning('Bad counter data.')
                 self.P.E.write_error('Timer error, bad data - continuing to calibrate' ) # just for testing
-        M.move(tctrl[0])  # return to original position    
+        returning = M.move(tctrl[0], wait=False)  # return to original position while the fit runs
         minv = min(tout[np.nonzero(counter_good)])+ self.delay_offset
         period = 1/self.laser_f # just defining things needed in sawtooth -  UGLY
-        delay = minv - t_trig # More code cleanup needed in the future.
-        err = np.array([]) # will hold array of errors
-        offset = np.linspace(0, period, ns)  # array of offsets to try
-        for x in offset:  # Tries different offsets to see what works
-            S = sawtooth(tctrl, t_trig, delay, x, period) # Sawtooth simulation
-            err = np.append(err, sum(counter_good*S.r * (S.t - tout)**2))  # Total error
-        idx = np.argmin(err) # Index of minimum error
-        S = sawtooth(tctrl, t_trig, delay, offset[idx], period)
-        self.P.put('calib_error', np.sqrt(err[idx]/ self.calib_points))
-        self.d['delay'] = delay
-        self.d['offset'] = offset[idx]
-        self.P.put('delay', delay)
-        self.P.put('offset', offset[idx])
-        M.wait_for_stop() # wait for motor to stop moving before exit
+        F = sawtooth_fit(tctrl, tout, counter_good, jitter, t_trig, minv - t_trig, period) # joint delay / offset fit
+        self.P.put('calib_error', F.error)
+        self.calibration = dict(t=time.time(), error=F.error, points=int(np.sum(counter_good)))
+        self.d['delay'] = F.delay
+        self.d['offset'] = F.offset
+        self.P.put('delay', F.delay)
+        self.P.put('offset', F.offset)
+        V['delay'] = F.delay
+        V['offset'] = F.offset
+        returning.wait() # wait for motor to stop moving before exit
         self.P.put('busy', 0)        
         
-    def set_time(self):
-        """Takes user-entered target time and sets trigger time and phase motor position accordingly."""
-        t = self.P.get('time')
+    def set_time(self, V):
+        """Takes the cycle's snapshot, sets trigger time and phase motor position for the user-entered target time."""
+        t = V['time']
         if math.isnan(t):
             self.P.E.write_error('desired time is NaN')
             return
         if t < self.min_time or t > self.max_time:
             self.P.E.write_error('need to move TIC trigger')
             return
-        t_high = self.P.get('time_hihi')
-        t_low = self.P.get('time_lolo')
+        t_high = V['time_hihi']
+        t_low = V['time_lolo']
         if t > t_high:
             t = t_high
             self.P.E.write_error('TGT bigger than time_hihi')
         if t < t_low:
             t = t_low
             self.P.E.write_error('TGT smaller than time_lolo')
-        T = trigger(self.P) # set up trigger
-        M = phase_motor(self.P)
+        M = self.M
         laser_t = t - self.d['offset']  # Apply offset to trigger time
         nlaser = np.floor(laser_t * self.laser_f) 
         pc = t - (self.d['offset'] + nlaser / self.laser_f) 
@@ -370,13 +727,13 @@ class locker():
         if trig < 9277.31:
             trig = 8.3333e+06 + (trig-9277.31)
         if self.P.use_drift_correction:
-            dc = self.P.get('drift_correction_signal') / 1000; # readback is in ps, but drift correction is ns, need to convert
-            do = self.P.get('drift_correction_offset') 
-            dg = self.P.get('drift_correction_gain')
+            dc = V['drift_correction_signal'] / 1000; # readback is in ps, but drift correction is ns, need to convert
+            do = V['drift_correction_offset']
+            dg = V['drift_correction_gain']
             dd = self.P.drift_correction_dir
-            ds = self.P.get('drift_correction_smoothing')
-            self.drift_last = self.P.get('drift_correction_value')
-            accum = self.P.get('drift_correction_accum')
+            ds = V['drift_correction_smoothing']
+            self.drift_last = V['drift_correction_value']
+            accum = V['drift_correction_accum']
             # modified to not use drift_correction_offset or drift_correction_multiplier:
             de = (dc-do)  # (hopefully) fresh pix value from TT script
             if ( self.drift_initialized ):
@@ -386,7 +743,8 @@ class locker():
                         self.drift_last = self.drift_last + (de- self.drift_last) / ds; # smoothing
                         self.drift_last = max(-.001, self.drift_last) # floor at 1 ps
                         self.drift_last = min(.001, self.drift_last)#
-                        self.P.put('drift_correction_value', self.drift_last)
+                        self.P.write('drift_correction_value', self.drift_last)
+                        V['drift_correction_value'] = self.drift_last
                         self.dc_last = dc
             else:
                 self.drift_last = de # initialize to most recent reading
@@ -396,34 +754,34 @@ class locker():
                 self.drift_initialized = True # will average next time (ugly)    
             pc = pc - (dd * dg * self.drift_last); # fix phase control. 
         if self.P.use_dither:
-            dx = self.P.get('dither_level') 
+            dx = V['dither_level']
             pc = pc + (random.random()-0.5)* dx / 1000 # uniformly distributed random. 
 
-        if self.P.get('enable_trig'): # Full routine when trigger can move
-            if T.get_ns() != trig:   # need to move
-                T.set_ns(trig) # sets the trigger
-        self.pc_diff = M.get_position() - pc  # difference between current phase motor and desired time        
+        if V['enable_trig']: # Full routine when trigger can move
+            if V['laser_trigger'] != trig:   # need to move
+                self.T.set_ns(trig) # sets the trigger
+                V['laser_trigger'] = trig
+        self.pc_diff = M.get_position(V) - pc  # difference between current phase motor and desired time        
         if abs(self.pc_diff) > 1e-6:
             M.move(pc) # moves the phase motor
+            V['phase_motor'] = pc / M.scale
             self.move_start = time.time() # Time that set time was changed - used by the move_time_delay() function.
             self.pc_out = pc # For move time delay function 
       
-    def check_jump(self):
-        """Takes the trigger time, phase motor position, and counter time, calculates the number of 3.808 GHz bucket jumps."""
-        T = trigger(self.P) # trigger class
-        M = phase_motor(self.P) # phase motor     
+    def check_jump(self, V):
+        """Takes the cycle's snapshot, compares trigger time, phase motor position and counter time, calculates the number of 3.808 GHz bucket jumps."""
+        M = self.M
         t = self.C.get_time()
         if t > -900000.0:      
-            self.P.put('error', t - self.P.get('time')) # timing error (reads counter)      
-        t_trig = T.get_ns()
-        pc = M.get_position()
-        try:
-            self.d['delay'] = self.P.get('delay')
-            self.d['offset'] = self.P.get('offset')
-        except:
-            print('Problem reading delay and offset pvs. Error occurred at:', date_time())
-            logging.error('Problem reading delay and offset pvs.')
+            self.P.write('error', t - V['time']) # timing error (reads counter)      
+        t_trig = V['laser_trigger']
+        pc = M.get_position(V)
+        self.d['delay'] = V['delay']
+        self.d['offset'] = V['offset']
         S = sawtooth(pc, t_trig, self.d['delay'], self.d['offset'], 1/self.laser_f) # calculate time        
+        t_new = t # this cycle's reading, the tracker wants independent samples
+        if self.C.good:
+            t = self.C.estimate # median of recent readings, one outlier can't fake a jump
         self.terror = t - S.t # error in ns
         self.buckets = round(self.terror * self.locking_f)
         self.bucket_error = self.terror - self.buckets / self.locking_f
@@ -444,12 +802,18 @@ class locker():
         if abs(self.bucket_error) > self.max_jump_error:
             self.buckets = 0
             self.P.E.write_error('Not an integer number of buckets')
+        elif self.P.track_offset and self.C.good and S.r:
+            step = self.tracker.update(self.d['offset'], t_new - S.t, self.C.rj.get_last_element() * self.C.scale)
+            if step != 0: # confident enough to move the offset, set_time follows it
+                self.d['offset'] += step
+                self.P.put('offset', self.d['offset'])
+                V['offset'] = self.d['offset']
         if self.buckets != 0:
             self.detection_t = time.time() # Time bucket jump was detected
         self.P.E.write_error('Laser OK') # Laser is OK
             
-    def fix_jump(self):
-        """Takes exact bucket error is ns, moves the phase motor and updates the offset to correct for it."""
+    def fix_jump(self, V):
+        """Takes the cycle's snapshot and exact bucket error in ns, moves the phase motor and updates the offset to correct for it."""
         if self.buckets == 0:  #no jump to begin with
             self.P.E.write_error('Trying to fix non-existent jump')
             return
@@ -457,45 +821,42 @@ class locker():
             self.P.E.write_error( 'Non-integer bucket error, cant fix')
             return
         self.P.E.write_error( 'Fixing Jump')
-        M = phase_motor(self.P) #phase control motor
-        M.wait_for_stop()  # just to be sure
-        old_pc = M.get_position()
+        self.P.flush()
+        M = self.M
+        old_pc = M.get_position(V) # waits for any move in progress
         new_pc = old_pc  - self.exact_error # new time for phase control
         new_pc_fix = np.mod(new_pc, 1/self.laser_f)  # equal within one cycle. 
-        M.move(new_pc_fix) # moves phase motor to new position
-        M.wait_for_stop()
-        time.sleep(2)
+        M.move(new_pc_fix) # moves phase motor to new position, returns once in position
+        V['phase_motor'] = new_pc_fix / M.scale
+        self.C.wait_for_update() # let the counter see the corrected time before the next check_jump
         new_offset = self.d['offset'] - (new_pc_fix - old_pc)
         self.d['offset'] = new_offset
         self.P.put('offset', new_offset)
+        V['offset'] = new_offset
         self.P.E.write_error('Done Fixing Jump')
         bc = self.P.get('bucket_counter') # previous number of jumps
         self.P.put('bucket_counter', bc + 1)  # write incremented number
 
-    def move_time_delay(self):
-        """Takes the time of the most recent set time adjustment, returns the approximate delay that occurred before the time interval counter detected the change in time."""
+    def move_time_delay(self, V):
+        """Takes the cycle's snapshot and the time of the most recent set time adjustment, returns the approximate delay that occurred before the time interval counter detected the change in time."""
         try:
             if abs(self.pc_diff) > 1e-6 or self.move_flag == 1: # Checks if phase motor set position has changed
                 self.curr_time = self.C.get_time() # Current counter time
-                T = trigger(self.P)
-                t_trig = T.get_ns()
-                S = sawtooth(self.pc_out, t_trig, self.P.get('delay'), self.P.get('offset'), 1/self.laser_f) # Calculate theoretical laser time 
+                S = sawtooth(self.pc_out, V['laser_trigger'], V['delay'], V['offset'], 1/self.laser_f) # Calculate theoretical laser time 
                 if abs(self.curr_time - S.t) < 0.25: # Checks if counter reading is within 250 ps of set time
                     move_stop = time.time() # Time of change in counter time
                     move_delay = move_stop - self.move_start # Calculates approximate time in seconds it took to make see change in time on counter. Imprecise because femto.py loop delay.
-                    self.P.put('move_time_delay', move_delay)
+                    self.P.write('move_time_delay', move_delay)
                     self.move_flag = 0
                 else:
                     self.move_flag = 1
             if self.buckets != 0 or self.bucket_flag == 1:
                 self.curr_time = self.C.get_time() # Current counter time
-                T = trigger(self.P)
-                t_trig = T.get_ns()
-                S = sawtooth(self.pc_out, t_trig, self.P.get('delay'), self.P.get('offset'), 1/self.laser_f) # Calculate theoretical laser time 
+                S = sawtooth(self.pc_out, V['laser_trigger'], V['delay'], V['offset'], 1/self.laser_f) # Calculate theoretical laser time 
                 if abs(self.curr_time - S.t) < 0.25: # Checks if counter reading is within 250 ps of set time
                     self.correction_t = time.time() # Time of change in counter time
                     self.corr_diff = self.correction_t - self.move_start # Calculates approximate time in seconds it took to make see change in time on counter due to bucket correction. Imprecise because femto.py loop delay.
-                    self.P.put('bucket_correction_delay', self.corr_diff)
+                    self.P.write('bucket_correction_delay', self.corr_diff)
                     self.bucket_flag = 0
                 else:
                     self.bucket_flag = 1
@@ -519,43 +880,135 @@ class sawtooth():
         self.r = (0.5 + np.copysign(.5, tr - 0.2 * period)) * (0.5 + np.copysign(.5, .8 * period - tr)) # no sign function
 
 
-class ring():
-    """A twelve element ring buffer."""
-    def __init__(self, sz=12):
-        """Takes a size value, creates an array for the ring buffer."""
-        self.sz = sz  # hold size of ring
-        self.a = np.zeros(sz)
-        self.ptr = -1 # points to last data, start negative
-        self.full = False # set to true when the ring is full
-        
-    def add_element(self, x):
-        """Takes an element index, adds an element to the ring at that index."""
-        self.ptr = np.mod(self.ptr+1,self.sz)        
-        self.a[self.ptr] = x # set this element
-        if self.ptr == 7:
-            self.full = True
-
-    def get_last_element(self):
-        """Returns most recently added element of the buffer."""
-        return self.a[self.ptr]       
-        
-    def get_array(self):
-        """Returns entire ring buffer array."""
-        return self.a
-        
- 
+class sawtooth_fit():
+    """Fits delay and offset of the sawtooth model to calibration sweep data, weighting each point by its counter jitter."""
+    def __init__(self, t0, tout, good, jitter, t_trig, delay, period, n_offset=256, n_delay=16):
+        """Takes sweep positions, measured times, good flags, jitter (ns), trigger time, initial delay guess and period, fits delay and offset."""
+        t0 = np.asarray(t0, dtype=float)
+        tout = np.asarray(tout, dtype=float)
+        self.good = np.asarray(good, dtype=float)
+        self.w = self.weights(self.good, jitter)
+        self.period = period
+        # Coarse pass: whole delay x offset grid in one broadcast evaluation, shape (delays, offsets, points)
+        offsets = np.linspace(0, period, n_offset, endpoint=False)
+        delays = delay + period * np.append(0, np.linspace(-0.25, 0.05, n_delay)) # laser fires within one period of the trigger, so the delay sits at or just below the earliest reading
+        err, nbad = self.grid_error(t0, tout, t_trig, delays[:, np.newaxis, np.newaxis], offsets[np.newaxis, :, np.newaxis])
+        j = np.argmin(err, axis=1) # best offset for each delay
+        nbad = nbad[np.arange(len(delays)), j]
+        consistent = np.nonzero(nbad == np.min(nbad))[0] # delays that put every reading on the right sawtooth branch
+        i = consistent[np.argmin(np.abs(delays[consistent] - delay))] # of those, stay closest to the initial guess
+        # Fine pass: one coarse step either side of the coarse minimum
+        step = offsets[1] - offsets[0]
+        offsets = offsets[j[i]] + np.linspace(-step, step, n_offset)
+        err, nbad = self.grid_error(t0, tout, t_trig, delays[i], offsets[:, np.newaxis])
+        k = np.argmin(err)
+        # Newton step: the model is linear in offset once the sawtooth branch of each point is fixed, so one step lands on the exact minimum
+        S = sawtooth(t0, t_trig, delays[i], offsets[k], period)
+        wr = self.w * S.r
+        offset = offsets[k]
+        if np.sum(wr) > 0:
+            offset = offset + np.sum(wr * (tout - S.t)) / np.sum(wr)
+        self.delay = delays[i]
+        self.offset = np.mod(offset, period)
+        S = sawtooth(t0, t_trig, self.delay, self.offset, period)
+        self.error = self.rms(S, tout) # fit quality, weighted rms residual in ns
+
+    def weights(self, good, jitter):
+        """Takes good flags and jitter (ns) for each point, returns inverse-variance weights normalized to a mean of 1."""
+        jitter = np.abs(np.asarray(jitter, dtype=float))
+        ok = (good > 0) & (jitter > 0)
+        if not np.any(ok):
+            return good # no jitter data, all good points count equally
+        floor = 0.1 * np.median(jitter[ok]) # keep a single very quiet reading from dominating the fit
+        w = good / np.maximum(jitter, floor)**2
+        return w * np.sum(good) / np.sum(w)
+
+    def grid_error(self, t0, tout, t_trig, delay, offset):
+        """Takes broadcastable delay and offset grids, returns the weighted mean square error and the number of readings on the wrong branch at every grid point."""
+        S = sawtooth(t0, t_trig, delay, offset, self.period)
+        wr = self.w * S.r
+        err = np.sum(wr * (S.t - tout)**2, axis=-1) / np.maximum(np.sum(wr, axis=-1), 1e-12)
+        nbad = np.sum(self.good * (np.abs(S.t - tout) > 0.5 * self.period), axis=-1)
+        return err, nbad
+
+    def rms(self, S, tout):
+        """Takes a sawtooth and the measured times, returns the weighted rms residual over valid points."""
+        wr = self.w * S.r
+        if np.sum(wr) == 0:
+            return 0
+        return np.sqrt(np.sum(wr * (S.t - tout)**2) / np.sum(wr))
+
+
+class offset_tracker():
+    """Kalman filter on the part of the counter residual that is not a whole bucket, follows slow offset drift between calibrations."""
+    def __init__(self, P, locking_f):
+        """Takes locker PVs and the locking frequency, reads tracking settings from the locker config."""
+        self.P = P
+        self.bucket = 1 / locking_f # ns
+        self.q = P.locker_config.get('offset_track_q', 1e-8) # ns^2/s, how fast the offset may wander
+        self.apply_sigma = P.locker_config.get('offset_track_sigma', 0.002) # ns, only apply once the uncertainty is below this
+        self.min_step = P.locker_config.get('offset_track_step', 0.002) # ns, smallest correction worth a motor move
+        self.min_jitter = 1e-4 # ns, floor on the measurement noise
+        self.gate = 5.0 # residuals further than this many sigma are outliers
+        self.max_rejected = 20 # this many outliers in a row means the offset moved, start over
+        self.reset()
+
+    def reset(self, offset=None):
+        """Takes the offset in use, forgets the tracked error."""
+        self.e = 0.0 # tracked error in ns: true offset - offset in use
+        self.var = self.bucket**2 # ns^2, knows nothing better than a bucket
+        self.offset = offset
+        self.last = None
+        self.rejected = 0
+
+    def update(self, offset, residual, jitter):
+        """Takes the offset in use, counter minus sawtooth time and counter jitter in ns, returns the offset step to apply (0 until confident)."""
+        now = time.time()
+        if self.offset is not None and offset != self.offset:
+            shift = offset - self.offset
+            if abs(shift - self.bucket * round(shift / self.bucket)) > 1e-6: # bucket fixes keep the error, anything else is a new calibration
+                self.reset()
+        self.offset = offset
+        if self.last is not None:
+            self.var += self.q * (now - self.last) # random walk since the last reading
+        self.last = now
+        z = residual - self.bucket * round(residual / self.bucket) # whole buckets are fix_jump's business
+        r = max(jitter, self.min_jitter)**2
+        if abs(z - self.e) > self.gate * math.sqrt(self.var + r):
+            self.rejected += 1
+            if self.rejected >= self.max_rejected:
+                self.reset(offset)
+            return 0.0
+        self.rejected = 0
+        k = self.var / (self.var + r)
+        self.e += k * (z - self.e)
+        self.var *= 1 - k
+        sigma = math.sqrt(self.var)
+        step = 0.0
+        if sigma < self.apply_sigma and abs(self.e) > max(3 * sigma, self.min_step):
+            step = self.e
+            self.e = 0.0 # now part of the offset
+            self.offset = offset + step
+        pvs = dict(offset_track=offset + step + self.e, offset_track_sigma=sigma)
+        for k in self.P.available(pvs.keys()):
+            self.P.write(k, pvs[k])
+        return step
+
+
 class time_interval_counter():
     """Returns SR620 counter time if it is in acceptable range and jitter is acceptably low."""
-    def __init__(self, P):
-        """Takes counter PVs, creates ring buffer for counter data."""
+    def __init__(self, P, sz=12):
+        """Takes counter PVs and ring size, creates ring buffer for counter data."""
         self.scale = 1e9 # scale relative to nanoseconds
         self.P = P
         self.good = 1 
-        self.rt = ring() # create a ring buffer to hold data
+        sz = self.P.locker_config.get('counter_window', sz) # number of readings used for range and robust estimate
+        self.rt = ring(sz) # create a ring buffer to hold data
         self.rt.add_element(self.P.get('counter')) # read first counter value to initialize array
-        self.rj = ring() # ring to hold jitter data
+        self.rj = ring(sz) # ring to hold jitter data
         self.rj.add_element(self.P.get('counter_jitter'))
         self.range = 0 # range of data
+        self.poll_delay = 0.05 # s between reads when waiting for new data without a monitor
 
     def get_time(self):
         """Returns counter time scaled to ns."""
@@ -565,7 +1018,7 @@ class time_interval_counter():
         tmin = self.P.get('counter_low')
         tmax = self.P.get('counter_high')
         time = self.P.get('counter')  # read counter time
-        if time == self.rt.get_last_element: # no new data
+        if time == self.rt.get_last_element(): # no new data
             return 0 # no new data
         if (time > tmax) or (time < tmin):
             return 0 # data out of range
@@ -577,47 +1030,181 @@ class time_interval_counter():
         self.rj.add_element(jit)  # add jitter to ring
         self.good = 1
         if self.rt.full:
-            self.range = self.scale * (max(self.rt.get_array()) - min(self.rt.get_array()))  # range of measurements
+            self.range = self.scale * self.rt.range  # range of measurements
         return time * self.scale
 
+    def load(self, times, jitters):
+        """Takes saved counter and jitter readings, oldest first, puts them in the rings ahead of the reading taken at startup."""
+        first = (self.rt.get_last_element(), self.rj.get_last_element())
+        self.rt = ring(self.rt.sz)
+        self.rj = ring(self.rj.sz)
+        for t, j in zip(times, jitters):
+            self.rt.add_element(t)
+            self.rj.add_element(j)
+        if first[0] != self.rt.get_last_element(): # a new reading since the state was saved
+            self.rt.add_element(first[0])
+            self.rj.add_element(first[1])
+
+    def wait_for_update(self, n=2, timeout=2.0):
+        """Takes a number of readings and a timeout in s, waits until the counter posts that many new readings, returns True if it did."""
+        if self.P.get_cached('counter') is not None: # monitored, count updates as they arrive
+            event = threading.Event()
+            seen = [0]
+            def update(value):
+                seen[0] += 1
+                if seen[0] >= n:
+                    event.set()
+            self.P.add_callback('counter', update)
+            try:
+                return event.wait(timeout)
+            finally:
+                self.P.remove_callback('counter', update)
+        last = self.P.get('counter')
+        seen = 0
+        end = time.time() + timeout
+        while time.time() < end: # no monitor, poll for changes
+            time.sleep(self.poll_delay)
+            time_now = self.P.get('counter')
+            if time_now != last:
+                last = time_now
+                seen += 1
+                if seen >= n:
+                    return True
+        return False
+
+    @property
+    def median(self):
+        """Median of the recent readings in ns."""
+        return self.scale * self.rt.median
+
+    @property
+    def mad(self):
+        """Median absolute deviation of the recent readings in ns."""
+        return self.scale * self.rt.mad
+
+    @property
+    def mean(self):
+        """Mean of the recent readings in ns."""
+        return self.scale * self.rt.mean
+
+    @property
+    def std(self):
+        """Standard deviation of the recent readings in ns."""
+        return self.scale * self.rt.std
+
+    @property
+    def estimate(self):
+        """Robust counter time in ns: the median once the ring is full, the latest reading before that."""
+        if self.rt.full:
+            return self.median
+        return self.scale * self.rt.get_last_element()
+
    
+class motion():
+    """Completion handle for one phase motor move, set from the DMOV / RBV monitors or by polling when they are off."""
+    def __init__(self, M, pos, timeout):
+        """Takes the phase motor, target position in ns and timeout in s, starts listening for the move to finish."""
+        self.M = M
+        self.P = M.P
+        self.position = pos
+        self.end = time.time() + timeout
+        self.event = threading.Event()
+        self.monitored = self.P.get_cached('phase_motor_dmov') is not None and self.P.get_cached('phase_motor_rb') is not None
+        self.ok = False # set once in position was verified
+        if self.monitored:
+            for name in ['phase_motor_dmov', 'phase_motor_rb']:
+                self.P.add_callback(name, self.update)
+            self.update() # a motor already in position posts no more updates
+
+    def update(self, value=None):
+        """Called on DMOV / RBV monitor updates, flags a possible end of the move."""
+        dmov = self.P.get_cached('phase_motor_dmov')[0]
+        rb = self.P.get_cached('phase_motor_rb')[0]
+        if self.M.in_position(dmov, rb, self.position):
+            self.event.set()
+
+    def verify(self):
+        """Returns True if a fresh read shows the motor stopped within tolerance of the target."""
+        try:
+            stopped = self.P.get('phase_motor_dmov') # 1 if stopped, if throws error, is still moving
+        except:
+            print('Could not get dmov. Error occurred at:', date_time())
+            logging.error('Could not get dmov.')
+            return False  # threw error, assume not stopped (should clean up to look for epics error)
+        return stopped and self.M.in_position(stopped, self.P.get('phase_motor_rb'), self.position)
+
+    def done(self):
+        """Returns True if the move has finished, without waiting."""
+        if not self.ok and (not self.monitored or self.event.is_set()):
+            self.event.clear() # cleared before the read, so a later monitor still wakes wait()
+            self.ok = self.verify()
+        return self.ok
+
+    def wait(self):
+        """Waits until the motor is in position or the timeout passes, returns True if it got there."""
+        try:
+            while not self.ok:
+                if self.monitored:
+                    self.event.wait(max(self.end - time.time(), 0))
+                if self.done():
+                    break
+                if time.time() >= self.end:
+                    print('Phase motor not in position after timeout. Occurred at:', date_time())
+                    logging.warning('Phase motor not in position after timeout.')
+                    break
+                if not self.monitored:
+                    time.sleep(self.M.loop_delay)
+        finally:
+            self.close()
+        return self.ok
+
+    def close(self):
+        """Stops listening to the monitors."""
+        if self.monitored:
+            for name in ['phase_motor_dmov', 'phase_motor_rb']:
+                self.P.remove_callback(name, self.update)
+
+
 class phase_motor():
-    """Waits for phase motor to stop moving, reads and writes phase motor position."""
+    """Waits for phase motor to stop moving, reads and writes phase motor position. Remembers where it was last verified in position."""
     def __init__(self, P):
         """Takes phase motor PVs, sets up phase motor movement parameters."""
         self.scale = .001 # motor is in ps, everthing else in ns
         self.P = P
         self.max_tries = 100
         self.loop_delay = 0.1
+        self.timeout = self.max_tries * self.loop_delay # s to wait for a move before giving up
         self.tolerance = 3e-5  #was 5e-6 #was 2e-5
         self.position = self.P.get('phase_motor') * self.scale  # get the current position  WARNING logic race potential
-        self.wait_for_stop()  # wait until it stops moving
+        self.settled = self.wait_for_stop()  # wait until it stops moving, True while known to be at self.position
+
+    def in_position(self, dmov, rb, pos):
+        """Takes DMOV, readback in ps and target position in ns, returns True if stopped within tolerance."""
+        return bool(dmov) and abs(rb * self.scale - pos) < self.tolerance
 
     def wait_for_stop(self):
-        """Sleeps until phase motor is stopped and within tolerance of set value."""
-        for n in range(0, self.max_tries):
-            try:
-                stopped = self.P.get('phase_motor_dmov') # 1 if stopped, if throws error, is still moving
-            except:
-                print('Could not get dmov. Error occurred at:', date_time())
-                logging.error('Could not get dmov.')
-                stopped = 0  # threw error, assume not stopped (should clean up to look for epics error)
-            if stopped:
-                posrb = self.P.get('phase_motor_rb') * self.scale  # position in nanoseconds
-                if abs(posrb - self.position) < self.tolerance:  # are we within range
-                   break
-            time.sleep(self.loop_delay)        
-
-    def move(self, pos):
-        """Takes target position, moves phase motor to target value in ps."""
+        """Waits until phase motor is stopped and within tolerance of set value, returns True if it is."""
+        return motion(self, self.position, self.timeout).wait()
+
+    def move(self, pos, wait=True):
+        """Takes target position in ns, moves phase motor and returns the motion handle, after waiting for it unless wait is False."""
+        m = motion(self, pos, self.timeout) # listen before the put so the end of a short move isn't missed
         self.P.put('phase_motor', pos/self.scale) # motor move if needed   
         self.position = pos  # requested position in ns
-        self.wait_for_stop() # check
+        self.settled = m.wait() if wait else False # a move not waited for is checked on the next get_position
+        return m
          
-    def get_position(self):
-        """Returns phase motor position in ns."""
-        self.wait_for_stop() # wait until it stops moving
-        self.position = self.scale * self.P.get('phase_motor')  # get position data
+    def get_position(self, V=None):
+        """Takes the cycle's snapshot (optional), returns phase motor position in ns. No reads while the snapshot shows the motor where it was last verified."""
+        if V is not None:
+            target = V['phase_motor'] * self.scale # where the motor was last sent, by anyone
+        else:
+            target = self.scale * self.P.get('phase_motor')  # get position data
+        if self.settled and abs(target - self.position) < self.tolerance:
+            self.P.reads_avoided += 2 # DMOV and RBV, the position was read either way
+            return self.position
+        self.position = target
+        self.settled = self.wait_for_stop() # wait until it stops moving
         return self.position           
 
 
@@ -640,19 +1227,67 @@ class trigger():
    
   
 class error_output():
-    """Writes error messages to a PV."""
-    def __init__(self, pv):
-        """Takes error PV, sets it to default OK state."""
+    """Collects the status conditions raised during a cycle, writes the most severe one to the error PV once per cycle."""
+    def __init__(self, pv, hold=2.0):
+        """Takes error PV and the time in s a warning or fault stays active after it was last raised, sets the PV to default OK state."""
         self.pv = pv
         self.pv.put(value= 'OK', timeout=1.0) #Error message default is 'OK'
         self.maxlen = 25 # Maximum error string length
+        self.hold = hold # keeps flapping conditions from toggling the PV every cycle
+        self.last = 'OK' # text on the PV
+        self.raised = dict() # message -> sequence number, raised since the last flush
+        self.active = dict() # message -> [sequence number, time last raised], warnings and faults still within the hold time
+        self.seq = 0
+        self.bits = 0 # bitmask of active conditions
+        self.count = 0 # number of active conditions
+        self.conditions = dict() # message -> (severity, bit), severity 0 ok, 1 activity, 2 warning, 3 fault, 4 exiting
+        for msg, severity in [('OK', 0), ('Laser OK', 0), ('Done Fixing Jump', 1), (' calibration done', 1), ('Config reloaded', 1), ('done, exiting', 4)]:
+            self.conditions[msg] = (severity, None)
+        for bit, (msg, severity) in enumerate([
+                ('Counter not stable', 2), ('No counter reading', 2), ('Not an integer number of buckets', 2),
+                ('Trying to fix non-existent jump', 2), ('Non-integer bucket error, cant fix', 2),
+                ('TGT bigger than time_hihi', 2), ('TGT smaller than time_lolo', 2),
+                ('Timer error, bad data - continuing to calibrate', 2),
+                ('RF power out of range', 3), ('Diode power out of range', 3), ('Frequency set point out of range', 3),
+                ('Laser not indicating lock', 3), ('desired time is NaN', 3), ('need to move TIC trigger', 3),
+                ('Fixing Jump', 1), ('calibration requested - starting', 1), ('Config rejected', 2)]):
+            self.conditions[msg] = (severity, bit)
+        self.other_bit = bit + 1 # any message not listed above counts as a warning
   
     def write_error(self, txt):
-        """Takes error string text, writes it to error PV."""
-        n = len(txt)
-        if n > self.maxlen:
-            txt = txt[0:self.maxlen]
-        self.pv.put(value = txt, timeout = 1.0)
+        """Takes error string text, raises it as a condition for this cycle. The most severe one is written by flush()."""
+        self.seq += 1
+        self.raised[txt] = self.seq
+
+    def severity(self, txt):
+        """Takes a message, returns (severity, bit)."""
+        return self.conditions.get(txt, (2, self.other_bit))
+
+    def flush(self):
+        """Updates the active conditions, queues the most severe text if it differs from what the PV shows, goes out with the next batch flush."""
+        now = time.time()
+        for txt, seq in self.raised.items():
+            if self.severity(txt)[0] >= 2:
+                self.active[txt] = [seq, now]
+        for txt in list(self.active):
+            if now - self.active[txt][1] > self.hold:
+                del self.active[txt] # cleared
+        current = dict((txt, v[0]) for txt, v in self.active.items())
+        current.update(self.raised)
+        self.raised = dict()
+        self.bits = 0
+        for txt in current:
+            bit = self.severity(txt)[1]
+            if bit is not None:
+                self.bits |= 1 << bit
+        self.count = bin(self.bits).count('1')
+        if not current:
+            return # nothing raised, leave the PV as it is
+        txt = max(current, key=lambda t: (self.severity(t)[0], current[t]))  # most severe, then most recent
+        txt = txt[0:self.maxlen]
+        if txt != self.last:
+            self.pv.put(value = txt, timeout = None)
+            self.last = txt
 
 
 class degrees_s():
@@ -665,26 +1300,29 @@ class degrees_s():
         self.last_deg = self.P.get('deg_Sband') # last degrees sband
         self.last_ns_offset = self.P.get('ns_offset')
         self.last_deg_offset = self.P.get('deg_offset')
+        self.inputs = ['time', 'deg_Sband', 'ns_offset', 'deg_offset'] # PVs read once per cycle into a snapshot
         
-    def run(self):
-        """Takes degrees and ns time values, updates them to match one another. ns time value is given priority if they have both changed."""
-        ns = self.P.get('time')
-        deg = self.P.get('deg_Sband')
-        ns_offset = self.P.get('ns_offset')
-        deg_offset = self.P.get('deg_offset')
+    def run(self, V):
+        """Takes the cycle's snapshot, updates degrees and ns time values to match one another. ns time value is given priority if they have both changed."""
+        ns = V['time']
+        deg = V['deg_Sband']
+        ns_offset = V['ns_offset']
+        deg_offset = V['deg_offset']
         if ns != self.last_time or ns_offset != self.last_ns_offset: # nanoseconds have changed
            deg_new = -1.0*(ns - ns_offset) * self.freq * 360 - deg_offset
            self.last_time = ns
            self.last_ns_offset = ns_offset
            self.last_deg = deg_new
-           self.P.put('deg_Sband', deg_new) #write the degrees back
+           self.P.write('deg_Sband', deg_new) #write the degrees back, sent with the cycle's other writes
+           V['deg_Sband'] = deg_new
            
         elif deg != self.last_deg or deg_offset != self.last_deg_offset:  #changed degrees
            ns_new = -1.0*(deg + deg_offset)/(self.freq * 360) + ns_offset
            self.last_time = ns_new
            self.last_deg = deg
            self.last_deg_offset = deg_offset
-           self.P.put('time', ns_new) 
+           self.P.write('time', ns_new)
+           V['time'] = ns_new
 
         else:
             pass        
@@ -697,68 +1335,221 @@ def date_time():
     return curr_time
 
 
+def error_kind(e):
+    """Takes an exception from the main loop, returns 'channel' (CA error), 'data' (missing or bad value) or 'other'."""
+    if isinstance(e, channel.errors()):
+        return 'channel'
+    if isinstance(e, (TypeError, ValueError, ArithmeticError, IndexError, KeyError)):
+        return 'data' # usually a None or garbage value from a PV that dropped out
+    return 'other'
+
+
+class locker_loop():
+    """Sets up one locker and runs its main program loop a cycle at a time."""
+    def __init__(self, name, pool=None):
+        """Takes name of locking system and an optional pv_pool, sets up PVs, watchdog and locker."""
+        self.name = name
+        self.pool = pool
+        self.wait = 0.1 # s between ticks, less if a task period is shorter
+        self.max_soft = 3 # failed cycles in a row recovered in place before a full rebuild
+        self.errors = 0 # failed cycles in a row
+        self.error_start = None # time of the first error of the current run of them
+        self.W = None
+        self.saver = None # writes the checkpoint file, kept across rebuilds
+        self.setup()
+
+    def setup(self):
+        """Connects PVs and sets up watchdog, locker, degrees conversion and the loop tasks, sets OK if ready to run."""
+        self.OK = 0
+        P = PVS(self.name, self.pool) # kept apart until it works, a failed rebuild leaves the old locker whole
+        if P.OK == 0:
+            return
+        if self.W is not None:
+            self.W.stop() # the old heartbeat would look like another instance
+        W = watchdog.heartbeat(P.pvlist['watchdog']) # increments from its own thread, W.check() is a flag read
+        if W.error:
+            return
+        self.P, self.W = P, W
+        self.L = locker(self.P, self.W) # Sets up locking system parameters
+        self.resume() # warm start from the checkpoint file, as far as it still fits
+        if self.saver is None:
+            self.saver = checkpoint.saver(self.P.state_file)
+        self.L.locker_status(snapshot(self.P, self.L.status_inputs))  # Checks locking system / laser status
+        self.P.E.write_error(self.L.message)
+        self.D = degrees_s(self.P) # Enables degrees to be converted to ns, and vice versa
+        self.S = scheduler.scheduler(self.wait) # fixed rate tick, tasks run at their own rates on it
+        self.periods = dict(status=self.wait, lock=self.wait, degrees=1.0, report=1.0, checkpoint=5.0, config=1.0) # s, unless task_periods says otherwise
+        for name, fn in [('status', self.status), # laser and RF limits
+                         ('lock', self.lock), # counter, jumps and setpoint
+                         ('degrees', self.degrees),
+                         ('report', self.report), # PV stats and overruns
+                         ('checkpoint', self.checkpoint), # locker state for a restart
+                         ('config', self.config)]: # last, so edits apply between cycles
+            self.S.add(scheduler.task(name, fn, self.periods[name]))
+        self.configure()
+        self.OK = 1
+
+    def configure(self):
+        """Sets the loop tasks' periods, deadlines and inputs from the locker config."""
+        inputs = dict(status=self.L.status_inputs, lock=self.L.inputs + ['calibrate', 'fix_bucket', 'enable'], degrees=self.D.inputs,
+                      checkpoint=['time', 'laser_trigger'])
+        for t in self.S.tasks:
+            t.period = self.P.task_periods.get(t.name, self.periods[t.name])
+            t.deadline = self.P.task_deadlines.get(t.name, t.period)
+            t.inputs = list(inputs.get(t.name, []))
+        tasks = dict((t.name, t) for t in self.S.tasks)
+        tasks['status'].period = min(tasks['status'].period, tasks['lock'].period, tasks['degrees'].period) # runs first whenever lock or degrees does, they act on a fresh laser_ok
+        tasks['status'].deadline = self.P.task_deadlines.get('status', tasks['status'].period)
+        self.S.retick(min([self.wait] + [t.period for t in self.S.tasks])) # a task can't run faster than the tick
+
+    def resume(self):
+        """Restores the locker state saved before a restart, the parts that still match the PVs."""
+        s, problems = checkpoint.read(self.P.state_file, self.P.state_max_age)
+        if s is None:
+            print('No saved locker state:', '; '.join(problems))
+            logging.info('No saved locker state: %s', '; '.join(problems))
+            return
+        restored = self.L.resume(s, snapshot(self.P, self.L.inputs))
+        print('Restored saved locker state:', ', '.join(restored) or 'nothing', 'Occurred at:', date_time())
+        logging.info('Restored saved locker state: %s', ', '.join(restored) or 'nothing')
+
+    def checkpoint(self, V):
+        """Takes the cycle's snapshot, hands the locker state to the checkpoint writer."""
+        self.saver.save(self.L.state(V))
+
+    def config(self, V):
+        """Takes the cycle's snapshot, applies edits of the locker config file, flags a rejected edit on the status PV until it is fixed."""
+        keys = self.P.reload_config()
+        if keys:
+            self.L.configure(keys)
+            self.configure()
+            self.P.E.write_error('Config reloaded')
+        if self.P.config_problems:
+            self.P.E.write_error('Config rejected')
+
+    def status(self, V):
+        """Takes the cycle's snapshot, checks if the locking system is OK."""
+        L = self.L
+        L.locker_status(V)
+        if not L.laser_ok:  # If the laser is not in OK state, report error, lock waits until it is
+            self.P.E.write_error(L.message)
+            self.P.write('busy', 0)
+            self.P.write('ok', 0)
+
+    def lock(self, V):
+        """Takes the cycle's snapshot, handles calibration requests, checks and fixes bucket jumps and sets the laser time."""
+        P = self.P
+        L = self.L
+        if not L.laser_ok:
+            return
+        if V['calibrate']: # Executed if a calibration is requested
+            self.S.excuse() # takes as long as it takes
+            P.E.write_error( 'calibration requested - starting')
+            P.write('ok', 0)
+            P.write('busy', 1) # Sets busy flag while calibrating
+            P.flush()
+            L.calibrate(V)
+            P.put('calibrate', 0)
+            P.E.write_error( ' calibration done')
+            return
+        L.check_jump(V)   # Checks for bucket jumps
+        if V['fix_bucket'] and L.buckets != 0 and V['enable']:
+            P.write('ok', 0)
+            P.write('busy', 1)
+            L.fix_jump(V)  # Fixes bucket jumps, flushes busy first
+        for k, x in [('busy', 0), ('bucket_error', L.buckets), ('unfixed_error', L.bucket_error), ('ok', 1)]:
+            P.write(k, x) # only sent if changed
+        if V['enable']: # Checks if time control is enabled
+            L.set_time(V) # Sets laser time
+            L.move_time_delay(V) # Record delay between set time change and change in counter readback
+
+    def degrees(self, V):
+        """Takes the cycle's snapshot, makes the degrees and ns time values match."""
+        if not self.L.laser_ok: # nothing changes while the laser is not OK
+            return
+        self.D.run(V)
+
+    def report(self, V):
+        """Takes the cycle's snapshot, publishes PV stats, loop task overruns and watchdog heartbeat jitter."""
+        self.P.publish_stats()
+        beat = self.W.stats()
+        values = dict(overruns=self.S.overruns(), overrun_summary=self.S.summary(), heartbeat_jitter=beat['jitter'], heartbeat_late=beat['late'])
+        for k in self.P.available(['overruns', 'overrun_summary', 'heartbeat_jitter', 'heartbeat_late']):
+            self.P.write(k, values[k]) # only sent if changed
+
+    def cycle(self):
+        """Runs the loop tasks that are due on this tick, reading their inputs in one snapshot."""
+        P = self.P
+        loop_start = time.time()
+        self.W.check()
+        tasks = self.S.due(loop_start)
+        V = snapshot(P, self.S.inputs(tasks)) # every input for this cycle, read once
+        for t in tasks:
+            self.S.run(t, V)
+        loop_stop = time.time()
+        loop_time = loop_stop - loop_start
+        P.write('loop_time', loop_time)
+
+    def step(self):
+        """Runs one cycle, recovering from any error it raises, returns the time in s to wait before the next tick."""
+        try:
+            self.cycle()
+            self.P.flush() # one batch of this cycle's writes
+        except:   # Catch any otherwise uncaught error.
+            self.recover(sys.exc_info()[1])
+            return self.S.tick
+        if self.error_start is not None: # first good cycle after errors
+            dt = time.time() - self.error_start
+            print('Recovered after', round(dt, 3), 's at', date_time())
+            logging.info('Recovered after %.3f s.', dt)
+            for k in self.P.available(['recover_time']):
+                self.P.write(k, dt)
+            self.error_start = None
+        self.errors = 0
+        supervisor.ready() # first good cycle, for the restart latency
+        return self.S.until_next()
+
+    def recover(self, e):
+        """Takes the exception that ended a cycle, reconnects only the PVs that failed and keeps locker state, rebuilding everything if that keeps failing."""
+        kind = error_kind(e)
+        print(kind, 'error:', repr(e), 'Error occurred at:', date_time()) # Print error
+        logging.error('%s error: %r', kind, e)
+        if self.error_start is None:
+            self.error_start = time.time()
+        self.errors += 1
+        if kind != 'other' and self.errors <= self.max_soft:
+            bad = self.P.reconnect()
+            if bad:
+                print('Still not responding:', ', '.join(bad))
+                logging.warning('Still not responding: %s', ', '.join(bad))
+            return
+        print('UNKNOWN ERROR, trying again. Error occurred at:', date_time())
+        self.errors = 0
+        self.setup()
+        if self.OK == 0: # the old PVs and locker are still bound, running on with them would hide the failure
+            print('Rebuild failed, exiting for a restart at:', date_time())
+            logging.error('Rebuild failed, exiting for a restart.')
+            if self.W is not None:
+                self.W.stop()
+            sys.exit(1) # the supervisor restarts it
+
+    def run(self):
+        """Runs the main program loop until the watchdog says to stop."""
+        wait = self.wait
+        while self.W.error == 0:   # MAIN PROGRAM LOOP
+            time.sleep(wait)
+            wait = self.step()
+        self.W.stop()
+        self.P.E.write_error( 'done, exiting')
+        self.P.flush()
+
+
 def femto(name='NULL'):
     """Takes name of locking system, performs complete locking and timing routine."""
-    P = PVS(name)
-    if P.OK == 0:
-        return
-    W = watchdog.watchdog(P.pvlist['watchdog'])
-    if W.error:
-        return
-    L = locker(P,W) # Sets up locking system parameters
-    L.locker_status()  # Checks locking system / laser status
-    P.E.write_error(L.message)
-    T = trigger(P)
-    T.get_ns()
-    D = degrees_s(P) # Enables degrees to be converted to ns, and vice versa
-    while W.error == 0:   # MAIN PROGRAM LOOP
-        time.sleep(0.1)
-        try:   
-            loop_start = time.time()
-            W.check()
-            P.put('busy', 0)
-            L.locker_status()  # Checks if the locking system is OK
-            if not L.laser_ok:  # If the laser is not in OK state, report error and try again
-                P.E.write_error(L.message)
-                P.put('ok', 0)
-                time.sleep(0.5)  # Keeps the loop from spinning too fast
-                continue        
-            if P.get('calibrate'): # Executed if a calibration is requested
-                P.put('ok', 0)
-                P.put('busy', 1) # Sets busy flag while calibrating
-                P.E.write_error( 'calibration requested - starting')
-                L.calibrate()
-                P.put('calibrate', 0)
-                P.E.write_error( ' calibration done')
-                continue
-            L.check_jump()   # Checks for bucket jumps
-            if P.get('fix_bucket') and L.buckets != 0 and P.get('enable'):
-                P.put('ok', 0)
-                P.put('busy', 1)
-                L.fix_jump()  # Fixes bucket jumps
-            P.put('bucket_error',  L.buckets)
-            P.put('unfixed_error', L.bucket_error)
-            P.put('ok', 1)
-            if P.get('enable'): # Checks if time control is enabled
-                L.set_time() # Sets laser time
-                L.move_time_delay() # Record delay between set time change and change in counter readback
-            D.run()  # Ensures degrees and ns time value match
-            loop_stop = time.time()
-            loop_time = loop_stop - loop_start
-            P.put('loop_time', loop_time)
-        except:   # Catch any otherwise uncaught error.
-            print(sys.exc_info()[0]) # Print error
-            logging.error('%s', sys.exc_info()[0])
-            del P  #does this work?
-            print('UNKNOWN ERROR, trying again. Error occurred at:', date_time())
-            P = PVS(name)
-            W = watchdog.watchdog(P.pvlist['watchdog'])
-            L = locker(P, W) #set up locking system parameters
-            L.locker_status()  # check locking system / laser status
-            P.E.write_error(L.message)
-            T = trigger(P)
-            T.get_ns()
-    P.E.write_error( 'done, exiting')
+    F = locker_loop(name)
+    if F.OK == 0:
+        sys.exit(1) # not a clean finish, the supervisor restarts it
+    F.run()
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -0,0 +1,20 @@
+""" Simulated femto timing plant, a local stand-in for the LCLS controls network.
+
+femtosim serves every PV that femto.py, femto_longdelay.py, time_tool.py and
+pcav2cast_*.py touch from an in-process physics model (see plant.py), through
+fake psp.Pv / pyca and pyepics modules (see pv.py). Nothing goes over the
+network, so the scripts can be exercised and benchmarked on a laptop.
+
+Usage from the command line (runs the script in this process):
+    python -m femtosim femto.py CXI --latency 0.002 --noise 0.005
+    python -m femtosim pcav2cast_hxr.py
+
+Usage from python:
+    import femtosim
+    S = femtosim.plant(hutch='CXI', latency=0.002)
+    femtosim.install(S)  # before importing femto / epics
+    S.start()
+"""
+
+from femtosim.plant import plant
+from femtosim.pv import install
@@ -0,0 +1,45 @@
+""" Runs an fstiming script against the simulated plant.
+
+python -m femtosim <script> [hutch] [--latency s] [--noise ns] [--drift ns/s]
+                   [--jump-rate 1/s] [--counter-rate Hz] [--seed n]
+"""
+
+import argparse
+import logging
+import os
+import runpy
+import sys
+
+import femtosim
+
+
+def main():
+    """Parses the command line, builds and starts the plant, then runs the script in this process."""
+    parser = argparse.ArgumentParser(prog='femtosim', description='Run an fstiming script against a simulated plant.')
+    parser.add_argument('script', help='femto.py, femto_longdelay.py, femto_async.py, time_tool.py or pcav2cast_<hxr|sxr>.py')
+    parser.add_argument('hutch', nargs='?', default=None)
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated CA round trip in s')
+    parser.add_argument('--noise', type=float, default=0.005, help='counter noise in ns rms')
+    parser.add_argument('--drift', type=float, default=0.0, help='laser offset drift in ns/s')
+    parser.add_argument('--jump-rate', type=float, default=0.0, help='random bucket jumps per s')
+    parser.add_argument('--counter-rate', type=float, default=5.0, help='counter updates per s')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    locker_hutch = args.hutch if args.hutch and os.path.exists(os.path.join(here, args.hutch + '_locker_config.json')) else None
+    S = femtosim.plant(hutch=locker_hutch, latency=args.latency, noise=args.noise, drift=args.drift,
+                       jump_rate=args.jump_rate, counter_rate=args.counter_rate, seed=args.seed)
+    femtosim.install(S)
+    os.environ['FS_CONFIG_PATH'] = os.path.join(here, '') # locker configs from this checkout
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO) # keeps femto.py off /reg/d
+    S.start()
+    sys.path.insert(0, here)
+    sys.argv = [args.script] + ([args.hutch] if args.hutch else [])
+    try:
+        runpy.run_path(os.path.join(here, args.script), run_name='__main__')
+    finally:
+        S.stop()
+
+
+if __name__ == '__main__':
+    main()
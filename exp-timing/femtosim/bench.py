@@ -0,0 +1,223 @@
+#bench.py
+""" Performance benchmarks for the fstiming scripts, run against the simulated plant.
+
+Measures, with a configurable simulated CA latency:
+- femto(): time from start to the first completed cycle, loop time percentiles
+  (the LOOP_TIME writes), cycle period, CA requests and writes per cycle, CPU per cycle, and
+  time to detect / fix an injected bucket jump
+- time_tool.read_write: call time percentiles, CA requests and CPU per call
+- pcav2cast_hxr.feedback_step: step time, CA requests and CPU per step
+
+Results are written as JSON. Given a baseline JSON, every metric is checked
+against it and the exit code is 1 if any got worse by more than the tolerance.
+The exit code is also 1 if a script read a value before its queued get completed.
+
+python -m femtosim.bench --latency 0.002 --out bench.json
+python -m femtosim.bench --latency 0.002 --baseline bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+import femtosim
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLACK = {'_s': 0.002, '': 0.5} # absolute slack by metric unit suffix, on top of the relative tolerance
+
+
+def percentiles(x):
+    """Takes a list of samples, returns p50/p99/max."""
+    if len(x) == 0:
+        return dict(p50=None, p99=None, max=None)
+    x = np.asarray(x, dtype=float)
+    return dict(p50=float(np.percentile(x, 50)), p99=float(np.percentile(x, 99)), max=float(np.max(x)))
+
+
+def requests(stats):
+    """Takes plant stats, returns (round trips that wait, total requests)."""
+    waits = stats['get'] + stats['put'] + stats['pend'] + stats['connect']
+    return waits, waits + stats['get_nowait'] + stats['put_nowait']
+
+
+class probe():
+    """Snapshots CA counters and CPU so a window of work can be measured."""
+    def __init__(self, S):
+        self.S = S
+        self.stats = dict(S.stats)
+        self.cpu = time.process_time() - S.cpu # leave out the plant's own thread
+        self.wall = time.time()
+
+    def since(self, n):
+        """Takes the number of cycles in the window, returns per cycle requests and CPU."""
+        n = max(n, 1)
+        delta = dict((k, self.S.stats[k] - self.stats[k]) for k in self.stats)
+        waits, total = requests(delta)
+        return dict(round_trips_per_cycle=waits / float(n), requests_per_cycle=total / float(n),
+                    writes_per_cycle=(delta['put'] + delta['put_nowait']) / float(n),
+                    cpu_per_cycle_s=(time.process_time() - self.S.cpu - self.cpu) / n)
+
+
+def writes(S, name, start, stop=None):
+    """Takes the plant, a PV name and a time window, returns [(time, value)] of puts to that PV."""
+    return [(t, v) for (t, n, v) in list(S.writes) if n == name and t >= start and (stop is None or t < stop)]
+
+
+def bench_femto(S, hutch, warmup, window, fix_timeout):
+    """Runs femto() on the plant, returns loop metrics and time to detect / fix an injected jump."""
+    import femto
+    start = time.time()
+    th = threading.Thread(target=femto.femto, args=(hutch,))
+    th.daemon = True
+    th.start()
+    time.sleep(warmup) # check_jump holds off for 10 s after the first move
+    first = writes(S, S.vit + 'LOOP_TIME', start)
+    startup = first[0][0] - start if first else None # includes the watchdog's 1 s check
+    p = probe(S)
+    time.sleep(window)
+    loops = writes(S, S.vit + 'LOOP_TIME', p.wall)
+    result = dict(cycles=len(loops), loop_time_s=percentiles([v for t, v in loops]),
+                  cycle_period_s=percentiles(np.diff([t for t, v in loops])))
+    result.update(p.since(len(loops)))
+    result['time_to_first_cycle_s'] = startup
+    t0 = time.time()
+    S.inject_jump(1)
+    detect = fix = None
+    while time.time() - t0 < fix_timeout and fix is None:
+        time.sleep(0.01)
+        if detect is None: # busy goes up before fix_jump, the bucket error is only written after it
+            hits = [t for t, v in writes(S, S.vit + 'FS_BUCKET_ERROR', t0) + writes(S, S.vit + 'FS_CTRL_BUSY', t0) if v != 0]
+            detect = min(hits) - t0 if hits else None
+        hits = writes(S, S.vit + 'FS_CORRECTION_CNT', t0)
+        fix = hits[0][0] - t0 if hits else None
+    result['time_to_detect_s'] = detect
+    result['time_to_fix_s'] = fix
+    S.write(S.vit + 'FS_WATCHDOG', -1) # tells femto() to exit
+    th.join(10)
+    return result
+
+
+def bench_time_tool(S, hutch, n):
+    """Calls time_tool.read_write n times, returns per call metrics."""
+    import time_tool
+    with contextlib.redirect_stdout(io.StringIO()):
+        T = time_tool.time_tool(hutch)
+    p = probe(S)
+    dt = []
+    for k in range(n):
+        start = time.time()
+        T.read_write()
+        dt.append(time.time() - start)
+    result = dict(calls=n, call_time_s=percentiles(dt))
+    result.update(p.since(n))
+    return result
+
+
+def bench_pcav2cast(S, n):
+    """Runs pcav2cast_hxr.feedback_step n times, returns per step metrics (step time includes its 5 x 0.1 s sampling sleeps)."""
+    import pcav2cast_hxr
+    with contextlib.redirect_stdout(io.StringIO()):
+        pcav2cast_hxr.init()
+        p = probe(S)
+        dt = []
+        for k in range(n):
+            start = time.time()
+            pcav2cast_hxr.feedback_step()
+            dt.append(time.time() - start)
+    result = dict(steps=n, step_time_s=percentiles(dt))
+    result.update(p.since(n))
+    return result
+
+
+def flatten(d, prefix=''):
+    """Takes nested results, returns {'a.b.c': number}."""
+    out = dict()
+    for k, v in d.items():
+        if isinstance(v, dict):
+            out.update(flatten(v, prefix + k + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[prefix + k] = v
+    return out
+
+
+def compare(result, baseline, tolerance):
+    """Takes results and a baseline, returns a list of metrics that got worse by more than the tolerance (all metrics are lower-is-better)."""
+    new = flatten(result['results'])
+    old = flatten(baseline['results'])
+    bad = []
+    for k in sorted(old):
+        if k.endswith('cycles') or k.endswith('calls') or k.endswith('steps'):
+            continue # counts, not costs
+        if k.split('.')[0] not in result['results']:
+            continue # benchmark skipped this run
+        slack = SLACK['_s'] if '_s.' in k or k.endswith('_s') else SLACK['']
+        if k not in new:
+            bad.append('%s: missing (baseline %.4g)' % (k, old[k]))
+        elif new[k] > old[k] * (1 + tolerance) + slack:
+            bad.append('%s: %.4g > baseline %.4g' % (k, new[k], old[k]))
+    return bad
+
+
+def main():
+    """Parses the command line, runs the benchmarks, writes JSON and checks against a baseline."""
+    parser = argparse.ArgumentParser(prog='femtosim.bench', description='Benchmark fstiming scripts against the simulated plant.')
+    parser.add_argument('--hutch', default='CXI')
+    parser.add_argument('--latency', type=float, default=0.002, help='simulated CA round trip in s')
+    parser.add_argument('--warmup', type=float, default=11.0, help='s before measuring femto(), jump detection is held off for 10 s')
+    parser.add_argument('--window', type=float, default=5.0, help='s of femto() loop to measure')
+    parser.add_argument('--fix-timeout', type=float, default=30.0)
+    parser.add_argument('--calls', type=int, default=20, help='time_tool.read_write calls')
+    parser.add_argument('--steps', type=int, default=3, help='pcav2cast feedback steps')
+    parser.add_argument('--skip', default='', help='comma separated list of femto,time_tool,pcav2cast to skip')
+    parser.add_argument('--out', default=None, help='write results JSON here')
+    parser.add_argument('--baseline', default=None, help='compare against this results JSON')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+    skip = args.skip.split(',')
+    S = femtosim.plant(hutch=args.hutch, latency=args.latency)
+    femtosim.install(S)
+    os.environ['FS_CONFIG_PATH'] = os.path.join(HERE, '')
+    logging.basicConfig(level=logging.WARNING) # keeps femto.py off /reg/d
+    sys.path.insert(0, HERE)
+    S.start()
+    results = dict()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            if 'femto' not in skip:
+                results['femto'] = bench_femto(S, args.hutch, args.warmup, args.window, args.fix_timeout)
+        if 'time_tool' not in skip:
+            results['time_tool'] = bench_time_tool(S, args.hutch, args.calls)
+        if 'pcav2cast' not in skip:
+            results['pcav2cast'] = bench_pcav2cast(S, args.steps)
+    finally:
+        S.stop()
+    out = dict(config=dict(hutch=args.hutch, latency=args.latency, python=sys.version.split()[0],
+                           date=time.strftime('%Y-%m-%d %H:%M:%S')), results=results)
+    txt = json.dumps(out, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as file:
+            file.write(txt + '\n')
+    print(txt)
+    if S.stats['stale']:
+        print('STALE READS', S.stats['stale'], 'values read before their queued get completed')
+        sys.exit(1)
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        bad = compare(out, baseline, args.tolerance)
+        for b in bad:
+            print('REGRESSION', b)
+        if bad:
+            sys.exit(1)
+        print('no regressions against', args.baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+#plant.py
+""" Physics model behind the simulated PVs.
+
+The laser time seen by the SR620 follows the same sawtooth / 3.808 GHz bucket
+model as femto.sawtooth: the phase motor shifts the 68 MHz pulse train, the EVR
+trigger picks which pulse the counter sees. The hidden offset drifts, carries
+counter noise, and jumps by whole 3.808 GHz buckets when asked to.
+
+Every other PV is a plain memory record, created on first use. Alarm and limit
+fields default wide open so range checks pass unless a test sets them.
+"""
+
+import json
+import math
+import os
+import re
+import threading
+import time
+import numpy as np
+
+
+class plant():
+    """Holds the PV database and advances the laser, motor, counter, time tool and phase cavity models."""
+    def __init__(self, hutch=None, config_path=None, latency=0.0, noise=0.005, drift=0.0, jump_rate=0.0,
+                 counter_rate=5.0, motor_speed=10000.0, target=0.0, seed=0):
+        """Takes the hutch name, CA latency (s per round trip), counter noise (ns rms), offset drift (ns/s),
+        random bucket jump rate (per s), counter update rate (Hz), motor speed (ps/s) and starting target time (ns)."""
+        self.laser_f = 0.068 # 68MHz laser frequency, same constants as femto.locker
+        self.locking_f = 3.808 # 3.808GHz locking frequency
+        self.trigger_f = 0.119 # 119MHz trigger frequency
+        self.period = 1 / self.laser_f
+        self.latency = latency
+        self.noise = noise
+        self.drift = drift
+        self.jump_rate = jump_rate
+        self.counter_rate = counter_rate
+        self.motor_speed = motor_speed
+        self.rng = np.random.RandomState(seed)
+        self.lock = threading.RLock()
+        self.db = dict() # PV name -> value
+        self.stamp = dict() # PV name -> time of last change
+        self.subscribers = dict() # PV name -> list of functions called with the new value
+        self.missing = set() # PV names that never connect
+        self.faults = dict() # PV name -> number of upcoming operations that fail
+        self.stats = dict(get=0, get_nowait=0, put=0, put_nowait=0, pend=0, connect=0, stale=0) # requests served, and values read before their queued get completed
+        self.cpu = 0.0 # CPU seconds used by the background thread, so benchmarks can leave it out
+        self.writes = [] # (time, name, value) log of every put, for benchmarks
+        self.thread = None
+        self.running = False
+        self.now = time.time()
+        self.next_sample = self.now
+        self.delay = 12.3 # ns, true cable delay after the trigger
+        self.offset = 7.7 # ns, true photodiode to counter offset, drifts and jumps
+        self.jumps = 0 # total bucket jumps injected
+        self.target = target
+        self.base = None
+        if hutch is not None:
+            self.load_config(hutch, config_path)
+        self.tt_drift = 0.0 # ps, x-ray / laser drift seen by the time tool
+        self.pcav_drift = dict() # per PCAV record drift in ps
+        for n in range(1, 3):
+            self.db['LAS:UND:MMS:0%d' % n] = 0.0 # CAST phase shifters
+            self.db['LAS:UND:MMS:0%d.RBV' % n] = 0.0
+        for line, gain in [('UNDH', 2.0), ('UNDS', 1.1283)]: # pcav2cast feedback settings
+            self.db['LAS:%s:FLOAT:05' % line] = 1 # feedback enable
+            self.db['LAS:%s:FLOAT:50' % line] = 1.0 # error difference threshold
+            self.db['LAS:%s:FLOAT:92' % line] = gain
+            self.db['LAS:%s:FLOAT:93' % line] = 0.5 # loop gain
+            self.db['LAS:%s:FLOAT:94' % line] = 5.0 # loop pause
+
+    def load_config(self, hutch, config_path=None):
+        """Takes a hutch name, reads its locker config and sets up the locker PVs at a locked operating point."""
+        if config_path is None:
+            config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '')
+        with open(config_path + hutch + '_locker_config.json', 'r') as file:
+            config = json.load(file)
+        self.base = str(config['base'])
+        self.vit = self.base + 'VIT:'
+        self.counter = self.base + 'CNT:TI:'
+        self.motor = self.base + 'MMS:PH'
+        self.trigger = str(config['laser_trigger'])
+        db = self.db
+        db[self.vit + 'FS_TRIGGER_DELAY'] = self.delay # start calibrated
+        db[self.vit + 'FS_TIMING_OFFSET'] = self.offset
+        db[self.vit + 'FS_ENABLE_TIME_CTRL'] = 1
+        db[self.vit + 'FS_ENABLE_BUCKET_FIX'] = 1
+        db[self.vit + 'FS_ENABLE_TRIGGER'] = 1
+        db[self.vit + 'PHASE_LOCKED'] = 1
+        db[self.vit + 'FS_OSC_TGT_FREQ'] = 68000000.0
+        db[self.vit + 'FREQ_SP'] = 68000000.0
+        db[self.vit + 'DRIFT_CORRECT_SMOOTH'] = 10.0
+        db[self.vit + 'DRIFT_CORRECT_GAIN'] = 1.0
+        db[self.vit + 'DRIFT_CORRECT_ACCUM'] = 1
+        db[self.counter + 'GetMeasJitter.HIGH'] = 1e-10 # s
+        self.set_target(self.target)
+        self.sample()
+
+    def set_target(self, t):
+        """Takes a target time in ns, puts motor and trigger where femto.locker.set_time would."""
+        nlaser = np.floor((t - self.offset) * self.laser_f)
+        pc = np.mod(t - (self.offset + nlaser / self.laser_f), self.period)
+        ntrig = round((t - self.delay - (1 / self.trigger_f)) * self.trigger_f)
+        self.db[self.vit + 'FS_TGT_TIME'] = t
+        self.db[self.trigger] = ntrig / self.trigger_f
+        self.db[self.motor] = pc * 1000.0 # motor is in ps
+        self.db[self.motor + '.RBV'] = pc * 1000.0
+        self.db[self.motor + '.DMOV'] = 1
+
+    def laser_time(self):
+        """Returns the true laser time in ns for the current motor readback and trigger."""
+        t0 = self.db[self.motor + '.RBV'] / 1000.0
+        trig_out = self.db[self.trigger] + self.delay
+        offset = self.offset + self.jumps / self.locking_f
+        nlaser = np.ceil((trig_out - (t0 + offset)) / self.period)
+        return t0 + offset + nlaser * self.period
+
+    def inject_jump(self, n=1):
+        """Takes a number of buckets, shifts the laser by that many 3.808 GHz periods."""
+        with self.lock:
+            self.jumps += n
+
+    def fail(self, name, count=1):
+        """Takes a PV name, makes its next count operations fail as a CA timeout would."""
+        with self.lock:
+            self.faults[name] = self.faults.get(name, 0) + count
+
+    # PV access, used by pv.py
+
+    def default(self, name):
+        """Returns the value a PV starts with the first time it is used."""
+        if name.endswith('.HIHI') or name.endswith('.HIGH') or name.endswith('.HOPR'):
+            return 1e9
+        if name.endswith('.LOLO') or name.endswith('.LOW') or name.endswith('.LOPR'):
+            return -1e9
+        if name.endswith('.DESC') or name.endswith('FS_STATUS'):
+            return ''
+        if name.endswith('.DMOV'):
+            return 1
+        return 0.0
+
+    def check(self, name):
+        """Takes a PV name, raises IOError if it is missing or has a fault queued."""
+        if name in self.missing:
+            raise IOError('simulated PV not found: ' + name)
+        if self.faults.get(name, 0) > 0:
+            self.faults[name] -= 1
+            raise IOError('simulated CA timeout: ' + name)
+
+    def read(self, name):
+        """Takes a PV name, returns its current value."""
+        with self.lock:
+            self.check(name)
+            self.advance()
+            if name not in self.db:
+                self.db[name] = self.dynamic(name)
+            return self.db[name]
+
+    def write(self, name, value):
+        """Takes a PV name and value, stores it and lets the model react."""
+        with self.lock:
+            self.check(name)
+            self.advance()
+            self.writes.append((time.time(), name, value))
+            if name == getattr(self, 'motor', None):
+                value = float(value)
+                if value != self.db.get(name):
+                    self.set(self.motor + '.DMOV', 0)
+            m = re.match(r'^(LAS:UND:MMS:0\d)$', name)
+            if m:
+                self.set(name + '.RBV', value) # CAST phase shifter settles within a cycle
+            self.set(name, value)
+
+    def set(self, name, value):
+        """Takes a PV name and value, stores it and posts a monitor update if it changed."""
+        old = self.db.get(name)
+        self.db[name] = value
+        changed = True
+        try:
+            changed = bool(np.any(old != value))
+        except Exception:
+            pass
+        if changed or old is None:
+            self.stamp[name] = self.now
+            for fn in self.subscribers.get(name, []):
+                fn(value)
+
+    def subscribe(self, name, fn):
+        """Takes a PV name and a function, calls the function with the value on every change."""
+        with self.lock:
+            self.subscribers.setdefault(name, []).append(fn)
+
+    def dynamic(self, name):
+        """Takes a PV name not yet in the database, returns its starting value (model driven PVs are computed)."""
+        if name.endswith('TTALL'):
+            return self.tt_array()
+        if re.match(r'^SIOC:UND.:PT01:0:TIME\d$', name):
+            return self.pcav(name)
+        return self.default(name)
+
+    # Physics
+
+    def start(self, dt=0.002):
+        """Takes a step size in s, advances the model on a background thread so monitors fire without reads."""
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(dt,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stops the background thread."""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self, dt):
+        """Background loop."""
+        clock = getattr(time, 'thread_time', None) # python 3.7+
+        while self.running:
+            start = clock() if clock else 0
+            with self.lock:
+                self.advance()
+            if clock:
+                self.cpu += clock() - start
+            time.sleep(dt)
+
+    def advance(self):
+        """Advances the model to the current wall clock time."""
+        now = time.time()
+        dt = now - self.now
+        if dt <= 0:
+            return
+        self.now = now
+        if self.jump_rate > 0 and self.rng.rand() < self.jump_rate * dt:
+            self.jumps += self.rng.choice([-1, 1])
+        self.offset += self.drift * dt
+        self.tt_drift += 0.01 * math.sqrt(dt) * self.rng.randn()
+        if self.base is not None:
+            self.move_motor(dt)
+        if now >= self.next_sample: # new counter / time tool / phase cavity readings
+            self.next_sample = now + 1.0 / self.counter_rate
+            self.sample()
+
+    def move_motor(self, dt):
+        """Takes a time step in s, moves the phase motor readback toward the set point."""
+        target = self.db[self.motor]
+        rbv = self.db[self.motor + '.RBV']
+        step = self.motor_speed * dt
+        if abs(target - rbv) <= step:
+            if rbv != target or not self.db[self.motor + '.DMOV']:
+                self.set(self.motor + '.RBV', target)
+                self.set(self.motor + '.DMOV', 1)
+        else:
+            self.set(self.motor + '.RBV', rbv + math.copysign(step, target - rbv))
+
+    def sample(self):
+        """Posts a fresh counter reading, time tool shot and phase cavity reading."""
+        if self.base is not None:
+            jitter = self.noise * (1 + 0.2 * self.rng.randn())
+            t = self.laser_time() + self.noise * self.rng.randn()
+            self.set(self.counter + 'GetOffsetInvMeasMean', t * 1e-9) # counter reads seconds
+            self.set(self.counter + 'GetMeasJitter', abs(jitter) * 1e-9)
+        for name in list(self.db.keys()):
+            if name.endswith('TTALL'):
+                self.set(name, self.tt_array())
+            elif re.match(r'^SIOC:UND.:PT01:0:TIME\d$', name):
+                self.set(name, self.pcav(name))
+
+    def tt_array(self):
+        """Returns a time tool TTALL array: pix, fs, amp, amp_second, ref, FWHM, ..."""
+        fs = 1000.0 * self.tt_drift + 10 * self.rng.randn() # fs
+        return np.array([500 + fs / 5.0, fs, 0.05, 0.01, 1000.0, 50.0, 0.0, 0.0])
+
+    def pcav(self, name):
+        """Takes a phase cavity PV name, returns its reading in ps: drift plus the CAST phase shifter correction."""
+        shifter = 'LAS:UND:MMS:02' if ':UNDH:' in name else 'LAS:UND:MMS:01'
+        drift = self.pcav_drift.get(name, 0.0) + 0.002 * self.rng.randn()
+        self.pcav_drift[name] = drift
+        return drift + self.db[shifter + '.RBV'] / 2.0 + 0.001 * self.rng.randn()
@@ -0,0 +1,356 @@
+#pv.py
+""" Fake EPICS client modules backed by a femtosim plant.
+
+install(plant) registers stand-ins for psp.Pv, pyca and epics (pyepics) in
+sys.modules, so femto.py, time_tool.py and pcav2cast_*.py import them
+unchanged. Every synchronous get/put and every pend_io costs one simulated
+round trip of plant.latency seconds and is counted in plant.stats.
+
+Queued gets and puts (timeout=None) behave like pyca's callback requests, and
+connect(timeout=None) like a connection handler: a CA thread completes each
+one after its own round trip (0.5 to 1.5 latencies,
+in order per channel) and then calls the Pv's getevt_cb / putevt_cb. pend_io
+does not wait for them, as ca_pend_io does not. Reading a Pv's value while
+its queued get is still in flight counts as a stale read in plant.stats.
+"""
+
+import heapq
+import itertools
+import random
+import sys
+import threading
+import time
+import traceback
+import types
+
+PLANT = None # plant served by the fake modules
+queue = [] # (due, seq, function) requests in flight, completed by the CA thread
+queue_cond = threading.Condition()
+seq = itertools.count() # keeps the heap order stable for equal due times
+ca_thread = None
+rng = random.Random(0) # round trip lengths
+
+
+class pyexc(Exception):
+    """Stands in for pyca.pyexc."""
+    pass
+
+
+class caexc(Exception):
+    """Stands in for pyca.caexc."""
+    pass
+
+
+def round_trip(kind):
+    """Takes the kind of request, counts it and waits one simulated CA round trip."""
+    PLANT.stats[kind] += 1
+    if PLANT.latency > 0:
+        time.sleep(PLANT.latency)
+
+
+def later(pv, fn):
+    """Takes a Pv and a function, runs fn from the CA thread after the request's own round trip, after the channel's earlier requests."""
+    global ca_thread
+    delay = PLANT.latency * rng.uniform(0.5, 1.5) + 0.0005 # never done by the time the call returns
+    with queue_cond:
+        due = max(time.time() + delay, pv.last_due) # one channel's requests complete in order, as on its TCP circuit
+        pv.last_due = due
+        heapq.heappush(queue, (due, next(seq), fn))
+        if ca_thread is None:
+            ca_thread = threading.Thread(target=ca_loop, name='fake-ca')
+            ca_thread.daemon = True
+            ca_thread.start()
+        queue_cond.notify()
+
+
+def ca_loop():
+    """CA thread: completes queued requests when they are due."""
+    while True:
+        with queue_cond:
+            while not queue:
+                queue_cond.wait()
+            due = queue[0][0]
+            now = time.time()
+            if due > now:
+                queue_cond.wait(due - now)
+                continue
+            fn = heapq.heappop(queue)[2]
+        try:
+            fn()
+        except Exception: # a bad callback mustn't stop the other completions
+            traceback.print_exc()
+
+
+class Pv():
+    """psp.Pv stand-in: same attributes and call signatures as used by the fstiming scripts."""
+    def __init__(self, name, initialize=False, **kw):
+        self.name = name
+        self.data = None # value, read through the value property
+        self.outstanding = 0 # queued gets in flight
+        self.delivering = False # inside a monitor callback
+        self.last_due = 0 # completion time of the channel's last queued request
+        self.secs = 0
+        self.nsec = 0
+        self.status = 0
+        self.severity = 0
+        self.isconnected = False
+        self.ismonitored = False
+        self.monitor_cbs = dict() # id -> function
+        self.next_cb = 0
+        if initialize:
+            self.connect(timeout=1.0)
+
+    def connect(self, timeout=None):
+        """Connects the channel. With a timeout, waits one round trip and raises if the PV does not exist; without one, the CA thread connects it later."""
+        if timeout is None or timeout <= 0:
+            later(self, self.connected)
+            return
+        round_trip('connect')
+        if self.name in PLANT.missing:
+            raise pyexc('connection timed out: ' + self.name)
+        self.isconnected = True
+
+    def connected(self):
+        """CA thread: the connection handler of a channel started without waiting."""
+        if self.name not in PLANT.missing:
+            self.isconnected = True
+
+    def disconnect(self):
+        """Disconnects the channel."""
+        self.isconnected = False
+        self.ismonitored = False
+
+    @property
+    def value(self):
+        if self.outstanding and not self.delivering and threading.current_thread() is not ca_thread:
+            PLANT.stats['stale'] += 1 # read before the queued get completed
+        return self.data
+
+    @value.setter
+    def value(self, x):
+        self.data = x
+
+    def drain(self):
+        """Waits for the channel's queued requests, a synchronous request goes out behind them."""
+        wait = self.last_due - time.time()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, value):
+        """Takes a new value, stores it with a timestamp."""
+        self.value = value
+        stamp = PLANT.stamp.get(self.name, time.time())
+        self.secs = int(stamp)
+        self.nsec = int((stamp - self.secs) * 1e9)
+
+    def get(self, ctrl=None, timeout=None, **kw):
+        """Reads the value. timeout=None queues the read until the next pend_io."""
+        if not self.isconnected:
+            self.connect(timeout=timeout if timeout is not None else 1.0)
+        if timeout is None:
+            PLANT.stats['get_nowait'] += 1
+            self.outstanding += 1
+            later(self, self.get_done)
+            return None
+        self.drain()
+        round_trip('get')
+        try:
+            self.update(PLANT.read(self.name))
+        except IOError as e:
+            raise pyexc(str(e))
+        return self.value
+
+    def get_done(self):
+        """CA thread: completes a queued get and calls the pyca get callback."""
+        err = None
+        try:
+            self.update(PLANT.read(self.name))
+        except IOError as e:
+            err = pyexc(str(e))
+        self.outstanding -= 1
+        cb = getattr(self, 'getevt_cb', None)
+        if cb is not None:
+            cb(err)
+
+    def put(self, value, timeout=None, **kw):
+        """Writes the value. timeout=None queues the write, it completes later on the CA thread."""
+        if not self.isconnected:
+            self.connect(timeout=1.0)
+        if timeout is None:
+            PLANT.stats['put_nowait'] += 1 # one message on the wire, no wait
+            later(self, lambda: self.put_done(value))
+            return
+        self.drain()
+        round_trip('put')
+        try:
+            PLANT.write(self.name, value)
+        except IOError as e:
+            raise pyexc(str(e))
+        self.value = value
+
+    def put_done(self, value):
+        """CA thread: completes a queued put and calls the pyca put callback."""
+        err = None
+        try:
+            PLANT.write(self.name, value)
+        except IOError as e:
+            err = pyexc(str(e))
+        cb = getattr(self, 'putevt_cb', None)
+        if cb is not None:
+            cb(err)
+
+    def monitor(self, mask=None, ctrl=False, count=None, wait_first=False):
+        """Subscribes to value updates."""
+        if not self.ismonitored:
+            self.ismonitored = True
+            PLANT.subscribe(self.name, self.monitor_event)
+
+    def monitor_start(self, *args, **kw):
+        """Old name for monitor()."""
+        self.monitor()
+
+    def monitor_stop(self):
+        """Stops delivering monitor updates."""
+        self.ismonitored = False
+
+    def add_monitor_callback(self, cb, once=False):
+        """Takes a function called as cb(e) on every monitor update (e is None on success)."""
+        self.next_cb += 1
+        self.monitor_cbs[self.next_cb] = cb
+        return self.next_cb
+
+    def del_monitor_callback(self, id):
+        """Takes an id from add_monitor_callback, stops calling that function."""
+        self.monitor_cbs.pop(id, None)
+
+    def monitor_event(self, value):
+        """Called by the plant when the PV changes."""
+        if not self.ismonitored:
+            return
+        self.update(value)
+        self.delivering = True
+        try:
+            for cb in list(self.monitor_cbs.values()):
+                cb(None)
+        finally:
+            self.delivering = False
+
+    def timestamp(self):
+        """Returns (secs, nsec) of the last update."""
+        return (self.secs, self.nsec)
+
+
+def flush_io():
+    """pyca.flush_io stand-in, queued requests go out with the next pend_io."""
+    pass
+
+
+def pend_io(timeout=None):
+    """pyca.pend_io stand-in: one round trip. Like ca_pend_io it does not wait for queued (callback) gets and puts."""
+    round_trip('pend')
+
+
+def attach_context():
+    """pyca.attach_context stand-in, the simulation has no CA context."""
+    pass
+
+
+def pend_event(timeout=None):
+    """pyca.pend_event stand-in."""
+    if timeout:
+        time.sleep(timeout)
+
+
+class PV():
+    """pyepics PV stand-in."""
+    def __init__(self, pvname, callback=None, auto_monitor=None, **kw):
+        self.pvname = pvname
+        self.callbacks = dict()
+        self.connected = pvname not in PLANT.missing
+        if callback is not None:
+            self.add_callback(callback)
+
+    @property
+    def value(self):
+        return self.get()
+
+    def get(self, timeout=None, **kw):
+        """Reads the value, one round trip."""
+        round_trip('get')
+        try:
+            return PLANT.read(self.pvname)
+        except IOError:
+            return None
+
+    def put(self, value, wait=False, timeout=None, callback=None, **kw):
+        """Writes the value, calls callback(pvname=...) once the plant has it."""
+        round_trip('put')
+        try:
+            PLANT.write(self.pvname, value)
+        except IOError:
+            return -1 # as pyepics does on a timeout
+        if callback is not None:
+            callback(pvname=self.pvname)
+        return 1
+
+    def add_callback(self, callback, **kw):
+        """Takes a function called as callback(pvname=, value=, timestamp=, severity=) on every update."""
+        idx = len(self.callbacks)
+        self.callbacks[idx] = callback
+        name = self.pvname
+        def event(value):
+            if idx in self.callbacks:
+                callback(pvname=name, value=value, timestamp=PLANT.stamp.get(name, time.time()), severity=0)
+        PLANT.subscribe(name, event)
+        return idx
+
+    def remove_callback(self, idx):
+        """Takes a callback index, stops calling it."""
+        self.callbacks.pop(idx, None)
+
+    def wait_for_connection(self, timeout=None):
+        """Returns True if the PV exists in the simulation."""
+        return self.connected
+
+    def disconnect(self):
+        """Drops all callbacks."""
+        self.callbacks.clear()
+
+
+def caget(pvname, timeout=None, **kw):
+    """pyepics caget stand-in."""
+    return PV(pvname).get(timeout=timeout)
+
+
+def caput(pvname, value, wait=False, timeout=None, **kw):
+    """pyepics caput stand-in."""
+    return PV(pvname).put(value, wait=wait, timeout=timeout)
+
+
+def cainfo(pvname, print_out=True, **kw):
+    """pyepics cainfo stand-in."""
+    txt = '%s = %s' % (pvname, caget(pvname))
+    if print_out:
+        print(txt)
+    return txt
+
+
+def install(plant):
+    """Takes a plant, registers fake psp, psp.Pv, pyca and epics modules that serve it."""
+    global PLANT
+    PLANT = plant
+    this = sys.modules[__name__]
+    psp = types.ModuleType('psp')
+    psp_pv = types.ModuleType('psp.Pv')
+    psp_pv.Pv = Pv
+    psp.Pv = psp_pv
+    pyca = types.ModuleType('pyca')
+    epics = types.ModuleType('epics')
+    for k in ['flush_io', 'pend_io', 'pend_event', 'attach_context', 'pyexc', 'caexc']:
+        setattr(pyca, k, getattr(this, k))
+    for k in ['PV', 'caget', 'caput', 'cainfo']:
+        setattr(epics, k, getattr(this, k))
+    sys.modules['psp'] = psp
+    sys.modules['psp.Pv'] = psp_pv
+    sys.modules['pyca'] = pyca
+    sys.modules['epics'] = epics
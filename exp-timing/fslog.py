@@ -0,0 +1,185 @@
+#fslog.py
+""" Non-blocking logging shared by the fstiming scripts.
+
+A log call formats its record and puts it on a bounded queue; a daemon thread
+writes the queue to the real handlers (size rotated log files, stdout). The
+control loop never waits for NFS or a slow console: if the queue fills up
+the record is dropped and counted, and the writer notes how many were lost.
+Warnings and errors are rate limited per message template, so a PV that keeps
+failing doesn't flood the log. Set FS_LOG_JSON=1 to write JSON lines instead
+of text.
+
+Works with python 2.7 (femto.py, time_tool.py) and 3 (pcav2cast).
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+text_format = '%(asctime)s - %(levelname)s - %(message)s' # same as the old femto.log
+date_format = '%Y-%m-%d %H:%M'
+
+
+class json_formatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+    def format(self, record):
+        d = dict(t=round(record.created, 3), time=self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), level=record.levelname,
+                 thread=record.threadName, msg=record.getMessage())
+        if record.exc_text:
+            d['exc'] = record.exc_text
+        return json.dumps(d)
+
+
+class rate_limit(logging.Filter):
+    """Passes at most burst records per message template and period, from level up, then notes how many it held back."""
+    def __init__(self, period=60.0, burst=5, level=logging.WARNING):
+        """Takes the period in s, the records let through per period and the lowest level limited."""
+        logging.Filter.__init__(self)
+        self.period = period
+        self.burst = burst
+        self.level = level
+        self.seen = dict() # (level, template) -> [period start, records passed, records held back]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno < self.level:
+            return True
+        key = (record.levelno, str(record.msg)) # the template, before its arguments are filled in
+        now = time.time()
+        with self.lock:
+            s = self.seen.get(key)
+            if s is None or now - s[0] >= self.period:
+                held = s[2] if s is not None else 0
+                self.seen[key] = [now, 1, 0]
+                if held:
+                    record.msg = str(record.msg) + ' [%d similar messages suppressed]' % held
+                return True
+            if s[1] < self.burst:
+                s[1] += 1
+                return True
+            s[2] += 1
+            return False
+
+
+class queue_handler(logging.Handler):
+    """Puts records on a queue for the writer thread, never blocks."""
+    def __init__(self, q):
+        """Takes the queue."""
+        logging.Handler.__init__(self)
+        self.q = q
+        self.dropped = 0 # records lost because the queue was full
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage() # format now, the arguments may change before the writer gets to it
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.q.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class writer(threading.Thread):
+    """Drains the queue into the handlers that do the writing."""
+    def __init__(self, source, handlers):
+        """Takes the queue_handler feeding the queue and the handlers to write to."""
+        threading.Thread.__init__(self, name='fslog')
+        self.daemon = True
+        self.source = source
+        self.handlers = handlers
+        self.reported = 0 # dropped records already noted in the log
+
+    def write(self, record):
+        """Takes a record, passes it to every handler whose level and filters accept it."""
+        for h in self.handlers:
+            if record.levelno >= h.level:
+                h.handle(record)
+
+    def run(self):
+        while True:
+            record = self.source.q.get()
+            if record is None:
+                break
+            self.write(record)
+            dropped = self.source.dropped
+            if dropped != self.reported:
+                self.write(logging.makeLogRecord(dict(msg='Log queue full, dropped %d records' % (dropped - self.reported),
+                                                      levelno=logging.WARNING, levelname='WARNING')))
+                self.reported = dropped
+        for h in self.handlers:
+            h.flush()
+
+    def stop(self, timeout=2.0):
+        """Writes out what is queued and stops the thread, waiting at most timeout s."""
+        try:
+            self.source.q.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+
+def formatter():
+    """Returns the formatter for files and consoles, JSON lines if FS_LOG_JSON is set."""
+    if os.environ.get('FS_LOG_JSON', '0') not in ('', '0'):
+        return json_formatter()
+    return logging.Formatter(text_format, datefmt=date_format)
+
+
+def file_handler(path, max_bytes=10*1024*1024, backups=5):
+    """Takes a log file path, the size in bytes at which it rotates and the number of old files kept, returns the handler."""
+    h = logging.handlers.RotatingFileHandler(path, mode='a', maxBytes=max_bytes, backupCount=backups)
+    h.setFormatter(formatter())
+    return h
+
+
+def console_handler():
+    """Returns a stdout handler that prints bare messages (JSON lines if FS_LOG_JSON is set)."""
+    h = logging.StreamHandler(sys.stdout)
+    f = formatter()
+    h.setFormatter(f if isinstance(f, json_formatter) else logging.Formatter('%(message)s'))
+    return h
+
+
+def configured():
+    """Returns True if logging is already set up (the root logger has handlers), in which case start() leaves it alone like basicConfig."""
+    return bool(logging.getLogger().handlers)
+
+
+def start(handlers, level=logging.DEBUG, size=10000, period=60.0, burst=5):
+    """Takes the handlers that do the writing, routes the root logger to them through a queue of size records, returns the writer thread (None if already configured)."""
+    if configured():
+        return None
+    root = logging.getLogger()
+    source = queue_handler(queue.Queue(size))
+    source.addFilter(rate_limit(period, burst))
+    root.addHandler(source)
+    root.setLevel(level)
+    w = writer(source, handlers)
+    w.start()
+    atexit.register(w.stop) # write out what is queued at exit
+    return w
+
+
+def setup(path=None, console=False, level=logging.DEBUG):
+    """Takes a log file path and whether to also print to stdout, starts non-blocking logging to them, returns the writer thread (None if already configured)."""
+    if configured():
+        return None
+    handlers = []
+    if path is not None:
+        handlers.append(file_handler(path))
+    if console:
+        handlers.append(console_handler())
+    return start(handlers, level)
@@ -0,0 +1,117 @@
+#lockerconfig.py
+""" Reads, checks and watches <HUTCH>_locker_config.json.
+
+read() parses the file and checks it against the schema below; a file that
+doesn't parse or doesn't match comes back with a list of problems instead of
+an exception. watch notices edits by polling the file's modification time and
+size (a stat, at most once per period), so a running locker can pick them up.
+"""
+
+import json
+import os
+import time
+
+text = (str, type(u'')) # json gives unicode strings on python 2
+number = (int, float)
+
+
+def positive(x):
+    return x > 0
+
+
+def positive_values(d):
+    return all(isinstance(x, number) and x > 0 for x in d.values())
+
+
+def number_values(d):
+    return all(isinstance(x, number) and x >= 0 for x in d.values())
+
+
+schema = [ # key, types, required, value check (or None)
+    ('nm', text, True, None),
+    ('base', text, True, None),
+    ('laser_trigger', text, True, None),
+    ('drift_correction_dir', number, True, lambda x: x in (1, -1)),
+    ('use_drift_correction', bool, True, None),
+    ('use_dither', bool, True, None),
+    ('bucket_correction_delay', text, True, None),
+    ('use_pv_cache', bool, False, None),
+    ('serve_pvs', bool, False, None),
+    ('counter_window', int, False, lambda x: x >= 3),
+    ('track_offset', bool, False, None),
+    ('offset_track_q', number, False, positive),
+    ('offset_track_sigma', number, False, positive),
+    ('offset_track_step', number, False, positive),
+    ('write_deadbands', dict, False, number_values),
+    ('status_hold', number, False, lambda x: x >= 0),
+    ('state_max_age', number, False, lambda x: x >= 0),
+    ('task_periods', dict, False, positive_values),
+    ('task_deadlines', dict, False, positive_values),
+]
+
+restart_keys = ['nm', 'base', 'use_pv_cache', 'serve_pvs'] # only read at startup, a change needs a restart
+
+
+def validate(cfg):
+    """Takes a parsed config, returns a list of problems (empty if it is good)."""
+    if not isinstance(cfg, dict):
+        return ['not a JSON object']
+    problems = []
+    for key, types, required, check in schema:
+        if key not in cfg:
+            if required:
+                problems.append('missing ' + key)
+            continue
+        x = cfg[key]
+        if not isinstance(x, types) or (isinstance(x, bool) and types is not bool): # true/false is an int to python
+            problems.append('%s has the wrong type' % key)
+        elif check is not None and not check(x):
+            problems.append('%s out of range' % key)
+    return problems
+
+
+def read(path):
+    """Takes a config path, returns (config, problems). config is None if the file can't be read or parsed."""
+    try:
+        with open(path, 'r') as f:
+            cfg = json.load(f)
+    except (IOError, OSError) as e:
+        return None, ['cannot read %s: %s' % (path, e)]
+    except ValueError as e: # json.JSONDecodeError on python 3
+        return None, ['Invalid JSON syntax: %s' % e]
+    return cfg, validate(cfg)
+
+
+def changed(old, new):
+    """Takes two configs, returns the sorted keys whose values differ."""
+    return sorted(k for k in set(old) | set(new) if old.get(k) != new.get(k))
+
+
+class watch():
+    """Notices edits to a file by polling its modification time and size."""
+    def __init__(self, path, period=1.0):
+        """Takes the file path and the minimum time in s between checks."""
+        self.path = path
+        self.period = period
+        self.last_check = time.time()
+        self.stamp = self.stat()
+
+    def stat(self):
+        """Returns (modification time, size) of the file, None if it is missing."""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def changed(self):
+        """Returns True once after each edit of the file, checking at most once per period."""
+        now = time.time()
+        if now - self.last_check < self.period:
+            return False
+        self.last_check = now
+        stamp = self.stat()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        return True
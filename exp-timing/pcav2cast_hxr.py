@@ -9,8 +9,12 @@
 # source /reg/g/pcds/engineering_tools/xpp/scripts/pcds_conda
 import time
 import datetime
-import epics
+import channel
+channel.prefer('pyepics') # written for pyepics, FS_EPICS_BACKEND can choose another
+import logging
 import numpy as np
+import fslog
+import supervisor
 
 ######################################
 # HXR PV definition
@@ -33,37 +37,45 @@ HXR_ERR_DIFF_PV = 'LAS:UNDH:FLOAT:51'  # error difference PV
 # default initial values
 HXR_GAIN = 2  # 03/1/2024 cal
 PAUSE_TIME = 5    # Let's give some time for the system to react
-CTRL_OUT = epics.caget(HXR_CAST_PS_PV_R)    # initial value of the phase shifter
+CTRL_OUT = 0    # read in init()
 AVG_N = 5    # Taking 5 data samples to average and throw out outliers
-HXR_FB_EN = epics.caget(HXR_FB_PV)
+HXR_FB_EN = 0    # read in init()
 COUNTER = 0
-epics.caput(HB_PV, COUNTER)
 TIME_ERR_AVG_PREV = 0
-epics.caput(HXR_NAN_PV, 0)
-epics.caput(HXR_NAN_PVDESC, 'No NAN read')
 NAN_ALERT = 0
 
-# We are doing an exponential fb loop, where the output = output[-1] + (-gain * error)
-# Latch in the value before starting the feedback, this will be value we correct to
-CTRL_SETPT = epics.caget(HXR_PCAV_PV0)
+CTRL_SETPT = 0    # read in init()
 
 time_err_ary = np.zeros((AVG_N,))
 PCAV_temp_ary = np.zeros(2,)
 
-print('pcav2cast_sxr running test update 6/19/2025')
 
-# Main loop
-while True:
-    HXR_GAIN = epics.caget(HXR_GAIN_PV)
-    PV_PAUSE_TIME = epics.caget(HXR_LOOP_PAUSE_PV)
-    LOOP_KP = epics.caget(HXR_LOOP_GAIN_PV)
-    COUNTER = epics.caget(HB_PV)
-    TIME_ERR_THRESH = epics.caget(HXR_THRESH_PV)  # error threshold
+def init():
+    """Reads the starting phase shifter and PCAV values, resets the heartbeat and NaN alert PVs."""
+    global CTRL_OUT, HXR_FB_EN, CTRL_SETPT
+    CTRL_OUT = channel.caget(HXR_CAST_PS_PV_R)    # initial value of the phase shifter
+    HXR_FB_EN = channel.caget(HXR_FB_PV)
+    channel.caput(HB_PV, COUNTER)
+    channel.caput(HXR_NAN_PV, 0)
+    channel.caput(HXR_NAN_PVDESC, 'No NAN read')
+    # We are doing an exponential fb loop, where the output = output[-1] + (-gain * error)
+    # Latch in the value before starting the feedback, this will be value we correct to
+    CTRL_SETPT = channel.caget(HXR_PCAV_PV0)
 
-    print(COUNTER)
+
+def feedback_step():
+    """One pass of the feedback loop: averages the PCAV error and writes the phase shifter correction."""
+    global HXR_GAIN, PAUSE_TIME, LOOP_KP, COUNTER, TIME_ERR_THRESH, NAN_ALERT, TIME_ERR_AVG_PREV, CTRL_OUT, HXR_FB_EN
+    HXR_GAIN = channel.caget(HXR_GAIN_PV)
+    PV_PAUSE_TIME = channel.caget(HXR_LOOP_PAUSE_PV)
+    LOOP_KP = channel.caget(HXR_LOOP_GAIN_PV)
+    COUNTER = channel.caget(HB_PV)
+    TIME_ERR_THRESH = channel.caget(HXR_THRESH_PV)  # error threshold
+
+    logging.info('%s', COUNTER)
     for h in range(0, AVG_N):
-        PCAV_temp_ary[0,] = epics.caget(HXR_PCAV_PV0)
-        PCAV_temp_ary[1,] = epics.caget(HXR_PCAV_PV0)   # HXR PCAV 1 used for SXR feedback
+        PCAV_temp_ary[0,] = channel.caget(HXR_PCAV_PV0)
+        PCAV_temp_ary[1,] = channel.caget(HXR_PCAV_PV0)   # HXR PCAV 1 used for SXR feedback
         PCAV_VAL = np.average(PCAV_temp_ary)
         if np.isnan(PCAV_VAL):
             PCAV_VAL = 0
@@ -75,16 +87,16 @@ while True:
         time.sleep(0.1)
     # Check for NaN values in the array
     if NAN_ALERT == 1:
-        epics.caput(HXR_NAN_PV, NAN_ALERT)
-        epics.caput(HXR_NAN_PVDESC, "NaN Detected")
+        channel.caput(HXR_NAN_PV, NAN_ALERT)
+        channel.caput(HXR_NAN_PVDESC, "NaN Detected")
     else:
-        epics.caput(HXR_NAN_PV, NAN_ALERT)
-        epics.caput(HXR_NAN_PVDESC, "No NaN")
+        channel.caput(HXR_NAN_PV, NAN_ALERT)
+        channel.caput(HXR_NAN_PVDESC, "No NaN")
 
     time_err_ary_sort = np.sort(time_err_ary)
     time_err_ary_sort1 = time_err_ary_sort[1:-1]    # remove the outliers
     TIME_ERR_AVG = np.mean(time_err_ary_sort1)
-    epics.caput(HXR_PCAV_AVG_PV, TIME_ERR_AVG)
+    channel.caput(HXR_PCAV_AVG_PV, TIME_ERR_AVG)
 
     if COUNTER == 0:
         TIME_ERR_DIFF = 0.01
@@ -95,26 +107,36 @@ while True:
     # cntl_temp = np.true_divide(TIME_ERR_AVG, HXR_GAIN)
     cntl_temp = np.multiply(TIME_ERR_AVG, HXR_GAIN)
     CTRL_DELTA = np.multiply(LOOP_KP, cntl_temp)
-    print(f'Previous PCAV err: {TIME_ERR_AVG_PREV}')
+    logging.info('Previous PCAV err: %s', TIME_ERR_AVG_PREV)
     # print('previous error')
     # print(TIME_ERR_AVG_PREV)
-    print(f'PCAV err diff: {TIME_ERR_DIFF}')
+    logging.info('PCAV err diff: %s', TIME_ERR_DIFF)
     # print('error difference')
     # print(TIME_ERR_DIFF)
-    HXR_FB_EN = epics.caget(HXR_FB_PV)  # get feedback enable PV
+    HXR_FB_EN = channel.caget(HXR_FB_PV)  # get feedback enable PV
     if (TIME_ERR_DIFF == 0) or (abs(TIME_ERR_DIFF) >= TIME_ERR_THRESH) or (HXR_FB_EN == 0):
         CTRL_DELTA = 0
-        print('feedback set to 0')
+        logging.info('feedback set to 0')
     # else:
     #     print('feedback normal')
     CTRL_OUT = CTRL_OUT + CTRL_DELTA
-    epics.caput(HXR_ERR_DIFF_PV, CTRL_DELTA)
-    print(f'Feedback delta: {CTRL_DELTA}')
-    epics.caput(HXR_CAST_PS_PV_W, CTRL_OUT)
+    channel.caput(HXR_ERR_DIFF_PV, CTRL_DELTA)
+    logging.info('Feedback delta: %s', CTRL_DELTA)
+    channel.caput(HXR_CAST_PS_PV_W, CTRL_OUT)
     TIME_ERR_AVG_PREV = TIME_ERR_AVG
     COUNTER = COUNTER + 1
-    epics.caput(HB_PV, COUNTER)
+    channel.caput(HB_PV, COUNTER)
     now = datetime.datetime.now()
-    print(now.strftime('%Y-%m-%d-%H-%M-%S'))
-    print('=============================================')
-    time.sleep(PAUSE_TIME)
+    logging.info('%s', now.strftime('%Y-%m-%d-%H-%M-%S'))
+    logging.info('=============================================')
+
+
+if __name__ == '__main__':
+    fslog.setup(console=True)  # stdout through a queue, a slow console doesn't hold up the loop
+    init()
+    logging.info('pcav2cast_sxr running test update 6/19/2025')
+    # Main loop
+    while True:
+        feedback_step()
+        supervisor.ready() # first feedback step, for the restart latency
+        time.sleep(PAUSE_TIME)
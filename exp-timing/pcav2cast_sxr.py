@@ -9,8 +9,12 @@
 # source /reg/g/pcds/engineering_tools/xpp/scripts/pcds_conda
 import time
 import datetime
-import epics
+import channel
+channel.prefer('pyepics') # written for pyepics, FS_EPICS_BACKEND can choose another
+import logging
 import numpy as np
+import fslog
+import supervisor
 
 ######################################
 # SXR PV definition
@@ -33,20 +37,15 @@ SXR_CTRL_DELTA_PV = 'LAS:UNDS:FLOAT:51'  # error difference PV
 # init values
 SXR_GAIN = 1.1283  # slope from plotting cast phase shifter v. PCAV value 
 PAUSE_TIME = 5    # Let's give some time for the system to react
-CTRL_OUT = epics.caget(SXR_CAST_PS_PV_R)    # initial value of the phase shifter
+CTRL_OUT = 0    # read in init()
 AVG_N = 5    # Taking 5 data samples to average and throw out outliers
-# epics.caput(SXR_THRESH_PV, 1)  # set the error threshold to 1
-SXR_FB_EN = epics.caget(SXR_FB_PV)
+# channel.caput(SXR_THRESH_PV, 1)  # set the error threshold to 1
+SXR_FB_EN = 0    # read in init()
 COUNTER = 0
-epics.caput(HB_PV, COUNTER)
 TIME_ERR_AVG_PREV = 0
-epics.caput(SXR_NAN_PV, 0)
-epics.caput(SXR_NAN_PVDESC, 'No NaN read')
 NAN_ALERT = 0
 
-# We are doing an exponential fb loop, where the output = output[-1] + (-gain * error)
-# Latch in the value before starting the feedback, this will be value we correct to
-CTRL_SETPT = epics.caget(SXR_PCAV_PV1)
+CTRL_SETPT = 0    # read in init()
 
 time_err_ary = np.zeros((AVG_N,))
 PCAV_temp_ary = np.zeros(2,)
@@ -59,21 +58,34 @@ HXR_CAST_PS_PV_W = 'LAS:UND:MMS:02'  # Phase shifter PV write
 HXR_CAST_PS_PV_R = HXR_CAST_PS_PV_W + '.RBV'    # Phase shifter PV readback
 XPP_KP = 1.0
 
-print('pcav2cast_sxr running test update 6/25/2025')
 
-# Main loop
-while True:
-    SXR_GAIN = epics.caget(SXR_GAIN_PV)
-    PAUSE_TIME = epics.caget(SXR_LOOP_PAUSE_PV)
-    LOOP_KP = epics.caget(SXR_LOOP_GAIN_PV)
-    COUNTER = epics.caget(HB_PV)
-    TIME_ERR_THRESH = epics.caget(SXR_THRESH_PV)  # error difference threshold
-    XPP_KP = epics.caget(XPP_GAIN_PV)
+def init():
+    """Reads the starting phase shifter and PCAV values, resets the heartbeat and NaN alert PVs."""
+    global CTRL_OUT, SXR_FB_EN, CTRL_SETPT
+    CTRL_OUT = channel.caget(SXR_CAST_PS_PV_R)    # initial value of the phase shifter
+    SXR_FB_EN = channel.caget(SXR_FB_PV)
+    channel.caput(HB_PV, COUNTER)
+    channel.caput(SXR_NAN_PV, 0)
+    channel.caput(SXR_NAN_PVDESC, 'No NaN read')
+    # We are doing an exponential fb loop, where the output = output[-1] + (-gain * error)
+    # Latch in the value before starting the feedback, this will be value we correct to
+    CTRL_SETPT = channel.caget(SXR_PCAV_PV1)
 
-    print(COUNTER)
+
+def feedback_step():
+    """One pass of the feedback loop: averages the PCAV error and writes the phase shifter correction."""
+    global SXR_GAIN, PAUSE_TIME, LOOP_KP, COUNTER, TIME_ERR_THRESH, XPP_KP, NAN_ALERT, TIME_ERR_AVG_PREV, CTRL_OUT, SXR_FB_EN
+    SXR_GAIN = channel.caget(SXR_GAIN_PV)
+    PAUSE_TIME = channel.caget(SXR_LOOP_PAUSE_PV)
+    LOOP_KP = channel.caget(SXR_LOOP_GAIN_PV)
+    COUNTER = channel.caget(HB_PV)
+    TIME_ERR_THRESH = channel.caget(SXR_THRESH_PV)  # error difference threshold
+    XPP_KP = channel.caget(XPP_GAIN_PV)
+
+    logging.info('%s', COUNTER)
     for h in range(0, AVG_N):
-        PCAV_temp_ary[0,] = epics.caget(SXR_PCAV_PV1)   # One PCAV used for SXR feedback
-        PCAV_temp_ary[1,] = epics.caget(SXR_PCAV_PV1)
+        PCAV_temp_ary[0,] = channel.caget(SXR_PCAV_PV1)   # One PCAV used for SXR feedback
+        PCAV_temp_ary[1,] = channel.caget(SXR_PCAV_PV1)
         PCAV_VAL = np.average(PCAV_temp_ary)
         if np.isnan(PCAV_VAL):
             PCAV_VAL = 0
@@ -85,17 +97,17 @@ while True:
         time.sleep(0.1)
     # Check for NaN values in the array
     if NAN_ALERT == 1:
-        epics.caput(SXR_NAN_PV, NAN_ALERT)
-        epics.caput(SXR_NAN_PVDESC, "NaN Detected")
+        channel.caput(SXR_NAN_PV, NAN_ALERT)
+        channel.caput(SXR_NAN_PVDESC, "NaN Detected")
     else:
-        epics.caput(SXR_NAN_PV, NAN_ALERT)
-        epics.caput(SXR_NAN_PVDESC, "No NaN")
+        channel.caput(SXR_NAN_PV, NAN_ALERT)
+        channel.caput(SXR_NAN_PVDESC, "No NaN")
 
     # Calculate the average error
     time_err_ary_sort = np.sort(time_err_ary)
     time_err_ary_sort1 = time_err_ary_sort[1:-1]  # remove the outliers
     TIME_ERR_AVG = np.mean(time_err_ary_sort1)
-    epics.caput(SXR_PCAV_AVG_PV, TIME_ERR_AVG)
+    channel.caput(SXR_PCAV_AVG_PV, TIME_ERR_AVG)
 
     if COUNTER == 0:
         TIME_ERR_DIFF = 0.01
@@ -105,31 +117,41 @@ while True:
     # apply the feedback control
     cntl_temp = np.multiply(TIME_ERR_AVG, SXR_GAIN)
     CTRL_DELTA = np.multiply(LOOP_KP, cntl_temp)
-    SXR_FB_EN = epics.caget(SXR_FB_PV)  # get feedback enable PV
+    SXR_FB_EN = channel.caget(SXR_FB_PV)  # get feedback enable PV
     # don't do feedback if the error is too large or feedback is disabled
     if (TIME_ERR_DIFF == 0) or (abs(TIME_ERR_DIFF) >= TIME_ERR_THRESH) or (SXR_FB_EN == 0):
         CTRL_DELTA = 0
-        print('feedback set to 0')
+        logging.info('feedback set to 0')
     # else:
     #     print('feedback normal')
     # If the XPP switch is on, we will use the HXR PCAV value to control the SXR CAST
-    XPP_SWITCH_VAL = epics.caget(XPP_SWITCH_PV)
+    XPP_SWITCH_VAL = channel.caget(XPP_SWITCH_PV)
     if XPP_SWITCH_VAL != 0:
-        hxr_cast_val = epics.caget(HXR_CAST_PS_PV_R)
-        print('NEH RF Ref following HXR PCAV')
+        hxr_cast_val = channel.caget(HXR_CAST_PS_PV_R)
+        logging.info('NEH RF Ref following HXR PCAV')
         CTRL_OUT = np.multiply(hxr_cast_val, XPP_KP)
     else:
         CTRL_OUT = CTRL_OUT + CTRL_DELTA
-    epics.caput(SXR_CTRL_DELTA_PV, CTRL_DELTA)
+    channel.caput(SXR_CTRL_DELTA_PV, CTRL_DELTA)
     # print debug values
-    print(f'TIME_ERR_AVG: {TIME_ERR_AVG}')
-    print(f'CTRL_DELTA: {CTRL_DELTA}')
-    print(f'CTRL_OUT: {CTRL_OUT}')
-    epics.caput(SXR_CAST_PS_PV_W, CTRL_OUT)
+    logging.info('TIME_ERR_AVG: %s', TIME_ERR_AVG)
+    logging.info('CTRL_DELTA: %s', CTRL_DELTA)
+    logging.info('CTRL_OUT: %s', CTRL_OUT)
+    channel.caput(SXR_CAST_PS_PV_W, CTRL_OUT)
     TIME_ERR_AVG_PREV = TIME_ERR_AVG
     COUNTER = COUNTER + 1
-    epics.caput(HB_PV, COUNTER)
+    channel.caput(HB_PV, COUNTER)
     now = datetime.datetime.now()
-    print(now.strftime('%Y-%m-%d-%H-%M-%S'))
-    print('=============================================')
-    time.sleep(PAUSE_TIME)
+    logging.info('%s', now.strftime('%Y-%m-%d-%H-%M-%S'))
+    logging.info('=============================================')
+
+
+if __name__ == '__main__':
+    fslog.setup(console=True)  # stdout through a queue, a slow console doesn't hold up the loop
+    init()
+    logging.info('pcav2cast_sxr running test update 6/25/2025')
+    # Main loop
+    while True:
+        feedback_step()
+        supervisor.ready() # first feedback step, for the restart latency
+        time.sleep(PAUSE_TIME)
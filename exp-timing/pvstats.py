@@ -0,0 +1,101 @@
+#pvstats.py
+""" Rolling PV error counts and latency histograms with fixed memory.
+
+Errors are counted per (PV, operation) in time buckets that together span the
+report window; old buckets fall off the end, so memory is bounded by the
+number of PVs times the number of buckets. Latencies go into a fixed set of
+log spaced bins per PV. record() is a dict update and a bisect, cheap enough
+for every get and put; reports and summaries cost O(unique PVs).
+"""
+
+import bisect
+import logging
+import time
+from collections import deque
+
+
+class pv_stats():
+    """Counts PV errors over a rolling window and keeps per PV latency histograms."""
+    def __init__(self, window=600.0, buckets=10):
+        """Takes the window in s and the number of buckets it is split into."""
+        self.window = window
+        self.width = window / buckets # s per bucket
+        self.counts = deque(maxlen=buckets) # [bucket start time, {(name, op): errors}]
+        self.edges = [1e-4, 3e-4, 1e-3, 3e-3, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0] # s, latency bin upper edges
+        self.hist = dict() # name -> counts per latency bin (last bin is above the top edge), since the last report
+        self.last_report = time.time()
+        self.last_publish = 0
+
+    def record(self, name, op, ok=True, dt=None):
+        """Takes a PV name, operation ('read' or 'write'), whether it worked and how long it took in s."""
+        if not ok:
+            now = time.time()
+            if not self.counts or now - self.counts[-1][0] >= self.width:
+                self.counts.append([now, dict()]) # oldest bucket drops off
+            errs = self.counts[-1][1]
+            errs[(name, op)] = errs.get((name, op), 0) + 1
+        if dt is not None:
+            h = self.hist.get(name)
+            if h is None:
+                h = self.hist[name] = [0] * (len(self.edges) + 1)
+            h[bisect.bisect_left(self.edges, dt)] += 1
+
+    def errors(self):
+        """Returns {(name, op): errors} over the window."""
+        start = time.time() - self.window
+        total = dict()
+        for t, errs in self.counts:
+            if t + self.width < start:
+                continue
+            for k, n in errs.items():
+                total[k] = total.get(k, 0) + n
+        return total
+
+    def percentile(self, name, q):
+        """Takes a PV name and a fraction, returns the upper edge of the latency bin holding that percentile in s (None if no data)."""
+        h = self.hist.get(name)
+        if not h:
+            return None
+        target = q * sum(h)
+        seen = 0
+        for k, n in enumerate(h):
+            seen += n
+            if seen >= target:
+                return self.edges[k] if k < len(self.edges) else float('inf')
+        return None
+
+    def summary(self, maxlen=39):
+        """Returns (errors in the window, short text naming the worst PVs) for a status PV."""
+        errs = self.errors()
+        total = sum(errs.values())
+        if total == 0:
+            return 0, 'no PV errors'
+        worst = sorted(errs.items(), key=lambda x: -x[1])
+        txt = ' '.join('%s:%s%d' % (name.split(':')[-1], op[0], n) for (name, op), n in worst)
+        return total, txt[0:maxlen]
+
+    def due(self, period):
+        """Takes a period in s, returns True once per period (for rate limited publishing)."""
+        now = time.time()
+        if now - self.last_publish < period:
+            return False
+        self.last_publish = now
+        return True
+
+    def report(self, slowest=5):
+        """Logs the window's errors per PV and the slowest PVs' latency once the window has passed, then starts new histograms."""
+        if time.time() - self.last_report < self.window:
+            return
+        self.last_report = time.time()
+        errs = self.errors()
+        total = sum(errs.values())
+        if total >= 1: # If an error has occurred, print report
+            print('Current time:', time.ctime(), 'In the past', int(self.window / 60), 'minutes,', total, 'PV connection errors have occurred.')
+            logging.warning('In the past %d minutes, %s PV connection errors have occurred.', self.window / 60, total)
+            for (name, op), n in sorted(errs.items()):
+                print('PV Name/Error Type:', name+' - '+op, 'Connection Errors:', n)
+                logging.warning('PV Name/Error Type: %s - %s Connection Errors: %s', name, op, n)
+        p99 = [(self.percentile(name, 0.99), name) for name in self.hist]
+        for t, name in sorted(p99, reverse=True)[0:slowest]:
+            logging.info('PV latency %s: p50 <= %s s, p99 <= %s s, %d calls', name, self.percentile(name, 0.5), t, sum(self.hist[name]))
+        self.hist = dict()
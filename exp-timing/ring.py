@@ -0,0 +1,140 @@
+#ring.py
+""" Ring buffer with running statistics, used by the femto time interval counter.
+
+Statistics cover the most recent `window` samples (default: the whole ring) and
+are kept up to date as samples arrive instead of being recomputed from the array:
+- min / max / range: monotonic deques, amortized O(1) per sample
+- mean / variance: Welford's update with removal of the sample leaving the window
+- median: sorted copy of the window, bisect insert / remove
+- MAD: computed from the sorted window on first use after a new sample, then cached
+"""
+
+import bisect
+import math
+from collections import deque
+import numpy as np
+
+
+class ring():
+    """A fixed size ring buffer with running statistics over its most recent samples."""
+    def __init__(self, sz=12, window=None):
+        """Takes a size value and statistics window (defaults to the size), creates an array for the ring buffer."""
+        self.sz = sz  # hold size of ring
+        self.window = sz if window is None else min(window, sz)
+        self.a = np.zeros(sz)
+        self.ptr = -1 # points to last data, start negative
+        self.n = 0 # total number of elements ever added
+        self.full = False # set to true once the ring has wrapped
+        self.maxq = deque() # (index, value), values decreasing, front is the window max
+        self.minq = deque() # (index, value), values increasing, front is the window min
+        self.sorted = [] # window values in order, for the median
+        self.avg = 0.0 # running mean of the window
+        self.m2 = 0.0 # running sum of squared deviations of the window
+        self.mad_cache = None
+
+    def add_element(self, x):
+        """Takes an element, adds it to the ring and updates the window statistics."""
+        x = float(x)
+        if self.n >= self.window: # oldest sample leaves the window
+            self.remove(self.a[np.mod(self.ptr + 1 - self.window, self.sz)])
+        self.ptr = np.mod(self.ptr+1,self.sz)
+        self.a[self.ptr] = x # set this element
+        idx = self.n
+        self.n += 1
+        if self.n >= self.sz:
+            self.full = True
+        while self.maxq and self.maxq[-1][1] <= x:
+            self.maxq.pop()
+        self.maxq.append((idx, x))
+        while self.minq and self.minq[-1][1] >= x:
+            self.minq.pop()
+        self.minq.append((idx, x))
+        for q in (self.maxq, self.minq):
+            while q[0][0] <= idx - self.window:
+                q.popleft()
+        bisect.insort(self.sorted, x)
+        k = len(self.sorted) # Welford add
+        d = x - self.avg
+        self.avg += d / k
+        self.m2 += d * (x - self.avg)
+        self.mad_cache = None
+
+    def remove(self, y):
+        """Takes the value leaving the window, removes it from the mean, variance and sorted window."""
+        del self.sorted[bisect.bisect_left(self.sorted, y)]
+        k = len(self.sorted)
+        if k == 0:
+            self.avg = 0.0
+            self.m2 = 0.0
+            return
+        old = self.avg # Welford remove
+        self.avg = old - (y - old) / k
+        self.m2 = max(self.m2 - (y - old) * (y - self.avg), 0.0)
+
+    def get_last_element(self):
+        """Returns most recently added element of the buffer."""
+        return self.a[self.ptr]
+
+    def get_array(self):
+        """Returns entire ring buffer array."""
+        return self.a
+
+    def recent(self):
+        """Returns the samples in the statistics window as a list, oldest first."""
+        k = min(self.n, self.window)
+        return [float(self.a[np.mod(self.ptr - i, self.sz)]) for i in range(k - 1, -1, -1)]
+
+    @property
+    def count(self):
+        """Number of samples in the statistics window."""
+        return len(self.sorted)
+
+    @property
+    def max(self):
+        """Largest sample in the window."""
+        return self.maxq[0][1] if self.maxq else 0.0
+
+    @property
+    def min(self):
+        """Smallest sample in the window."""
+        return self.minq[0][1] if self.minq else 0.0
+
+    @property
+    def range(self):
+        """max - min over the window."""
+        return self.max - self.min
+
+    @property
+    def mean(self):
+        """Mean of the window."""
+        return self.avg
+
+    @property
+    def var(self):
+        """Sample variance of the window."""
+        k = len(self.sorted)
+        return self.m2 / (k - 1) if k > 1 else 0.0
+
+    @property
+    def std(self):
+        """Sample standard deviation of the window."""
+        return math.sqrt(self.var)
+
+    @property
+    def median(self):
+        """Median of the window."""
+        k = len(self.sorted)
+        if k == 0:
+            return 0.0
+        if k % 2:
+            return self.sorted[k // 2]
+        return 0.5 * (self.sorted[k // 2 - 1] + self.sorted[k // 2])
+
+    @property
+    def mad(self):
+        """Median absolute deviation of the window."""
+        if self.mad_cache is None:
+            if not self.sorted:
+                return 0.0
+            self.mad_cache = float(np.median(np.abs(np.array(self.sorted) - self.median)))
+        return self.mad_cache
@@ -0,0 +1,105 @@
+#scheduler.py
+""" Fixed rate cooperative scheduler for the locker loop.
+
+The loop wakes on a fixed tick (start + k * tick, not sleep-then-work, so the
+cycle period doesn't stretch with the work done) and runs the tasks that are
+due, in the order they were added. Each task has its own period and deadline;
+a task that finishes more than its deadline after it was due counts as an
+overrun. Ticks missed because a cycle ran long are skipped, not made up.
+"""
+
+import time
+
+
+class task():
+    """One periodic job: a function, its period and deadline in s, and the PVs it reads."""
+    def __init__(self, name, fn, period, deadline=None, inputs=()):
+        """Takes a name, a function taking the cycle's snapshot, period and deadline in s (default the period) and input PV names."""
+        self.name = name
+        self.fn = fn
+        self.period = period
+        self.deadline = period if deadline is None else deadline
+        self.inputs = list(inputs)
+        self.next = None # time the task is next due, None runs it on the first tick
+        self.runs = 0
+        self.overruns = 0
+        self.last_time = 0 # s from due to finished, last run
+
+
+class scheduler():
+    """Runs tasks at their own rates from one fixed rate tick and counts deadline overruns."""
+    def __init__(self, tick):
+        """Takes the tick period in s."""
+        self.tick = tick
+        self.tasks = []
+        self.start = None # time of tick 0
+        self.k = 0 # number of the tick waited for last
+        self.skipped = 0 # ticks missed because a cycle ran long
+        self.excused = False # set by a task whose long run is expected (calibration)
+
+    def add(self, t):
+        """Takes a task, runs it after the ones added before it."""
+        self.tasks.append(t)
+        return t
+
+    def due(self, now):
+        """Takes the current time, returns the tasks due to run."""
+        if self.start is None:
+            self.start = now
+        return [t for t in self.tasks if t.next is None or now >= t.next - self.tick / 2] # half a tick of slack for timer jitter
+
+    def inputs(self, tasks):
+        """Takes a list of tasks, returns the PV names they read, once each."""
+        names = set()
+        for t in tasks:
+            names.update(t.inputs)
+        return sorted(names)
+
+    def run(self, t, *args):
+        """Takes a task and the arguments for its function, runs it and accounts for its deadline."""
+        start = time.time()
+        release = start if t.next is None else min(t.next, start)
+        self.excused = False
+        try:
+            return t.fn(*args)
+        finally:
+            finish = time.time()
+            t.runs += 1
+            t.last_time = finish - release
+            if t.last_time > t.deadline and not self.excused:
+                t.overruns += 1
+            t.next = release + t.period
+            if t.next < finish: # missed whole periods, don't try to catch up
+                t.next += (int((finish - t.next) / t.period) + 1) * t.period
+
+    def excuse(self):
+        """Called from a running task whose long run is expected, it won't count as an overrun."""
+        self.excused = True
+
+    def retick(self, tick):
+        """Takes a new tick period in s, next ticks count from the last one waited for."""
+        if tick == self.tick:
+            return
+        if self.start is not None:
+            self.start += self.k * self.tick
+            self.k = 0
+        self.tick = tick
+
+    def until_next(self):
+        """Returns the time in s to the next tick, skipping ticks that have already passed."""
+        now = time.time()
+        if self.start is None:
+            return self.tick
+        k = int((now - self.start) / self.tick) + 1 # next tick not yet passed
+        self.skipped += max(k - self.k - 1, 0)
+        self.k = k
+        return self.start + k * self.tick - now
+
+    def overruns(self):
+        """Returns the total overruns of all tasks."""
+        return sum(t.overruns for t in self.tasks)
+
+    def summary(self, maxlen=39):
+        """Returns short text with the overruns of each task that had any, for a status PV."""
+        txt = ' '.join('%s:%d' % (t.name, t.overruns) for t in self.tasks if t.overruns)
+        return (txt or 'no overruns')[0:maxlen]
@@ -0,0 +1,203 @@
+#softioc.py
+""" Serves the locker's own VIT: records from inside the locker process.
+
+With "serve_pvs" in the locker config, the records the locker writes for
+its own state (status, errors, counters, loop time, ...) are hosted by a
+channel access server in the locker process instead of the VIT IOC. A write
+to one of them is a memory update that clients see over CA on the server's
+next pass; the hardware PVs (counter, motor, EVR, RF / diode readbacks) and
+the operator setpoints stay remote. Each served record also gets a .DESC and
+alarm limits where the locker has a threshold for it.
+
+The records must be removed from the VIT IOC of that hutch, two servers of
+one PV name confuse every client.
+
+Needs pcaspy (optional, python 2.7 and 3).
+"""
+
+import logging
+import threading
+import time
+try:
+    import pcaspy
+except ImportError: # optional, only needed with serve_pvs
+    pcaspy = None
+
+major = 2 # pcaspy.Severity.MAJOR_ALARM, usable without pcaspy for the table below
+ok = 0
+
+records = [ # record name after <base>VIT:, pcaspy fields (a limit at or beyond the value alarms, so low is set below 0 where 0 is fine), DESC
+    ('FS_STATUS', dict(type='string'), 'Locker status message'),
+    ('FS_TIMING_ERROR', dict(prec=4, unit='ns'), 'Counter minus target time'),
+    ('FS_LASER_OK', dict(type='enum', enums=['Not OK', 'OK'], states=[major, ok]), 'Laser locked and in time'),
+    ('FS_CTRL_BUSY', dict(type='enum', enums=['Idle', 'Busy'], states=[ok, ok]), 'Calibrating or fixing a jump'),
+    ('FS_BUCKET_ERROR', dict(type='int', low=-1, high=1), 'Bucket jumps seen last check'),
+    ('FS_UNFIXED_ERROR', dict(prec=4, unit='ns', low=-0.05, high=0.05), 'Jump error left after a fix'),
+    ('FS_CORRECTION_CNT', dict(type='int'), 'Bucket jumps fixed since start'),
+    ('FS_CALIB_ERROR', dict(prec=4, unit='ns'), 'RMS error of the last calib'),
+    ('MOV_TIME_DLY', dict(prec=3, unit='s'), 'Time move to counter change'),
+    ('BUCKET_CORRECT_DLY', dict(prec=3, unit='s'), 'Jump fix to counter change'),
+    ('LOOP_TIME', dict(prec=3, unit='s', lolo=-1, low=-1, high=0.1, hihi=1.0), 'Main loop cycle time'),
+    ('DRIFT_CORRECT_VAL', dict(prec=6, unit='ns', low=-0.001, high=0.001), 'Drift correction output'),
+    ('FS_RECOVER_TIME', dict(prec=3, unit='s'), 'Loop error to next good cycle'),
+    ('FS_PV_ERRORS', dict(type='int', low=-1, high=1), 'PV errors in the last 10 min'),
+    ('FS_PV_ERR_SUMMARY', dict(type='string'), 'PVs with the most errors'),
+    ('FS_STATUS_BITS', dict(type='int'), 'Active status conditions'),
+    ('FS_STATUS_CNT', dict(type='int'), 'Number of active conditions'),
+    ('FS_READS_AVOIDED', dict(type='int'), 'Device reads skipped'),
+    ('FS_OVERRUNS', dict(type='int', low=-1, high=1), 'Loop task deadline overruns'),
+    ('FS_OVERRUN_SUMMARY', dict(type='string'), 'Overruns per loop task'),
+    ('FS_HEARTBEAT_JITTER', dict(prec=4, unit='s', low=-1, high=0.25), 'Watchdog increment jitter'),
+    ('FS_HEARTBEAT_LATE', dict(type='int'), 'Late watchdog increments'),
+    ('FS_OFFSET_TRACK', dict(prec=4, unit='ns'), 'Tracked timing offset'),
+    ('FS_OFFSET_TRACK_SIGMA', dict(prec=4, unit='ns'), 'Tracked offset uncertainty'),
+]
+
+server = None # the process's channel access server, shared by every locker in it
+served = dict() # VIT: base -> locker_records, kept when a locker is rebuilt
+lock = threading.Lock()
+
+
+def start():
+    """Starts the process's channel access server and its thread once, returns the server."""
+    global server
+    with lock:
+        if server is None:
+            server = pcaspy.SimpleServer()
+            th = threading.Thread(target=run, name='softioc')
+            th.daemon = True
+            th.start()
+    return server
+
+
+def run():
+    """Server thread: answers client requests and sends monitor updates."""
+    while True:
+        try:
+            server.process(0.05)
+        except Exception as e: # keep serving, one bad request mustn't stop the records
+            logging.error('Soft IOC error: %r', e)
+            time.sleep(0.05)
+
+
+class local_pv():
+    """A served record with the parts of the psp Pv interface the locker uses; reads and writes are memory updates."""
+    served = True
+
+    def __init__(self, records, reason):
+        """Takes the locker_records serving it and the record name after the base."""
+        self.records = records
+        self.reason = reason
+        self.name = records.base + reason
+        self.value = records.driver.getParam(reason)
+        self.secs = 0
+        self.nsec = 0
+        self.severity = 0
+        self.isconnected = True
+        self.ismonitored = False
+        self.monitor_cbs = dict() # id -> function
+        self.next_cb = 0
+
+    def connect(self, timeout=None):
+        self.isconnected = True
+
+    def disconnect(self):
+        self.ismonitored = False
+
+    def get(self, ctrl=None, timeout=None, **kw):
+        return self.value
+
+    def put(self, value, timeout=None, **kw):
+        """Takes a value, stores it and has the server send it to the clients."""
+        self.records.set(self.reason, value)
+        self.update(value)
+
+    def update(self, value):
+        """Takes a new value (from the locker or a client), stores it and calls the monitor callbacks."""
+        self.value = value
+        t = time.time()
+        self.secs = int(t)
+        self.nsec = int((t - self.secs) * 1e9)
+        if self.ismonitored:
+            for cb in list(self.monitor_cbs.values()):
+                cb(None)
+
+    def monitor(self, mask=None, ctrl=False, count=None, wait_first=False):
+        self.ismonitored = True
+
+    def add_monitor_callback(self, cb, once=False):
+        self.next_cb += 1
+        self.monitor_cbs[self.next_cb] = cb
+        return self.next_cb
+
+    def del_monitor_callback(self, id):
+        self.monitor_cbs.pop(id, None)
+
+
+if pcaspy is not None:
+    class driver(pcaspy.Driver):
+        """Stores writes from clients and passes them on to the locker's local_pv."""
+        def __init__(self, records):
+            pcaspy.Driver.__init__(self)
+            self.records = records
+
+        def write(self, reason, value):
+            if reason.endswith('.DESC'):
+                return False # fixed text
+            with self.records.lock:
+                self.setParam(reason, value)
+                self.updatePVs()
+            pv = self.records.pvs.get(reason)
+            if pv is not None:
+                pv.update(value)
+            return True
+
+
+class locker_records():
+    """The records of one locker, served by the process's channel access server under its VIT: base."""
+    def __init__(self, base):
+        """Takes the locker's VIT: base, e.g. 'LAS:FS5:VIT:', creates its records and starts serving them."""
+        self.base = base
+        self.lock = threading.Lock() # the locker and the server thread both update the records
+        self.pvs = dict() # record name -> local_pv
+        pvdb = dict()
+        for reason, fields, desc in records:
+            pvdb[reason] = dict(fields, port=base) # one driver per locker
+            pvdb[reason + '.DESC'] = dict(type='string', value=desc, port=base)
+        S = start()
+        S.createPV(base, pvdb)
+        self.driver = type('driver', (driver,), dict(port=base))(self) # pcaspy finds a driver by its class's port
+        for reason, fields, desc in records: # a defined value, not UDF / INVALID
+            self.driver.setParam(reason, fields.get('value', '' if fields.get('type') == 'string' else 0))
+            self.driver.setParam(reason + '.DESC', desc)
+        self.driver.updatePVs()
+        for reason, fields, desc in records:
+            self.pvs[reason] = local_pv(self, reason)
+
+    def __contains__(self, pvname):
+        """Takes a full PV name, returns True if it is served here."""
+        return pvname.startswith(self.base) and pvname[len(self.base):] in self.pvs
+
+    def pv(self, pvname):
+        """Takes a full PV name served here, returns its local_pv."""
+        return self.pvs[pvname[len(self.base):]]
+
+    def set(self, reason, value):
+        """Takes a record name and value, stores it and flags it for the next monitor update."""
+        with self.lock:
+            self.driver.setParam(reason, value)
+            self.driver.updatePVs()
+
+
+def serve(base):
+    """Takes a locker's VIT: base, returns its locker_records (the same ones again after a rebuild), None (and a warning) if pcaspy isn't installed."""
+    if pcaspy is None:
+        print('serve_pvs is set but pcaspy is not installed, using the VIT IOC records')
+        logging.warning('serve_pvs is set but pcaspy is not installed, using the VIT IOC records')
+        return None
+    with lock:
+        if base in served:
+            return served[base]
+    R = locker_records(base)
+    served[base] = R
+    return R
@@ -0,0 +1,270 @@
+#supervisor.py
+""" Starts and watches the fstiming scripts of one IOC (what st.cmd used to dispatch).
+
+python supervisor.py [--spawn] <IOC>
+
+The IOC name picks the scripts, as st.cmd did: <base>-<hutch>, e.g.
+py-fstiming-CXI runs femto.py CXI, py-fstiming-cast-sxr runs pcav2cast_sxr.py.
+Heavy modules are imported once here and each worker is forked from this
+process, so starting or restarting it skips interpreter start up and those
+imports (--spawn starts a fresh interpreter instead). pyca opens its channel
+access context when imported and a context does not survive a fork, so the
+psp scripts only get NumPy preloaded; pyepics connects lazily and is
+preloaded too.
+
+A worker that crashes (exit code not 0, or killed) is started again after a
+delay that doubles with every crash in a row (1 s up to 60 s), and goes back
+to 1 s once a worker has run for a minute. A worker that exits with code 0
+(its watchdog handed over to another instance) is not restarted. Workers call
+ready() after their first good cycle; the supervisor logs how long that took
+after the start, with the restart count.
+
+Works with python 2.7 (femto.py, time_tool.py) and 3 (pcav2cast).
+"""
+
+import atexit
+import importlib
+import os
+import runpy
+import select
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+reported = False # ready() already told the supervisor
+
+
+def ready():
+    """Tells the supervisor that started this process, if any, that its first cycle is done. Only the first call sends anything."""
+    global reported
+    if reported:
+        return
+    reported = True
+    fd = os.environ.get('FS_READY_FD')
+    if fd is None: # not run by the supervisor
+        return
+    try:
+        os.write(int(fd), b'ready\n')
+        os.close(int(fd))
+    except (OSError, ValueError):
+        pass
+
+
+def say(*args):
+    """Prints a line to the IOC console right away, stamped with the time."""
+    sys.stdout.write(time.strftime('%Y-%m-%d %H:%M:%S') + ' supervisor: ' + ' '.join(str(x) for x in args) + '\n')
+    sys.stdout.flush()
+
+
+def plan(ioc):
+    """Takes the IOC name, returns ([(script, args)], modules to preload), ([], []) if it is not a fstiming IOC."""
+    hutch = ioc.split('-')[-1]
+    base = ioc[:-len(hutch)-1]
+    if base == 'py-fstiming':
+        return [('femto_longdelay.py' if hutch == 'XCS' else 'femto.py', [hutch])], ['numpy'] # XCS runs the long delay variant
+    if base == 'py-fstiming-host':
+        return [('femto_host.py', os.environ.get('HUTCHES', '').split())], ['numpy'] # lockers to run in one process, e.g. "CXI MFX XCS"
+    if base == 'py-fstiming-tt':
+        return [('time_tool.py', [hutch])], ['numpy']
+    if base == 'py-fstiming-cast':
+        return [('pcav2cast_' + hutch + '.py', [])], ['numpy', 'epics']
+    return [], []
+
+
+class worker():
+    """One supervised script: how to start it, its process and its restart history."""
+    def __init__(self, script, args):
+        """Takes the script file and its command line arguments."""
+        self.script = script
+        self.args = list(args)
+        self.name = ' '.join([script] + self.args)
+        self.pid = None # running process, None while waiting to start
+        self.proc = None # Popen, when spawned
+        self.ready_fd = None # read end of the pipe ready() writes to
+        self.started = 0 # time of the last start
+        self.first_cycle = None # s from the last start to ready(), None until then
+        self.restarts = 0
+        self.delay = 1.0 # s before the next restart
+        self.next_start = 0 # time to start it again, None once it is done
+
+
+class supervisor():
+    """Forks (or spawns) the workers of one IOC, restarts crashed ones with backoff and logs restart latency."""
+    def __init__(self, workers, preload=(), fork=True):
+        """Takes the workers, modules to import before the first start and whether to fork them from this process."""
+        self.workers = workers
+        self.fork = fork and hasattr(os, 'fork')
+        self.min_delay = 1.0 # s, first restart delay
+        self.max_delay = 60.0 # s, longest restart delay
+        self.stable = 60.0 # s a worker must run for the delay to go back to min_delay
+        self.stopping = False
+        if self.fork:
+            for name in preload:
+                t = time.time()
+                try:
+                    importlib.import_module(name)
+                    say('preloaded', name, 'in %.2f s' % (time.time() - t))
+                except Exception as e: # the worker will report it properly
+                    say('cannot preload', name + ':', repr(e))
+
+    def start(self, w):
+        """Takes a worker, starts its process."""
+        r, fd = os.pipe()
+        w.started = time.time()
+        w.first_cycle = None
+        if self.fork:
+            pid = os.fork()
+            if pid == 0:
+                os.close(r)
+                self.child(w, fd)
+            w.pid = pid
+        else:
+            env = dict(os.environ, FS_READY_FD=str(fd))
+            kw = dict(pass_fds=(fd,)) if sys.version_info[0] >= 3 else dict(close_fds=False)
+            w.proc = subprocess.Popen([sys.executable, w.script] + w.args, env=env, **kw)
+            w.pid = w.proc.pid
+        os.close(fd)
+        w.ready_fd = r
+        say('started', w.name, 'pid', w.pid, 'restart', w.restarts)
+
+    def child(self, w, fd):
+        """Runs in the forked process: takes the worker and the ready pipe, runs the script as __main__ and exits with its code."""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for x in self.workers: # pipes of the other workers belong to the supervisor
+            if x.ready_fd is not None:
+                os.close(x.ready_fd)
+        os.environ['FS_READY_FD'] = str(fd)
+        sys.argv = [w.script] + w.args
+        code = 0
+        try:
+            runpy.run_path(w.script, run_name='__main__')
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else: # sys.exit('message')
+                sys.stderr.write(str(e.code) + '\n')
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        try:
+            atexit._run_exitfuncs() # os._exit skips them, fslog writes out its queue here
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code) # never return into the supervisor's loop
+
+    def poll(self, w):
+        """Takes a running worker, returns its exit code (negative signal number if killed), None while it runs."""
+        if w.proc is not None:
+            return w.proc.poll()
+        pid, status = os.waitpid(w.pid, os.WNOHANG)
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def read_ready(self, timeout):
+        """Waits up to timeout s for ready() messages from the workers and logs their time to first cycle."""
+        fds = dict((w.ready_fd, w) for w in self.workers if w.ready_fd is not None)
+        if not fds:
+            time.sleep(timeout)
+            return
+        try:
+            readable = select.select(list(fds), [], [], timeout)[0]
+        except (select.error, OSError): # interrupted by a signal
+            return
+        for fd in readable:
+            w = fds[fd]
+            data = os.read(fd, 64)
+            os.close(fd)
+            w.ready_fd = None # one message, or end of file if it exited first
+            if data:
+                w.first_cycle = time.time() - w.started
+                say(w.name, 'first cycle %.2f s after start, restart' % w.first_cycle, w.restarts)
+
+    def exited(self, w, code):
+        """Takes a worker that exited and its exit code, schedules its restart unless it finished cleanly."""
+        run_time = time.time() - w.started
+        w.pid = None
+        w.proc = None
+        if w.ready_fd is not None:
+            os.close(w.ready_fd)
+            w.ready_fd = None
+        if code == 0 or self.stopping:
+            say(w.name, 'finished with code', code, 'after %.1f s' % run_time)
+            w.next_start = None
+            return
+        if run_time > self.stable:
+            w.delay = self.min_delay
+        how = 'killed by signal %d' % -code if code < 0 else 'exited with code %d' % code
+        first = 'first cycle after %.2f s' % w.first_cycle if w.first_cycle is not None else 'no first cycle'
+        say(w.name, how, 'after %.1f s (%s), restart' % (run_time, first), w.restarts + 1, 'in %.0f s' % w.delay)
+        w.next_start = time.time() + w.delay
+        w.delay = min(2 * w.delay, self.max_delay)
+        w.restarts += 1
+
+    def stop(self, signum=None, frame=None):
+        """Signal handler: stops the workers and then the supervisor."""
+        self.stopping = True
+
+    def shutdown(self, timeout=5.0):
+        """Asks the running workers to stop, kills the ones still running after timeout s."""
+        for sig, wait in [(signal.SIGTERM, timeout), (signal.SIGKILL, 1.0)]:
+            running = [w for w in self.workers if w.pid is not None]
+            for w in running:
+                try:
+                    os.kill(w.pid, sig)
+                except OSError:
+                    pass
+            end = time.time() + wait
+            while running and time.time() < end:
+                time.sleep(0.1)
+                for w in running:
+                    code = self.poll(w)
+                    if code is not None:
+                        self.exited(w, code)
+                running = [w for w in running if w.pid is not None]
+
+    def run(self):
+        """Starts the workers and keeps them running until all finish or the supervisor is told to stop."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping:
+            now = time.time()
+            for w in self.workers:
+                if w.pid is None and w.next_start is not None and now >= w.next_start:
+                    self.start(w)
+            if all(w.pid is None and w.next_start is None for w in self.workers):
+                break # all finished
+            self.read_ready(0.5)
+            for w in self.workers:
+                if w.pid is not None:
+                    code = self.poll(w)
+                    if code is not None:
+                        self.exited(w, code)
+        self.shutdown()
+        say('stopped,', ', '.join('%s: %d restarts' % (w.name, w.restarts) for w in self.workers))
+
+
+def main():
+    """Runs the workers of the IOC named on the command line (or in $IOC)."""
+    argv = sys.argv[1:]
+    fork = '--spawn' not in argv
+    argv = [x for x in argv if x != '--spawn']
+    ioc = argv[0] if argv else os.environ.get('IOC', '')
+    scripts, preload = plan(ioc)
+    if not scripts:
+        say('Bad IOC name:', ioc)
+        while True: # Loop forever so we don't spam the log!
+            time.sleep(3600)
+    os.chdir(os.path.dirname(os.path.abspath(__file__))) # scripts and their config files are found from here
+    supervisor([worker(s, a) for s, a in scripts], preload, fork).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,48 +2,52 @@
 import time
 import numpy as np
 import watchdog
-from psp.Pv import Pv
+import channel
+import pvconnect
+import fslog
+import logging
 import sys
+import supervisor
 
 class time_tool():
     def __init__ (self, sys='NULL'): 
         if sys == 'FS11': # set up for new bay 1 laser
-            print('starting FS11')
+            logging.info('starting FS11')
             self.delay = 0.1
             pvname = 'XPP:TIMETOOL:TTALL'  # time tool array name
             dev_base = 'LAS:FS11:VIT:'  
             stagename = 'XPP:LAS:MMN:16'  # delay stage for time tool
             ipmname = 'XPP:SB2:BMMON:SUM' # intensity profile monitor PV
         elif sys == 'FS14':  # set up FS14 system
-            print('starting FS14 pcav2ttdrift')
+            logging.info('starting FS14 pcav2ttdrift')
             self.delay = 0.1 # 1 second delay
             pvname = 'TMO:TIMETOOL:TTALL'  # time tool array name
             dev_base = 'LAS:FS14:VIT:'
             stagename = 'LM1K4:COM_MP2_DLY1'  # delay stage for time tool
             ipmname = 'EM2K0:XGMD:HPS:milliJoulesPerPulse' # intensity profile monitor PV
         elif sys == 'XPP':  # set up xpp system
-            print('starting XPP')
+            logging.info('starting XPP')
             self.delay = 0.1 # 1 second delay
             pvname = 'XPP:TIMETOOL:TTALL'  # time tool array name
             dev_base = 'LAS:FS3:VIT:'
             stagename = 'XPP:LAS:MMN:16'  # delay stage for time tool
             ipmname = 'XPP:SB2:BMMON:SUM' # intensity profile monitor PV
         elif sys == 'XCS':  # set up xcs system
-            print('starting XCS')
+            logging.info('starting XCS')
             self.delay = 0.1 # 1 second delay
             pvname = 'XCS:TIMETOOL:TTALL'  # time tool array name
             dev_base = 'LAS:FS4:VIT:'
             stagename = 'XCS:LAS:MMN:01'  # delay stage for time tool
             ipmname = 'XCS:SB1:BMMON:SUM' # intensity profile monitor PV
         elif sys == 'MFX':  # set up xcs system
-            print('starting MFX')
+            logging.info('starting MFX')
             self.delay = 0.1 # 1 second delay
             pvname = 'MFX:TT:01:TTALL'  # time tool array name
             dev_base = 'LAS:FS45:VIT:'
             stagename = 'MFX:LAS:MMN:06'  # delay stage for time tool
             ipmname = 'MFX:DG2:BMMON:SUM' # intensity profile monitor PV
         elif sys == 'CXI':  # set up cxi system
-            print('starting CXI')
+            logging.info('starting CXI')
             self.delay = 0.1 # 1 second delay
             pvname = 'CXI:TT:01:TTALL' #time tool array name
             dev_base = 'LAS:FS5:VIT:'
@@ -51,16 +55,14 @@ class time_tool():
             #stagename = 'CXI:USR:MMN:25'  # delay stage for time tool
             ipmname = 'CXI:DG2:BMMON:SUM' # intensity profile monitor PV
         else:
-            print(sys+' not found, exiting')
+            logging.error('%s not found, exiting', sys)
             exit()
         
-        self.ttpv = Pv(pvname)
-        self.ttpv.connect(timeout=1.0) # connect to pv
-        self.stagepv = Pv(stagename)
-        self.stagepv.connect(timeout=1.0)
-        self.ipmpv = Pv(ipmname)
-        self.ipmpv.connect(timeout=1.0)
+        self.ttpv = channel.Pv(pvname)
+        self.stagepv = channel.Pv(stagename)
+        self.ipmpv = channel.Pv(ipmname)
         self.drift_correct_pv = dict()  # will hold list of IOC pvs
+        self.drift_correct = dict()  # will hold the connected IOC pvs
         self.values = dict() # will hold the numbers from the time tool
         self.limits = dict() # will hold limits from matlab pvs
         self.old_values = dict() # will hold the old values read from matlab
@@ -75,15 +77,33 @@ class time_tool():
         self.drift_correct_pv[7] = dev_base+'STAGE'
         self.drift_correct_pv[8] = dev_base+'IPM'
         self.drift_correct_pv[9] = dev_base+'DRIFT_CORRECT_SIG'
-        for n in range(0,9):
-            self.drift_correct[self.nm[n]] = [Pv(self.drift_correct_pv[n]), Pv(self.drift_correct_pv[n]+'.LOW'), Pv(self.drift_correct_pv[n]+'.HIGH'), Pv(self.drift_correct_pv[n]+'.DESC')]
-            for x in range(0,4):
-                    self.drift_correct[self.nm[n]][x].connect(timeout=1.0)  # connnect to all the various PVs.     
-            for x in range(0,3):
-                self.drift_correct[self.nm[n]][x].get(ctrl=True, timeout=1.0)
-                self.drift_correct[self.nm[n]][3].put(value = self.nm[n], timeout = 1.0)
-        self.W = watchdog.watchdog(self.drift_correct[self.nm[0]][0]) # initialize watchdog   
+        pvs = dict(tt=self.ttpv, stage=self.stagepv, ipm=self.ipmpv)  # everything to connect, by a name for the report
+        for n in range(0,10):
+            self.drift_correct[self.nm[n]] = [channel.Pv(self.drift_correct_pv[n]), channel.Pv(self.drift_correct_pv[n]+'.LOW'), channel.Pv(self.drift_correct_pv[n]+'.HIGH'), channel.Pv(self.drift_correct_pv[n]+'.DESC')]
+            for x, field in enumerate(['', '.LOW', '.HIGH', '.DESC']):
+                pvs[self.nm[n]+field] = self.drift_correct[self.nm[n]][x]
+        missing = pvconnect.connect_all(pvs, timeout=1.0)  # connect and read all the various PVs at once
+        pvconnect.report(missing, pvs)
+        for n in range(0,10):
+            if self.drift_correct[self.nm[n]][3].isconnected:
+                self.drift_correct[self.nm[n]][3].put(value = self.nm[n], timeout = None)  # queued, sent together below
+        channel.flush_io()
+        self.W = watchdog.heartbeat(self.drift_correct[self.nm[0]][0]) # initialize watchdog, increments from its own thread   
         
+    def reconnect(self):
+        """Reconnects any PV that dropped, returns the names that still don't connect."""
+        pvs = [self.ttpv, self.stagepv, self.ipmpv]
+        for n in range(0,10):
+            pvs.extend(self.drift_correct[self.nm[n]])
+        bad = []
+        for pv in pvs:
+            if not getattr(pv, 'isconnected', True):
+                try:
+                    pv.connect(timeout=1.0)
+                except:
+                    bad.append(pv.name)
+        return bad
+
     def read_write(self):   
         self.ttpv.get(ctrl=True, timeout=1.0) # get TT array data
         self.stagepv.get(ctrl=True, timeout=1.0) # get TT stage position
@@ -91,10 +111,10 @@ class time_tool():
         for n in range(1,9):
              self.old_values[self.nm[n]] = self.drift_correct[self.nm[n]][0].value # old PV values
              #self.limits[self.nm[n]] = [self.drift_correct[self.nm[n]][1].value, self.drift_correct[self.nm[n]][2].value] # limits
-        if n in range (1,6):
-            self.drift_correct[self.nm[n]][0].put(value = self.ttpv.value[n-1], timeout = 1.0)  # write to matlab PVs 
-            for x in range(0,3):
-                self.drift_correct[self.nm[n]][x].get(ctrl=True, timeout=1.0)  # get all the matlab pvs
+             if n in range (1,6):
+                 self.drift_correct[self.nm[n]][0].put(value = self.ttpv.value[n-1], timeout = 1.0)  # write to matlab PVs 
+                 for x in range(0,3):
+                     self.drift_correct[self.nm[n]][x].get(ctrl=True, timeout=1.0)  # get all the matlab pvs
         self.drift_correct[self.nm[7]][0].put(value = self.stagepv.value, timeout = 1.0)  # read stage position
         self.drift_correct[self.nm[8]][0].put(value = self.ipmpv.value, timeout = 1.0) # read/write intensity profile
          #print self.ttpv.value
@@ -129,21 +149,42 @@ class time_tool():
 
 def run():  # just a loop to keep recording         
     if len(sys.argv) < 2:
-        T = time_tool()  # initialize
+        name = 'NULL'
     else:
-        T = time_tool(sys.argv[1])
+        name = sys.argv[1]
+    fslog.setup(console=True) # stdout through a queue, a slow console doesn't hold up the loop
+    T = time_tool(name)  # initialize
+    errors = 0 # failed calls in a row
+    max_soft = 3 # failed calls in a row handled by reconnecting before a full restart
+    error_start = None
     while T.W.error == 0:
         T.W.check() # check / update watchdog counter
         time.sleep(T.delay)
         try:
             T.read_write()  # collects the data 
         except:
+            logging.error('Error: %r', sys.exc_info()[1])
+            if error_start is None:
+                error_start = time.time()
+            errors += 1
+            if errors <= max_soft:
+                bad = T.reconnect()  # keep the same PVs and watchdog, only reconnect what dropped
+                if bad:
+                    logging.warning('Still not connected: %s', ', '.join(bad))
+                continue
+            T.W.stop() # the new instance claims the watchdog again
             del T
-            print('Crashed, restarting')
-            T = time_tool() # create again
+            logging.error('Crashed, restarting')
+            T = time_tool(name) # create again for the same hutch
+            errors = 0
             if T.W.error:
                 return        
-    pass  
+            continue
+        supervisor.ready() # first good read, for the restart latency
+        if error_start is not None:
+            logging.info('Recovered after %.3f s', time.time() - error_start)
+            error_start = None
+        errors = 0
 
 if __name__ == "__main__":
    run()
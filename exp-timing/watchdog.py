@@ -1,49 +1,191 @@
 #watchdog.py
+""" Watchdog timer shared by every fstiming script (python 2.7 and 3).
 
+The running instance increments a watchdog PV every cycle. A second instance
+sees the count move and exits instead of fighting the first one, and writing a
+negative value to the PV tells the running instance to exit.
+
+watchdog increments the PV from check(), once per loop cycle. heartbeat does
+it from its own thread every 0.25 s and watches the PV with a monitor, so a
+second writer is seen on its first write and the loop's check() is a flag
+read. The increments pause while the loop has not called check() for 30 s,
+so a hung loop still lets another instance take over.
+"""
+
+import logging
+import threading
 import time  #includes sleep command to wait for other users
+from collections import deque
+import channel
+import ring
+
 class watchdog():
-    def __init__(self, pv):  # pv is an already connected pv
+    """Claims a watchdog PV for this process; error is 1 when the script should exit."""
+    def __init__(self, pv):  # pv is an already connected channel, or a PV name
+        if isinstance(pv, str):
+            pv = channel.Pv(pv)
         self.pv = pv
         self.counter = 0;
         try:
+            if not self.pv.isconnected:
+                self.pv.connect(timeout=1.0)
             self.pv.get(ctrl=True, timeout=1.0)
             self.value = self.pv.value
             if self.value < 0:#command to exit programs
                 self.error = 1 #exit program
-                print 'watchdog pv negative - exiting'
+                print('watchdog pv negative - exiting')
                 return
-            print 'initializing watchdog'
+            print('initializing watchdog')
             time.sleep(1) # wait 1 second1 for an update
             self.pv.get(ctrl=True, timeout=1.0)
         except:
-            print 'cant write watchdog pv, exiting'
+            print('cant write watchdog pv, exiting')
             self.error = 1
             return
         if self.pv.value < 0:#command to exit programs
             self.error = 1 #exit program
-            print 'watchdog pv negative - exiting'
+            print('watchdog pv negative - exiting')
             return
         if self.pv.value != self.value:
             self.error = 1
-            print 'another program is incrementing the watchdog'
+            print('another program is incrementing the watchdog')
             return
         self.error = 0  # OK to continue
 
     def check(self):  # check watchdog timer
+        """Reads the PV, sets error if it was changed by someone else or is negative, else increments it."""
         try:
             self.pv.get(ctrl=True, timeout=1.0)
         except:
-            print 'not able to read watchdog PV, continuing to try'
+            print('not able to read watchdog PV, continuing to try')
             self.error = 0  # not an error (at least for now)
             return
         if self.pv.value < 0:
             self.error = 1 #exit program
-            print 'watchdog pv negative - exiting'
+            print('watchdog pv negative - exiting')
             return
         if self.pv.value != self.value:  # value changed
             self.error = 1
-            print 'another program is incrementing the watchdog'
+            print('another program is incrementing the watchdog')
             return
         self.error = 0
         self.value = self.pv.value+1
         self.pv.put(value = self.value, timeout=1.0) # write new number to increment
+
+
+class heartbeat(watchdog):
+    """watchdog that increments the PV from a background thread; check() only reads the error flag, so a long move or calibration doesn't stall it."""
+    def __init__(self, pv, period=0.25, stall=30.0):
+        """Takes the channel or PV name, the time in s between increments and how long in s the loop may go without calling check() before the increments stop."""
+        watchdog.__init__(self, pv) # claims the PV as before, error set if another instance has it
+        self.period = period
+        self.stall = stall
+        self.lock = threading.Lock()
+        self.sent = deque([getattr(self, 'value', None)], maxlen=8) # our recent values, monitor updates may lag behind the writes
+        self.fed = time.time() # last check() from the control loop
+        self.intervals = ring.ring(100) # s between increments
+        self.last_beat = None
+        self.beats = 0
+        self.late = 0 # increments more than 2 periods after the one before
+        self.failed = 0 # increments that could not be written
+        self.reason = None # why error was set
+        self.told = False # reason printed by the loop thread
+        self.cb_id = None
+        self.stopped = threading.Event()
+        self.thread = None
+        if self.error:
+            return
+        try:
+            self.cb_id = self.pv.add_monitor_callback(self.event)
+            if not getattr(self.pv, 'ismonitored', False): # a shared Pv may already be monitored
+                self.pv.monitor(ctrl=False)
+        except:
+            self.cb_id = None # the thread's read before each write still catches other writers
+            print('cannot monitor watchdog pv, checking on each increment')
+        self.thread = threading.Thread(target=self.run, name=threading.current_thread().name + ':heartbeat') # owner's name first, femto_host sorts log records by it
+        self.thread.daemon = True
+        self.thread.start()
+
+    def event(self, e=None):
+        """Monitor callback: sets error as soon as someone else writes the PV."""
+        if e is None:
+            self.seen(self.pv.value)
+
+    def seen(self, value):
+        """Takes a value read from the PV, sets error if it is negative or was not written by us."""
+        if self.error:
+            return
+        if value is not None and value < 0:
+            self.fail('watchdog pv negative - exiting')
+        elif value not in self.sent:
+            self.fail('another program is incrementing the watchdog')
+
+    def fail(self, reason):
+        """Takes the reason, stops the increments and tells the loop to exit."""
+        self.reason = reason
+        self.error = 1
+        self.stopped.set() # wakes the heartbeat thread, which logs the reason
+
+    def check(self):  # called by the control loop, no channel access
+        """Tells the heartbeat the loop is alive, prints why if it stopped; error is 1 when the script should exit."""
+        self.fed = time.time()
+        if self.error and self.reason and not self.told:
+            print(self.reason)
+            self.told = True
+
+    def run(self):
+        """Heartbeat thread: reads the PV and writes the next value every period, until error or stop()."""
+        channel.attach_context() # use the process CA context from this thread
+        stalled = False
+        while not self.stopped.wait(self.period):
+            if time.time() - self.fed > self.stall: # loop is stuck, let another instance take over
+                if not stalled:
+                    logging.warning('Watchdog %s: no check() for %.0f s, increments paused', self.pv.name, self.stall)
+                stalled = True
+                continue
+            stalled = False
+            try:
+                self.pv.get(ctrl=True, timeout=1.0)
+            except:
+                self.failed += 1 # not an error (at least for now)
+                continue
+            self.seen(self.pv.value)
+            if self.error:
+                break
+            value = self.value + 1
+            self.sent.append(value)
+            try:
+                self.pv.put(value=value, timeout=1.0) # write new number to increment
+            except:
+                self.failed += 1
+                continue
+            self.value = value
+            now = time.time()
+            with self.lock:
+                if self.last_beat is not None:
+                    self.intervals.add_element(now - self.last_beat)
+                    if now - self.last_beat > 2 * self.period:
+                        self.late += 1
+                self.last_beat = now
+                self.beats += 1
+        if self.error: # from this thread, so the log record carries the owner's name
+            logging.warning('Watchdog %s: %s', self.pv.name, self.reason or 'stopped')
+
+    def stats(self):
+        """Returns a dict of increment statistics: beats, late, failed and the mean, jitter (std) and max in s of the recent intervals."""
+        with self.lock:
+            n = self.intervals.count
+            d = dict(beats=self.beats, late=self.late, failed=self.failed)
+            d['mean'] = self.intervals.mean if n else 0.0
+            d['jitter'] = self.intervals.std if n > 1 else 0.0
+            d['max'] = self.intervals.max if n else 0.0
+        return d
+
+    def stop(self):
+        """Stops the increments and the monitor callback, e.g. before the locker is rebuilt."""
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(2 * self.period + 2.0) # an increment in flight would fool the next claim of the PV
+        if self.cb_id is not None:
+            self.pv.del_monitor_callback(self.cb_id)
+            self.cb_id = None
@@ -15,32 +15,19 @@ cd exp-timing
 echo "$hutch"
 
 case $base in
-   py-fstiming)
-      if [[ $hutch = XCS ]]; then
-         script=femto_longdelay.py
-      else
-         script=femto.py
-      fi
-      export MPLCONFIGDIR=/reg/d/iocData/fstiming
-      ;;
    py-fstiming-tt)
-      script=time_tool.py
       export MPLCONFIGDIR=/reg/d/iocData/fstiming-tt
       ;;
    py-fstiming-cast)
       source /reg/g/pcds/setup/epicsenv-3.14.12.sh
       source /cds/group/pcds/pyps/conda/pcds_conda
-      script=pcav2cast_${hutch}.py
       export MPLCONFIGDIR=/reg/d/iocData/fstiming-cast-${hutch}
-      unset hutch
       ;;
    *)
-      echo "Bad IOC name: $IOC"
-         while true; do sleep 3600; done     
-         # Loop forever so we don't spam the log!
+      export MPLCONFIGDIR=/reg/d/iocData/fstiming
       ;;
 esac
 
-echo "Running script $script hutch $hutch"
-python $script $hutch || echo "Script exited with code $?"
-
+# supervisor.py picks the script(s) from $IOC, restarts them if they crash
+echo "Running supervisor for $IOC"
+exec python supervisor.py $IOC